@@ -30,9 +30,14 @@ setup(
         "flask",
         "altair",
         "pandas",
+        "numpy",
 
         "toml",
     ],
+    extras_require={
+        "production": ["waitress"],
+        "arrow": ["pyarrow"],
+    },
 
     url="http://github.com/NSSAC/%s" % package_name,
     classifiers=(
@@ -0,0 +1,248 @@
+"""
+Benchmarks of ingestion, queries and chart rendering at scale.
+
+Synthetic databases with the same tables getpid writes are generated for every size,
+the timings are written as JSON so results of different versions can be compared.
+"""
+import importlib.metadata
+import json
+import os
+import platform
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import altair as alt
+import click
+import logbook
+import numpy as np
+import pandas as pd
+
+from . import cli_main, serve
+from .database import database
+
+log = logbook.Logger(__name__)
+
+SYS_COLUMNS = ["logic_time", "real_time", "cpu_load", "num_cpus", "load_avg", "total_phys_mem",
+               "used_phys_mem", "used_swap_mem", "total_swap_mem"]
+PID_COLUMNS = ["logic_time", "real_time", "cpu_percent", "mem_percent"]
+NUM_PIDS = 4
+CONFIG = """
+[[tab]]
+table_name = "sys_usage"
+mark = "line"
+[tab.encode]
+x = "logic_time"
+y = "cpu_load"
+"""
+# Dataset URLs of the charts of a page, see viz.datasets.split_datasets
+DATASETS_PATTERN = re.compile(r'"simdashDatasets":(\{[^{}]*\})')
+
+def make_bench_database(db_file, num_rows, seed=0):
+    """
+    Create a database with a sys_usage table and NUM_PIDS PID tables of num_rows rows each.
+
+    Args:
+        db_file: path to the new database file
+        num_rows: number of rows of every table
+        seed: seed of the random values
+    Returns:
+        The Database
+    """
+    rng = np.random.default_rng(seed)
+    real_time = pd.Timestamp("2019-01-01").timestamp() + np.arange(num_rows, dtype=float)
+    the_db = database.Database(db_file)
+    the_db.make_table("sys_usage", SYS_COLUMNS, ["FLOAT", "INT"] + ["FLOAT"] * 7, ["Q", "T"] + ["Q"] * 7)
+    the_db.get_table("sys_usage").extend({
+        "real_time": real_time,
+        "cpu_load": rng.uniform(0, 8, num_rows),
+        "num_cpus": np.full(num_rows, 8.0),
+        "load_avg": rng.uniform(0, 8, num_rows),
+        "total_phys_mem": np.full(num_rows, 16.0),
+        "used_phys_mem": rng.uniform(0, 16, num_rows),
+        "used_swap_mem": rng.uniform(0, 2, num_rows),
+        "total_swap_mem": np.full(num_rows, 2.0),
+    }, chunk_size=100000)
+    for pid in range(1, NUM_PIDS + 1):
+        table_name = f"benchpid{pid}"
+        the_db.make_table(table_name, PID_COLUMNS, ["FLOAT", "INT", "FLOAT", "FLOAT"], ["Q", "T", "Q", "Q"])
+        the_db.get_table(table_name).extend({
+            "real_time": real_time,
+            "cpu_percent": rng.uniform(0, 100, num_rows),
+            "mem_percent": rng.uniform(0, 100, num_rows),
+        }, chunk_size=100000)
+    the_db.make_table("displayed_charts", ["l_time", "r_time", "chart_name"], ["FLOAT", "INT", "TEXT"],
+                      ["Q", "T", "N"])
+    charts = the_db.get_table("displayed_charts")
+    for pid in range(1, NUM_PIDS + 1):
+        charts.append(chart_name=f"benchpid{pid}")
+    return the_db
+
+def time_call(func, repeats):
+    """
+    Time a function with no arguments.
+
+    Returns:
+        A dict with the min and median seconds over repeats calls
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "repeats": repeats}
+
+def bench_append(the_tab, num_appends, buffered):
+    """
+    Time appending num_appends rows one at a time.
+
+    Returns:
+        A dict with the seconds taken and the rows per second
+    """
+    start = time.perf_counter()
+    if buffered:
+        with the_tab.buffered(max_rows=10000):
+            for i in range(num_appends):
+                the_tab.append(cpu_percent=i % 100, mem_percent=50.0)
+    else:
+        for i in range(num_appends):
+            the_tab.append(cpu_percent=i % 100, mem_percent=50.0)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "rows_per_second": num_appends / seconds}
+
+def get_ok(client, url, **headers):
+    """
+    Get a URL through the Flask test client, raising RuntimeError unless it is answered with 200.
+    """
+    response = client.get(url, headers=headers)
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} returned {response.status_code}")
+    return response
+
+def transfer_sizes(client, url):
+    """
+    Measure the bytes a browser downloads to show a page, the page itself and the datasets its charts load.
+
+    Returns:
+        A dict with the bytes of the page, of its datasets, of both, and of both when gzipped
+    """
+    page = get_ok(client, url).data
+    urls = set()
+    for match in DATASETS_PATTERN.finditer(page.decode("utf-8")):
+        urls.update(json.loads(match.group(1)).values())
+    dataset_bytes = sum(len(get_ok(client, dataset_url).data) for dataset_url in urls)
+    # Responses too small to be gzipped are counted as they are sent
+    gzip_bytes = sum(len(get_ok(client, part, **{"Accept-Encoding": "gzip"}).data) for part in [url, *urls])
+    return {"page_bytes": len(page), "dataset_bytes": dataset_bytes, "bytes": len(page) + dataset_bytes,
+            "gzip_bytes": gzip_bytes}
+
+def bench_render(client, url, repeats):
+    """
+    Time rendering a page through the Flask test client, with and without the chart cache,
+    and measure the bytes sent for it, see transfer_sizes.
+    """
+    serve.CHART_CACHE.clear()
+    serve.CHART_CACHE.max_entries = 0
+    cold = time_call(lambda: get_ok(client, url), repeats)
+    serve.CHART_CACHE.max_entries = 256
+    get_ok(client, url)
+    warm = time_call(lambda: get_ok(client, url), repeats)
+    return {"cold": cold, "warm": warm, "transfer": transfer_sizes(client, url)}
+
+def run_benchmarks(sizes, directory, repeats=3, num_appends=2000):
+    """
+    Run every benchmark for every size.
+
+    Args:
+        sizes: list of row counts
+        directory: where the synthetic databases are created
+        repeats: number of times every timing is repeated
+        num_appends: number of rows appended one at a time in the append benchmarks
+    Returns:
+        A list of result dicts with the benchmark name, number of rows and timings
+    """
+    results = []
+    client = serve.app.test_client()
+    saved = (serve.DB_PATH, serve.CONFIG_PATH, serve.CHART_CACHE.max_entries)
+    try:
+        # The system charts of the larger sizes combine more points than Altair's row limit,
+        # which is only lifted while benchmarking
+        with alt.data_transformers.disable_max_rows():
+            for num_rows in sizes:
+                run_size(results, client, num_rows, directory, repeats, num_appends)
+    finally:
+        serve.DB_PATH, serve.CONFIG_PATH, serve.CHART_CACHE.max_entries = saved
+    return results
+
+def run_size(results, client, num_rows, directory, repeats, num_appends):
+    """
+    Run every benchmark for one size, adding the results to results.
+    """
+    db_file = os.path.join(directory, f"bench_{num_rows}.db")
+    config_file = os.path.join(directory, f"bench_{num_rows}.toml")
+    for path in (db_file, f"{db_file}-wal", f"{db_file}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    with open(config_file, "w", encoding="utf-8") as tfile:
+        tfile.write(CONFIG)
+
+    log.info(f"Generating {num_rows} rows")
+    start = time.perf_counter()
+    the_db = make_bench_database(db_file, num_rows)
+    results.append({"name": "generate", "rows": num_rows, "seconds": time.perf_counter() - start})
+
+    the_tab = the_db.get_table("sys_usage")
+    results.append({"name": "to_pandas", "rows": num_rows, **time_call(the_tab.to_pandas, repeats)})
+    results.append({"name": "len", "rows": num_rows, **time_call(the_tab.len, repeats)})
+
+    serve.DB_PATH = db_file
+    serve.CONFIG_PATH = config_file
+    for url in ["/displayconfig/", "/pid/", "/sys_usage"]:
+        log.info(f"Rendering {url} for {num_rows} rows")
+        results.append({"name": f"render {url}", "rows": num_rows, **bench_render(client, url, repeats)})
+
+    pid_tab = the_db.get_table("benchpid1")
+    results.append({"name": "append", "rows": num_rows, **bench_append(pid_tab, num_appends, False)})
+    results.append({"name": "append buffered", "rows": num_rows, **bench_append(pid_tab, num_appends, True)})
+
+def environment():
+    """
+    Describe the versions the benchmarks were run with.
+    """
+    try:
+        version = importlib.metadata.version("simdash")
+    except importlib.metadata.PackageNotFoundError:
+        version = "unknown"
+    return {
+        "simdash": version,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "time": pd.Timestamp("now").isoformat(),
+    }
+
+@cli_main.command()
+@click.option("-s", "--sizes", default="1000,10000,100000", show_default=True,
+              help="Comma separated row counts to benchmark, up to 10000000.")
+@click.option("-o", "--output", default="simdash_bench.json", show_default=True,
+              help="Path of the JSON results file.")
+@click.option("-r", "--repeats", default=3, show_default=True, help="Number of times every timing is repeated.")
+@click.option("--appends", default=2000, show_default=True, help="Number of rows appended one at a time.")
+@click.option("--directory", default=None, help="Directory for the generated databases, a temporary one by default.")
+def bench(sizes, output, repeats, appends, directory):
+    """
+    Benchmark ingestion, queries and chart rendering.
+    """
+    sizes = [int(float(size)) for size in sizes.split(",")]
+    if directory is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = run_benchmarks(sizes, tmpdir, repeats, appends)
+    else:
+        results = run_benchmarks(sizes, directory, repeats, appends)
+    with open(output, "w", encoding="utf-8") as ofile:
+        json.dump({"environment": environment(), "results": results}, ofile, indent=2)
+    log.info(f"Wrote results to {output}")
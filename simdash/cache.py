@@ -0,0 +1,78 @@
+"""
+Cache of rendered chart specs for the server.
+
+A chart is only rebuilt when the rows of the tables it is drawn from change.
+The cache key holds everything the chart depends on,
+including a change token of each table from Database.change_token.
+"""
+import collections
+import threading
+
+class ChartCache:
+    """
+    Size-bounded least recently used cache of chart JSON.
+
+    Attributes:
+        max_entries: the number of charts kept
+        hits: number of lookups answered from the cache
+        misses: number of lookups that built the chart
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries_ = collections.OrderedDict()
+        self.lock_ = threading.Lock()
+
+    def get_or_build(self, key, build):
+        """
+        Return the cached chart for key, or build, cache and return it.
+
+        Args:
+            key: hashable key of everything the chart depends on
+            build: function with no arguments that returns the chart
+        """
+        with self.lock_:
+            if key in self.entries_:
+                self.entries_.move_to_end(key)
+                self.hits += 1
+                return self.entries_[key]
+            self.misses += 1
+
+        value = build()
+        self.put(key, value)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key, or default if it is not cached.
+        """
+        with self.lock_:
+            if key not in self.entries_:
+                self.misses += 1
+                return default
+            self.entries_.move_to_end(key)
+            self.hits += 1
+            return self.entries_[key]
+
+    def put(self, key, value):
+        """
+        Cache value under key, dropping the least recently used entries if the cache is full.
+        """
+        if self.max_entries <= 0:
+            return
+        with self.lock_:
+            self.entries_[key] = value
+            self.entries_.move_to_end(key)
+            while len(self.entries_) > self.max_entries:
+                self.entries_.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all cached charts.
+        """
+        with self.lock_:
+            self.entries_.clear()
+
+    def __len__(self):
+        return len(self.entries_)
@@ -10,6 +10,10 @@ import click_completion
 from . import cli_main
 
 import simdash.serve
+import simdash.importer
+import simdash.bench
+import simdash.ingest
+import simdash.manage
 
 if __name__ == "__main__":
     click_completion.init()
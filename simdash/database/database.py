@@ -4,11 +4,144 @@ A Database is a collection of Tables with a variable meta_table that holds infor
 A Database can create Tables while keeping track of each Table's columns and their respective Altair variable types.
 """
 
+import contextlib
 import json
+import os
 import sqlite3
 import warnings
 
-from .table import Table
+from .pids import (PID_COLUMNS, PID_DTYPES, PID_TABLE, PID_VTYPES, PidTable, create_pid_indexes,
+                   parse_pid_table_name)
+from .pool import connect, file_identity, get_pool
+from .table import Table, parse_interval, rollup_table_name
+
+# Parsed meta_table rows of every database file, keyed by path,
+# along with the pool.file_identity of the file and the PRAGMA schema_version they were read at
+_META_CACHE = {}
+# Tables holding the server's own state, such as the PIDs shown on the /pid/ page,
+# which databases made of several files keep in a file of their own
+SERVER_TABLES = ("displayed_charts",)
+
+def create_time_indexes(curs, table_name, l_column, r_column):
+    """
+    Create the indexes on the logical time and real time columns of a table.
+    """
+    for column in (l_column, r_column):
+        curs.execute(f'CREATE INDEX IF NOT EXISTS "{table_name}__{column}" ON "{table_name}"("{column}");')
+
+def migrate_time_indexes(curs):
+    """
+    Add the time indexes to tables made before make_table created them.
+    """
+    rows = curs.execute("SELECT table_name, l_time_column, r_time_column FROM meta_table;").fetchall()
+    existing = {row[0] for row in curs.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    for table_name, l_column, r_column in rows:
+        if table_name in existing:
+            create_time_indexes(curs, table_name, l_column, r_column)
+
+def migrate_meta_rollups(curs):
+    """
+    Add the column holding the rollups of every table to the meta table.
+    """
+    if "rollups" not in [row[1] for row in curs.execute("PRAGMA table_info(meta_table);")]:
+        curs.execute("ALTER TABLE meta_table ADD COLUMN rollups TEXT;")
+
+def migrate_meta_retention(curs):
+    """
+    Add the column holding the retention policy of every table to the meta table.
+    """
+    if "retention" not in [row[1] for row in curs.execute("PRAGMA table_info(meta_table);")]:
+        curs.execute("ALTER TABLE meta_table ADD COLUMN retention TEXT;")
+
+def create_rollup(curs, table_name, l_column, r_column, seconds, columns):
+    """
+    Create a rollup table of a table and the trigger that keeps it up to date, filling it from the existing rows.
+
+    The rollup table has a row per bucket of seconds of real time, with the number of rows,
+    the range of logical time and the count, sum, min and max of every column.
+    Every row inserted into the table is added to its bucket by an UPSERT in the trigger,
+    so rollups stay up to date however the rows are written, and are kept when rows are pruned.
+
+    Args:
+        curs: cursor of a transaction
+        table_name, l_column, r_column: the table and its time columns
+        seconds: width of the buckets in seconds
+        columns: the numeric columns to roll up
+    """
+    rollup_name = rollup_table_name(table_name, seconds)
+    bucket = f'CAST("{r_column}" / {seconds} AS INTEGER) * {seconds}'
+    fields = ["rows_", "l_min", "l_max"]
+    for column in columns:
+        fields += [f"{column}__count", f"{column}__sum", f"{column}__min", f"{column}__max"]
+    definitions = ", ".join(f'"{field}" FLOAT' for field in fields)
+    curs.execute(f'CREATE TABLE IF NOT EXISTS "{rollup_name}"("bucket" INTEGER PRIMARY KEY, {definitions});')
+
+    names = ", ".join(f'"{field}"' for field in ["bucket"] + fields)
+    values = [bucket.replace(f'"{r_column}"', f'NEW."{r_column}"'), "1", f'NEW."{l_column}"', f'NEW."{l_column}"']
+    updates = ['"rows_" = "rows_" + 1', '"l_min" = min("l_min", excluded."l_min")',
+               '"l_max" = max("l_max", excluded."l_max")']
+    aggregates = [f'count("{l_column}")', f'min("{l_column}")', f'max("{l_column}")']
+    for column in columns:
+        values += [f'NEW."{column}" IS NOT NULL'] + [f'NEW."{column}"'] * 3
+        aggregates += [f'count("{column}")', f'sum("{column}")', f'min("{column}")', f'max("{column}")']
+        count, total, low, high = (f'"{column}__{name}"' for name in ("count", "sum", "min", "max"))
+        # NULL values are skipped, like the aggregate functions do
+        updates += [f"{count} = {count} + excluded.{count}",
+                    f"{total} = coalesce({total} + excluded.{total}, {total}, excluded.{total})",
+                    f"{low} = coalesce(min({low}, excluded.{low}), {low}, excluded.{low})",
+                    f"{high} = coalesce(max({high}, excluded.{high}), {high}, excluded.{high})"]
+    curs.execute(f'INSERT INTO "{rollup_name}"({names}) SELECT {bucket}, {", ".join(aggregates)} '
+                 f'FROM "{table_name}" WHERE "{r_column}" IS NOT NULL GROUP BY 1;')
+    curs.execute(f'CREATE TRIGGER IF NOT EXISTS "{rollup_name}__insert" AFTER INSERT ON "{table_name}" '
+                 f'WHEN NEW."{r_column}" IS NOT NULL BEGIN '
+                 f'INSERT INTO "{rollup_name}"({names}) VALUES ({", ".join(values)}) '
+                 f'ON CONFLICT("bucket") DO UPDATE SET {", ".join(updates)}; END;')
+
+# Schema migrations, PRAGMA user_version holds the number of migrations applied to a database
+MIGRATIONS = [migrate_time_indexes, migrate_meta_rollups, migrate_meta_retention]
+
+@contextlib.contextmanager
+def pooled(filename, readonly=True, size=8):
+    """
+    Context manager that gives a Database on a connection from this process's pool for the file.
+
+    The server uses this instead of Database(filename) so connections are reused between requests.
+    Tables got from the Database share its connection and must not be used after the with block.
+
+    Args:
+        filename: path to the database file
+        readonly: use a read-only connection, or the pool's single writable one
+        size: largest number of connections of the read-only pool, used when the pool is created
+    A partitioned database directory gives a PartitionedDatabase on the pool of its catalog,
+    and a directory or glob of the files of many runs a FederatedDatabase on read-only pools of the files.
+    """
+    from .federation import FederatedDatabase, is_federated
+    from .partition import PartitionedDatabase, is_partitioned
+    if is_partitioned(filename) or is_federated(filename):
+        cls = PartitionedDatabase if is_partitioned(filename) else FederatedDatabase
+        the_db = cls(filename, readonly=readonly, pool_size=size)
+        try:
+            yield the_db
+        finally:
+            the_db.close()
+        return
+    with get_pool(filename, readonly, size).connection() as conn:
+        yield Database(filename, conn=conn)
+
+def get_database(db_name):
+    """
+    Return db_name if it is a Database already, otherwise open the database file,
+    the directory of a partitioned database, or the directory or glob of the files of many runs, db_name.
+    """
+    from .federation import FederatedDatabase, is_federated
+    from .partition import PartitionedDatabase, is_partitioned
+    if isinstance(db_name, Database):
+        return db_name
+    if is_partitioned(db_name):
+        return PartitionedDatabase(db_name)
+    if is_federated(db_name):
+        return FederatedDatabase(db_name)
+    return Database(db_name)
 
 class Database:
     """
@@ -16,28 +149,49 @@ class Database:
 
     A Database can create Tables while keeping track of each Table's columns and their respective Altair variable types.
     """
-    def __init__(self, filename):
+    # Whether charts follow new rows by rowid, see Table.rows_since, otherwise they are refreshed with the page
+    streams_rows = True
+
+    def __init__(self, filename, conn=None):
         """
         Initialize the database connection and meta table.
 
         Args:
             filename: Path to the file, should end in .db
+            conn: an open connection to the file to use instead of opening a new one,
+                the meta table is expected to exist already
         """
+        if conn is not None:
+            self.filename = filename
+            self.conn = conn
+            return
         if filename is not None:
             try:
-                self.conn = sqlite3.connect(filename)
+                self.conn = connect(filename)
                 with self.conn:
                     curs = self.conn.cursor()
                     create_table_string = """CREATE TABLE IF NOT EXISTS
                     meta_table(table_name TEXT, columns TEXT, dtypes TEXT,
                     vtypes TEXT, l_time_column TEXT, r_time_column TEXT);"""
                     curs.execute(create_table_string)
+                self.migrate()
             except sqlite3.Error as err:
                 print("SQLite error: %s" %err)
         self.filename = filename
-        self.conn.execute("PRAGMA journal_mode=wal;")
 
-    def make_table(self, table_name, columns, dtypes, vtypes):
+    def migrate(self):
+        """
+        Bring an existing database up to date with the current schema.
+        """
+        with self.conn:
+            curs = self.conn.cursor()
+            version = curs.execute("PRAGMA user_version;").fetchone()[0]
+            for migration in MIGRATIONS[version:]:
+                migration(curs)
+            if version < len(MIGRATIONS):
+                curs.execute(f"PRAGMA user_version = {len(MIGRATIONS)};")
+
+    def make_table(self, table_name, columns, dtypes, vtypes, rollups=None):
         """
         Make a Table with the corresponding columns.
 
@@ -51,6 +205,8 @@ class Database:
                 One of (INT, FLOAT, or TEXT)
             vtypes: List of the variable types (Altair encodings) of each of the columns,
                 One of ('Q', 'T', 'O', 'N')
+            rollups: dict mapping bucket widths, such as '1min' and '1h', to lists of numeric columns,
+                see add_rollup
         """
         possible_dtype_list = ["INT", "FLOAT", "TEXT"]
         possible_vtype_list = ["Q", "T", "O", "N"]
@@ -71,9 +227,10 @@ class Database:
                 if row[0] == table_name:
                     warnings.warn("This table has already been created", UserWarning)
                     return
-            sql_insert_meta_string = "INSERT INTO meta_table VALUES(?, ?, ?, ?, ?, ?);"
+            sql_insert_meta_string = """INSERT INTO meta_table(table_name, columns, dtypes, vtypes,
+            l_time_column, r_time_column, rollups, retention) VALUES(?, ?, ?, ?, ?, ?, ?, ?);"""
             insert_meta_tuple = (table_name, json.dumps(columns), json.dumps(dtypes),
-                                 json.dumps(vtypes), columns[0], columns[1])
+                                 json.dumps(vtypes), columns[0], columns[1], json.dumps({}), json.dumps({}))
             curs.execute(sql_insert_meta_string, insert_meta_tuple)
 
             # Create the table
@@ -82,32 +239,192 @@ class Database:
             for i, value in enumerate(columns[1:], 1):
                 sql_alter_table = 'ALTER TABLE {tn} ADD COLUMN "{cn}" "{ct}";'
                 curs.execute(sql_alter_table.format(tn=table_name, cn=value, ct=dtypes[i]))
-            return
+            create_time_indexes(curs, table_name, columns[0], columns[1])
+        for interval, rollup_columns in (rollups or {}).items():
+            self.add_rollup(table_name, interval, rollup_columns)
+
+    def add_rollup(self, table_name, interval, columns):
+        """
+        Keep the count, mean, min and max of columns of a table for every bucket of real time.
+
+        The rollup is filled from the rows already in the table and kept up to date as rows are written,
+        charts of long time ranges read it instead of the rows, see Table.choose_rollup.
+
+        Args:
+            table_name: name of the table
+            interval: width of the buckets, seconds or a duration such as '1min' or '1h'
+            columns: list of numeric columns to roll up
+        """
+        seconds = int(parse_interval(interval))
+        if seconds < 1:
+            raise ValueError(f"Rollup interval {interval} is shorter than a second")
+        table_columns, dtypes, _, l_column, r_column, rollups = self.get_meta()[table_name]
+        for column in columns:
+            if column not in table_columns or column in (l_column, r_column):
+                raise ValueError(f"Column {column} of table {table_name} can not be rolled up")
+            if dtypes[table_columns.index(column)].upper() == "TEXT":
+                raise ValueError(f"Column {column} of table {table_name} is not numeric")
+        if seconds in rollups:
+            raise ValueError(f"Table {table_name} already has a {seconds} second rollup")
+        rollups = dict(rollups)
+        rollups[seconds] = list(columns)
+        with self.conn:
+            curs = self.conn.cursor()
+            create_rollup(curs, table_name, l_column, r_column, seconds, columns)
+            curs.execute("UPDATE meta_table SET rollups = ? WHERE table_name = ?;",
+                         (json.dumps(rollups), table_name))
+
+    def get_meta(self):
+        """
+        Get the parsed rows of the meta table.
+
+        The rows only change along with the schema, in make_table and remove_table,
+        so they are cached for every database file until PRAGMA schema_version changes or the file is replaced.
+
+        Returns:
+            A dict mapping table names to tuples of (columns, dtypes, vtypes, l_time_column, r_time_column,
+            dict mapping rollup seconds to columns)
+        """
+        version = self.conn.execute("PRAGMA schema_version;").fetchone()[0]
+        key = os.path.abspath(self.filename)
+        identity = file_identity(self.filename)
+        cached = _META_CACHE.get(key)
+        if cached is not None and cached[:2] == (identity, version):
+            return cached[2]
+        meta = {}
+        sql = "SELECT table_name, columns, dtypes, vtypes, l_time_column, r_time_column, rollups FROM meta_table;"
+        for row in self.conn.execute(sql):
+            rollups = {int(seconds): columns for seconds, columns in json.loads(row[6] or "{}").items()}
+            meta.setdefault(row[0], (json.loads(row[1]), json.loads(row[2]), json.loads(row[3]), row[4], row[5],
+                                     rollups))
+        _META_CACHE[key] = (identity, version, meta)
+        return meta
 
     def get_table(self, table_name):
         """
         Get the Table object with the specified name.
 
+        The Table shares this Database's connection.
+
         Args:
             table_name: the name of the table
         Returns:
             the_returned_tab: The Table object associated with the passed table_name
         """
-        with self.conn:
-            curs = self.conn.cursor()
-            sql_get_table = f"SELECT table_name, l_time_column, r_time_column FROM meta_table WHERE table_name = ?;"
-            curs.execute(sql_get_table, (table_name,))
-            tup = curs.fetchone()
-
-            # Keep track of logical time and real time col names
-            if tup is not None:
-                l_time_ = str(tup[1])
-                r_time_ = str(tup[2])
-            else:
-                raise ValueError("This table hasn't been made yet. Make this table before getting it")
-        the_returned_tab = Table(self.filename, table_name, l_time_, r_time_)
+        meta = self.get_meta().get(table_name)
+        if meta is None:
+            raise ValueError("This table hasn't been made yet. Make this table before getting it")
+        columns, dtypes, vtypes, l_time_, r_time_, rollups = meta
+        the_returned_tab = Table(self.filename, table_name, str(l_time_), str(r_time_),
+                                 conn=self.conn, columns=columns, vtypes=vtypes, dtypes=dtypes, rollups=rollups)
         return the_returned_tab
 
+    def set_retention(self, table_name, max_rows=None, max_age=None, keep_rollups=False):
+        """
+        Set how many rows of a table are kept, older rows are deleted by retention.prune_database.
+
+        Args:
+            table_name: name of the table
+            max_rows: largest number of rows kept, None for no limit
+            max_age: oldest real time kept, seconds or a duration such as '7 days', before now, None for no limit
+            keep_rollups: keep every bucket of the table's rollups, so history older than the rows
+                is only kept as rollups; rollup buckets older than the rows are deleted otherwise
+        """
+        if table_name not in self.get_meta():
+            raise ValueError("This table hasn't been made yet. Make this table before setting its retention")
+        retention = {}
+        if max_rows is not None:
+            if max_rows < 0:
+                raise ValueError("max_rows must not be negative")
+            retention["max_rows"] = int(max_rows)
+        if max_age is not None:
+            retention["max_age"] = parse_interval(max_age)
+        if keep_rollups:
+            if not retention:
+                raise ValueError("keep_rollups needs max_rows or max_age")
+            retention["keep_rollups"] = True
+        with self.conn:
+            self.conn.execute("UPDATE meta_table SET retention = ? WHERE table_name = ?;",
+                              (json.dumps(retention), table_name))
+
+    def get_retention(self, table_name):
+        """
+        Get the retention policy of a table set by set_retention.
+
+        Policies are read from the meta table every time, unlike get_meta,
+        since setting one does not change the schema.
+
+        Returns:
+            A dict with any of max_rows, max_age in seconds and keep_rollups, empty if every row is kept
+        """
+        row = self.conn.execute("SELECT retention FROM meta_table WHERE table_name = ?;", (table_name,)).fetchone()
+        return json.loads(row[0] or "{}") if row is not None else {}
+
+    def make_pid_table(self):
+        """
+        Make the long-format PID table and its composite indexes, see PidTable.
+
+        Returns:
+            The PidTable
+        """
+        if not self.check_if_table_exists(PID_TABLE):
+            self.make_table(PID_TABLE, PID_COLUMNS, PID_DTYPES, PID_VTYPES)
+        with self.conn:
+            create_pid_indexes(self.conn.cursor())
+        return self.get_pid_table()
+
+    def get_pid_table(self):
+        """
+        Get the long-format PID table, sharing this Database's connection.
+
+        Returns:
+            The PidTable, None if the database has none
+        """
+        meta = self.get_meta().get(PID_TABLE)
+        if meta is None:
+            return None
+        return PidTable(self.filename, conn=self.conn, columns=meta[0], vtypes=meta[2], dtypes=meta[1],
+                        rollups=meta[5])
+
+    def pid_key(self, table_name):
+        """
+        Get the (user, pid) key of a PID chart name that is kept in the long-format PID table.
+
+        Args:
+            table_name: a PID table name, such as rootpid1234
+        Returns:
+            A tuple containing (user, pid), None if table_name is a table of its own or not a PID table name
+        """
+        if table_name in self.get_meta() or PID_TABLE not in self.get_meta():
+            return None
+        return parse_pid_table_name(table_name)
+
+    def consolidate_pid_tables(self):
+        """
+        Move the rows of every per-PID table into the long-format PID table, dropping the per-PID tables.
+
+        Every table is moved in a transaction of its own, so this can be stopped and run again.
+
+        Returns:
+            A list of the names of the tables moved
+        """
+        pid_tab = self.make_pid_table()
+        moved = []
+        for table_name, (columns, _, _, l_column, r_column, _) in self.get_meta().items():
+            key = parse_pid_table_name(table_name)
+            if key is None or not {"cpu_percent", "mem_percent"} <= set(columns):
+                continue
+            with self.conn:
+                self.conn.execute(
+                    f'INSERT INTO "{PID_TABLE}" ("logic_time", "real_time", "user", "pid", "cpu_percent", '
+                    f'"mem_percent") SELECT "{l_column}", "{r_column}", ?, ?, "cpu_percent", "mem_percent" '
+                    f'FROM "{table_name}" ORDER BY rowid;', key)
+                self.conn.execute(f'DROP TABLE IF EXISTS "{table_name}";')
+                self.conn.execute("DELETE FROM meta_table WHERE table_name = ?;", (table_name,))
+            moved.append(table_name)
+        pid_tab.logical_time = float(pid_tab.time_range()[1] or 0.0)
+        return moved
+
     def remove_table(self, table_name):
         """
         Remove the table and delete its information.
@@ -119,6 +436,9 @@ class Database:
             curs = self.conn.cursor()
             sql_drop_table = "DROP TABLE IF EXISTS {tn};".format(tn=table_name)
             sql_delete_from_meta = f'DELETE FROM meta_table WHERE table_name="{table_name}"'
+            meta = self.get_meta().get(table_name)
+            for seconds in (meta[5] if meta is not None else {}):
+                curs.execute(f'DROP TABLE IF EXISTS "{rollup_table_name(table_name, seconds)}";')
             curs.execute(sql_drop_table)
             curs.execute(sql_delete_from_meta)
 
@@ -129,13 +449,7 @@ class Database:
         Returns:
             A list of the tables in the database
         """
-        tab_list = []
-        with self.conn:
-            sql = "SELECT table_name FROM meta_table;"
-            curs = self.conn.cursor()
-            for row in curs.execute(sql):
-                tab_list.append(row[0])
-        return tab_list
+        return list(self.get_meta())
 
     def get_tables_and_info(self):
         """
@@ -144,16 +458,10 @@ class Database:
         Returns:
             A tuple containing (List of tables, List of columns, list of vtypes)
         """
-        tab_list = []
-        col_list = []
-        vtype_list = []
-        with self.conn:
-            sql = "SELECT table_name, columns, vtypes from meta_table;"
-            curs = self.conn.cursor()
-            for row in curs.execute(sql):
-                tab_list.append(row[0])
-                col_list.append(json.loads(row[1]))
-                vtype_list.append(json.loads(row[2]))
+        meta = self.get_meta()
+        tab_list = list(meta)
+        col_list = [meta[table_name][0] for table_name in tab_list]
+        vtype_list = [meta[table_name][2] for table_name in tab_list]
         return (tab_list, col_list, vtype_list)
 
     def get_table_cols_and_vtypes(self, table_name):
@@ -165,12 +473,24 @@ class Database:
         Returns:
             A tuple containing (list of columns, list of vtypes)
         """
-        sql = f"SELECT table_name, columns, vtypes FROM meta_table WHERE table_name='{table_name}'"
-        with self.conn:
-            curs = self.conn.cursor()
-            curs.execute(sql)
-            fetched = curs.fetchone()
-            return (json.loads(fetched[1]), json.loads(fetched[2]))
+        meta = self.get_meta()[table_name]
+        return (meta[0], meta[2])
+
+    def change_token(self, table_name):
+        """
+        Get a cheap value that changes whenever rows are added to or pruned from the start of a table.
+
+        Both ends of the rowid b-tree are read, so this does not depend on the size of the table.
+
+        Args:
+            table_name: name of the table
+        Returns:
+            A tuple containing (smallest rowid, largest rowid)
+        """
+        # Separate subqueries, SQLite only reads the ends of the b-tree for a lone min or max
+        cur = self.conn.execute(f'SELECT (SELECT min(rowid) FROM "{table_name}"), '
+                                f'(SELECT max(rowid) FROM "{table_name}");')
+        return tuple(cur.fetchone())
 
     def check_if_table_exists(self, table_name):
         """
@@ -179,8 +499,4 @@ class Database:
         Args:
             table_name: name of table that is being checked
         """
-        sql = f"SELECT table_name FROM meta_table WHERE table_name='{table_name}'"
-        with self.conn:
-            curs = self.conn.cursor()
-            curs.execute(sql)
-            return curs.fetchone() is not None
+        return table_name in self.get_meta()
@@ -0,0 +1,530 @@
+"""
+The database files of many runs read as one database.
+
+A simulation run on many nodes, or swept over parameters, writes a database file per run.
+A FederatedDatabase reads every .db file of a directory, or every file matching a glob, as one database:
+the tables with the same name in every file are merged into a FederatedTable,
+with a run column holding the name of the file every row came from, which charts can colour or facet by.
+Files are read in parallel on a pool of threads, SQLite lets go of the GIL while it reads.
+
+The meta table of every file is kept until the file changes on disk,
+so adding a run to a dashboard only reads the meta table of the new file.
+Rowids of different files can not be put in one order, so charts of federated tables
+are refreshed with the page instead of following new rows.
+"""
+import concurrent.futures
+import glob
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .database import SERVER_TABLES, Database
+from .partition import is_partitioned
+from .pool import connect, get_pool
+from .table import Table, _merge_range, combine_aggregates, epoch_to_datetime64, partial_aggregate
+
+RUN_COLUMN = "run"
+# Name of the run column of tables that have a run column of their own
+SOURCE_COLUMN = "source"
+# File holding the server's own tables, hidden so globs of the runs do not match it
+STATE_FILE = ".simdash_state.db"
+# Number of threads the files of the runs are read on
+READ_THREADS = 8
+
+# Parsed meta tables of the files of runs, keyed by path, along with the file_signature they were read at
+_FILE_META = {}
+_EXECUTOR = None
+_EXECUTOR_PID = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def is_federated(filename):
+    """
+    Return True if filename is a glob or a directory of database files, rather than a single database.
+    """
+    return glob.has_magic(filename) or (os.path.isdir(filename) and not is_partitioned(filename))
+
+def find_databases(pattern):
+    """
+    Get the paths of the .db files in a directory, or of the files matching a glob, in sorted order.
+    """
+    if os.path.isdir(pattern) and not glob.has_magic(pattern):
+        pattern = os.path.join(pattern, "*.db")
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+def state_file(pattern):
+    """
+    Get the path of the file holding the SERVER_TABLES of a federated database,
+    in the directory of the runs or the deepest directory of the glob without wildcards.
+    """
+    directory = pattern
+    while glob.has_magic(directory):
+        directory = os.path.dirname(directory)
+    return os.path.join(directory or ".", STATE_FILE)
+
+def run_names(paths):
+    """
+    Name the run of every file after the file without its extension,
+    or after its path from the directory holding all of them if two files have the same name.
+
+    Returns:
+        A dict mapping run names to paths, in the order of paths
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if len(set(names)) < len(names):
+        common = os.path.commonpath([os.path.abspath(path) for path in paths])
+        names = [os.path.splitext(os.path.relpath(os.path.abspath(path), common))[0] for path in paths]
+    return dict(zip(names, paths))
+
+def file_signature(path):
+    """
+    Get the sizes and modification times of a database file and its write-ahead log, which change with every write.
+    """
+    signature = ()
+    for name in (path, f"{path}-wal"):
+        try:
+            stat = os.stat(name)
+            signature += (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signature += (None, None)
+    return signature
+
+def get_executor():
+    """
+    Get this process's pool of threads that runs are read on, created on first use.
+
+    Threads are not carried over a fork, so a forked process starts a pool of its own.
+    """
+    global _EXECUTOR, _EXECUTOR_PID
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None or _EXECUTOR_PID != os.getpid():
+            _EXECUTOR = concurrent.futures.ThreadPoolExecutor(READ_THREADS, thread_name_prefix="simdash-read")
+            _EXECUTOR_PID = os.getpid()
+        return _EXECUTOR
+
+class FederatedDatabase(Database):
+    """
+    The database files of many runs read as one Database, see the module docstring.
+
+    The tables of the runs are read-only, the SERVER_TABLES are kept in a state file next to the runs.
+    The files are looked for once, call refresh to pick up new ones on a Database that is kept open.
+
+    Attributes:
+        pattern: the directory or glob of the files of the runs
+    """
+    streams_rows = False
+
+    def __init__(self, pattern, readonly=False, pool_size=None):
+        """
+        Open the state file of a federated database, creating it if needed.
+
+        Args:
+            pattern: a directory, whose .db files are read, or a glob matching the files
+            readonly: use a read-only connection to the state file
+            pool_size: take connections from this process's pools instead of opening them,
+                read-only pools of this size, or the state file's writable one, used by pooled
+        """
+        self.pattern = pattern
+        self.pool_size = pool_size
+        state = state_file(pattern)
+        if not os.path.exists(state):
+            # Made on first use, so that read-only connections can open it
+            Database(state).conn.close()
+        self.pool_ = None
+        if pool_size is not None:
+            self.pool_ = get_pool(state, readonly, pool_size)
+            super().__init__(state, conn=self.pool_.acquire())
+        elif readonly:
+            super().__init__(state, conn=connect(state, readonly=True))
+        else:
+            super().__init__(state)
+        # Databases on the files of the runs, keyed by path
+        self.members_ = {}
+        self.runs_ = None
+
+    def close(self):
+        """
+        Close the files of the runs, giving connections taken from pools back.
+        """
+        for path, member in self.members_.items():
+            if self.pool_size is not None:
+                get_pool(path, True, self.pool_size).release(member.conn)
+            else:
+                member.conn.close()
+        self.members_ = {}
+        if self.pool_ is not None:
+            self.pool_.release(self.conn)
+            self.pool_ = None
+
+    def refresh(self):
+        """
+        Look for the files of the runs again on the next read.
+        """
+        self.runs_ = None
+
+    def runs(self):
+        """
+        Get the files of the runs.
+
+        Returns:
+            A dict mapping run names to paths, in the order of the paths
+        """
+        if self.runs_ is None:
+            self.runs_ = run_names(find_databases(self.pattern))
+        return self.runs_
+
+    def member_db(self, path):
+        """
+        Get a read-only Database on the file of a run, whose connection can be used from any thread.
+        """
+        if path not in self.members_:
+            if self.pool_size is not None:
+                conn = get_pool(path, True, self.pool_size).acquire()
+            else:
+                conn = connect(path, readonly=True, check_same_thread=False)
+            self.members_[path] = Database(path, conn=conn)
+        return self.members_[path]
+
+    def member_meta(self, path):
+        """
+        Get the meta of the file of a run, see Database.get_meta, only opening the file if it changed.
+        """
+        key = os.path.abspath(path)
+        signature = file_signature(path)
+        cached = _FILE_META.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        meta = self.member_db(path).get_meta()
+        _FILE_META[key] = (signature, meta)
+        return meta
+
+    def federated_tables(self):
+        """
+        Get the meta of every federated table along with the runs that have it.
+
+        A table is merged from the runs whose table has the same columns as in the first run that has it,
+        followed by the run column, and keeps the rollups every one of those runs has.
+
+        Returns:
+            A dict mapping table names to tuples of (meta like in get_meta, list of (run, path) tuples)
+        """
+        found = {}
+        for run, path in self.runs().items():
+            for table_name, meta in self.member_meta(path).items():
+                if table_name not in SERVER_TABLES:
+                    found.setdefault(table_name, []).append((run, path, meta))
+        tables = {}
+        for table_name, members in found.items():
+            columns, dtypes, vtypes, l_column, r_column, rollups = members[0][2]
+            members = [(run, path, meta) for run, path, meta in members if meta[0] == columns]
+            rollups = {seconds: names for seconds, names in rollups.items()
+                       if all(meta[5].get(seconds) == names for _, _, meta in members)}
+            run_column = SOURCE_COLUMN if RUN_COLUMN in columns else RUN_COLUMN
+            meta = (columns + [run_column], dtypes + ["TEXT"], vtypes + ["N"], l_column, r_column, rollups)
+            tables[table_name] = (meta, [(run, path) for run, path, _ in members])
+        return tables
+
+    def get_meta(self):
+        """
+        Get the meta of the federated tables and of the SERVER_TABLES, see Database.get_meta.
+        """
+        meta = dict(super().get_meta())
+        for table_name, (table_meta, _) in self.federated_tables().items():
+            meta[table_name] = table_meta
+        return meta
+
+    def get_table(self, table_name):
+        """
+        Get the FederatedTable with the specified name, or the Table of one of the SERVER_TABLES.
+        """
+        if table_name in SERVER_TABLES:
+            return super().get_table(table_name)
+        federated = self.federated_tables().get(table_name)
+        if federated is None:
+            raise ValueError("This table hasn't been made yet. Make this table before getting it")
+        (columns, dtypes, vtypes, _, _, rollups), members = federated
+        tables = [(run, self.member_db(path).get_table(table_name)) for run, path in members]
+        return FederatedTable(table_name, tables, columns, dtypes, vtypes, rollups)
+
+    def change_token(self, table_name):
+        """
+        Get the change token of a table in every run, see Database.change_token.
+
+        Returns:
+            A tuple of (run, (smallest rowid, largest rowid)) tuples
+        """
+        if table_name in SERVER_TABLES:
+            return super().change_token(table_name)
+        _, members = self.federated_tables()[table_name]
+        return tuple((run, self.member_db(path).change_token(table_name)) for run, path in members)
+
+    def make_table(self, table_name, columns, dtypes, vtypes, rollups=None):
+        """
+        Make one of the SERVER_TABLES in the state file, the tables of the runs are read-only.
+        """
+        if table_name not in SERVER_TABLES:
+            raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+        super().make_table(table_name, columns, dtypes, vtypes, rollups)
+
+    def remove_table(self, table_name):
+        """
+        Remove one of the SERVER_TABLES from the state file, the tables of the runs are read-only.
+        """
+        if table_name not in SERVER_TABLES:
+            raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+        super().remove_table(table_name)
+
+    def add_rollup(self, table_name, interval, columns):
+        """
+        Rollups are added to the file of every run, the tables of a federated database are read-only.
+        """
+        raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+
+    def set_retention(self, table_name, max_rows=None, max_age=None, keep_rollups=False):
+        """
+        Retention is set in the file of every run, the tables of a federated database are read-only.
+        """
+        raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+
+    def make_pid_table(self):
+        """
+        The long-format PID table is made in the file of a run, the tables of a federated database are read-only.
+        """
+        raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+
+    def consolidate_pid_tables(self):
+        """
+        PID tables are consolidated in the file of a run, the tables of a federated database are read-only.
+        """
+        raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+
+    def get_pid_table(self):
+        """
+        Get the long-format PID table, which is not federated.
+
+        Returns:
+            None
+        """
+        return None
+
+    def pid_key(self, table_name):
+        """
+        Get the (user, pid) key of a PID chart name in the long-format PID table, which is not federated.
+
+        Returns:
+            None, every PID chart reads a table of its own
+        """
+        return None
+
+class FederatedTable(Table):
+    """
+    The tables with the same name in the files of many runs, read as one Table with a run column.
+
+    Every read runs on the table of every run at the same time, see map_members,
+    and the rows are put together run by run, or in time order when there is a limit.
+    Aggregates and rollups are read from every run and combined.
+    Rowids of different runs can not be compared, so rows_since only takes a logical time.
+    """
+    def __init__(self, table_name, members, columns, dtypes, vtypes, rollups):
+        """
+        Args:
+            table_name: the name of the table
+            members: list of (run, Table) tuples
+            columns, dtypes, vtypes: of the tables of the runs followed by the run column
+            rollups: the rollups every table of the runs has
+        """
+        first = members[0][1]
+        super().__init__(first.filename_, table_name, first.l_column_, first.r_column_, conn=first.conn_,
+                         columns=columns, vtypes=vtypes, dtypes=dtypes, rollups=rollups)
+        self.members_ = members
+        self.run_column_ = columns[-1]
+
+    def map_members(self, func):
+        """
+        Call func(run, Table) for the table of every run on the read threads.
+
+        Returns:
+            The results in the order of the runs
+        """
+        if len(self.members_) == 1:
+            return [func(*self.members_[0])]
+        return list(get_executor().map(lambda member: func(*member), self.members_))
+
+    def split_columns(self, columns):
+        """
+        Get the columns to return and the columns to read from the tables of the runs.
+
+        Returns:
+            A tuple containing (list of columns, list of the columns without the run column)
+        """
+        columns = self.columns if columns is None else list(columns)
+        self.check_columns(columns)
+        return columns, [column for column in columns if column != self.run_column_]
+
+    def append(self, l_time=None, r_time=None, *args, **kwargs):
+        """
+        Rows are appended to the file of a run, the tables of a federated database are read-only.
+        """
+        raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+
+    def extend(self, data, chunk_size=10000):
+        """
+        Rows are appended to the file of a run, the tables of a federated database are read-only.
+        """
+        raise ValueError("Tables of a federated database are read-only, write to the file of a run")
+
+    def len(self):
+        """
+        Get the number of rows of every run.
+
+        Returns:
+            the_length (int): the length of the table
+        """
+        return sum(self.map_members(lambda run, the_tab: the_tab.len()))
+
+    def stats(self):
+        """
+        Combine the statistics of the table of every run, see Table.stats.
+
+        Returns:
+            A dict with the number of rows, the ranges of the time columns and the ranges of the numeric columns
+        """
+        stats = None
+        for part in self.map_members(lambda run, the_tab: the_tab.stats()):
+            if stats is None:
+                stats = part
+                continue
+            stats = {
+                "rows": stats["rows"] + part["rows"],
+                "l_time": _merge_range(stats["l_time"], part["l_time"]),
+                "r_time": _merge_range(stats["r_time"], part["r_time"]),
+                "columns": {column: _merge_range(stats["columns"][column], part["columns"][column])
+                            for column in stats["columns"]},
+            }
+        return stats
+
+    def last_rowid(self):
+        """
+        Rowids of the runs can not be compared, follow federated tables by logical time, see rows_since.
+        """
+        raise ValueError("Rowids of the runs of a federated table can not be compared")
+
+    def rows_since(self, rowid=None, l_time=None):
+        """
+        Get the rows of every run that were added after a logical time.
+
+        Args:
+            rowid: not taken, rowids of the runs can not be compared
+            l_time (float): only return rows with a larger logical time
+        Returns:
+            A tuple containing (pd.DataFrame of the new rows with the run column, 0)
+        """
+        if rowid is not None:
+            raise ValueError("Rows of a federated table are followed by logical time, not by rowid")
+        frames = self.map_members(
+            lambda run, the_tab: the_tab.rows_since(l_time=l_time)[0].assign(**{self.run_column_: run}))
+        return pd.concat(frames, ignore_index=True), 0
+
+    def time_range(self, by="logical"):
+        """
+        Get the smallest and largest time of a time column over every run.
+
+        Returns:
+            A tuple containing (smallest time, largest time), (None, None) if the table is empty
+        """
+        time_range = (None, None)
+        for part in self.map_members(lambda run, the_tab: the_tab.time_range(by)):
+            time_range = _merge_range(time_range, part)
+        return time_range
+
+    def count(self, start=None, end=None, by="logical"):
+        """
+        Count the rows of every run in a time window.
+
+        Without a window this is len().
+        """
+        if start is None and end is None:
+            return self.len()
+        return sum(self.map_members(lambda run, the_tab: the_tab.count(start, end, by)))
+
+    def count_capped(self, cap, start=None, end=None, by="logical"):
+        """
+        Count the rows of every run in a time window, stopping at cap.
+        """
+        return min(cap, sum(self.map_members(lambda run, the_tab: the_tab.count_capped(cap, start, end, by))))
+
+    def count_buckets(self, seconds, cap, start=None, end=None, by="logical"):
+        """
+        Count the buckets of a rollup of every run in a time window, stopping at cap.
+        """
+        return min(cap, sum(self.map_members(
+            lambda run, the_tab: the_tab.count_buckets(seconds, cap, start, end, by))))
+
+    def to_numpy(self, start=None, end=None, columns=None, limit=None, by="logical", datetimes=False):
+        """
+        Read the table of every run into NumPy arrays with the run column, see Table.to_numpy.
+
+        The rows are put together run by run, with a limit the last limit rows in time are kept.
+
+        Returns:
+            A dict mapping column names to np.ndarray
+        """
+        columns, read = self.split_columns(columns)
+        time_column = self.time_column(by)
+        if time_column not in read and (limit is not None or not read):
+            read.append(time_column)
+        parts = self.map_members(lambda run, the_tab: the_tab.to_numpy(start, end, read, limit, by))
+        data = {column: np.concatenate([part[column] for part in parts]) for column in read}
+        data[self.run_column_] = np.concatenate([np.full(len(part[read[0]]), run, dtype=object)
+                                                 for (run, _), part in zip(self.members_, parts)])
+        if limit is not None:
+            # The last limit rows of every run, of which the last limit in time are kept
+            order = np.argsort(data[time_column], kind="stable")
+            order = order[max(len(order) - int(limit), 0):]
+            data = {column: values[order] for column, values in data.items()}
+        data = {column: data[column] for column in columns}
+        if datetimes and self.r_column_ in data:
+            data[self.r_column_] = epoch_to_datetime64(data[self.r_column_])
+        return data
+
+    def iter_chunks(self, chunk_size=100000, start=None, end=None, columns=None, by="logical", numpy=False):
+        """
+        Read the table of every run in chunks with the run column, run by run, see Table.iter_chunks.
+        """
+        columns, read = self.split_columns(columns)
+        read = read or [self.time_column(by)]
+        for run, the_tab in self.members_:
+            for chunk in the_tab.iter_chunks(chunk_size, start, end, read, by, numpy=True):
+                chunk[self.run_column_] = np.full(len(chunk[read[0]]), run, dtype=object)
+                chunk = {column: chunk[column] for column in columns}
+                yield chunk if numpy else pd.DataFrame(chunk)
+
+    def read_rollup(self, seconds, start=None, end=None, columns=None, by="logical", aggregate="mean"):
+        """
+        Read the buckets of a rollup of every run with the run column, see Table.read_rollup.
+
+        Returns:
+            pd.DataFrame of the buckets of every run, run by run
+        """
+        if columns is not None:
+            columns = [column for column in columns if column != self.run_column_]
+        frames = self.map_members(lambda run, the_tab: the_tab.read_rollup(
+            seconds, start, end, columns, by, aggregate).assign(**{self.run_column_: run}))
+        return pd.concat(frames, ignore_index=True)
+
+    def aggregate(self, aggregates, group_by=(), bin_column=None, bin_step=None,
+                  start=None, end=None, limit=None, by="logical"):
+        """
+        Aggregate the table of every run in SQL, then combine the groups, see combine_aggregates.
+
+        The run column can be grouped on, then the groups of every run are kept apart.
+        """
+        if self.run_column_ in aggregates:
+            raise ValueError(f"Column {self.run_column_} can not be aggregated")
+        groups = ([] if bin_column is None else [bin_column]) + [col for col in group_by if col != bin_column]
+        member_group_by = [column for column in group_by if column != self.run_column_]
+        frames = self.map_members(lambda run, the_tab: partial_aggregate(
+            the_tab, aggregates, member_group_by, bin_column, bin_step, start, end, limit, by
+        ).assign(**{self.run_column_: run}))
+        return combine_aggregates(frames, aggregates, groups, limit)
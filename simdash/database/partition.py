@@ -0,0 +1,750 @@
+"""
+Databases split into segment files by time or size.
+
+A database written to for months grows into one file whose indexes no longer fit in memory,
+and which only shrinks by deleting rows one by one.
+A PartitionedDatabase is a directory of segment files, each an ordinary database holding every table,
+and writes go to the newest segment.  A new segment is started once the current one has covered
+a period of real time, such as an hour or a day, or has grown past a size.
+The catalog file in the same directory holds the meta table and, for every finished segment,
+the rows and time bounds of every table, so reads only open the segments overlapping their time window.
+
+PartitionedTables read like Tables by putting together the rows of those segments,
+so charts work on a partitioned database unchanged.  Their rowids are global rowids,
+the segment's number in the high bits, so change tokens and rows_since carry on across segments.
+A partitioned database is written to by a single process, such as the ingest daemon.
+"""
+import glob
+import numbers
+import os
+
+import numpy as np
+import pandas as pd
+
+from .database import SERVER_TABLES, Database
+from .pool import connect, get_pool
+from .table import (Table, _merge_range, _now_timestamp, combine_aggregates, epoch_to_datetime64, parse_interval,
+                    partial_aggregate)
+
+CATALOG = "catalog.db"
+SEGMENT_NAME = "segment_{:06d}.db"
+# Rowids of a segment are below 2**SEGMENT_BITS, the segment number is above
+SEGMENT_BITS = 40
+# Number of writes between checks of the size of the segment being written to
+SIZE_CHECK_WRITES = 1000
+
+def global_rowid(seq, rowid):
+    """
+    Get the rowid of a PartitionedTable out of a segment number and a rowid in that segment.
+    """
+    return (seq << SEGMENT_BITS) | rowid
+
+def split_rowid(rowid):
+    """
+    Get the (segment number, rowid in the segment) tuple of a PartitionedTable rowid.
+    """
+    return rowid >> SEGMENT_BITS, rowid & ((1 << SEGMENT_BITS) - 1)
+
+def is_partitioned(filename):
+    """
+    Return True if filename is the directory of a PartitionedDatabase.
+    """
+    return os.path.isfile(os.path.join(filename, CATALOG))
+
+def segment_size(path):
+    """
+    Get the size of a segment file along with its write-ahead log.
+    """
+    return sum(os.path.getsize(name) for name in (path, f"{path}-wal") if os.path.exists(name))
+
+def create_catalog(curs):
+    """
+    Create the tables of the catalog that list the segments and their bounds.
+    """
+    curs.execute("CREATE TABLE IF NOT EXISTS partitioning(key TEXT PRIMARY KEY, value);")
+    curs.execute("""CREATE TABLE IF NOT EXISTS segments(seq INTEGER PRIMARY KEY, path TEXT,
+                 period INTEGER, sealed INTEGER DEFAULT 0);""")
+    curs.execute("""CREATE TABLE IF NOT EXISTS segment_bounds(seq INTEGER, table_name TEXT, rows INTEGER,
+                 l_min, l_max, r_min, r_max, rowid_min INTEGER, rowid_max INTEGER,
+                 PRIMARY KEY(seq, table_name));""")
+
+class PartitionedDatabase(Database):
+    """
+    A Database whose tables are split into segment files by time or size.
+
+    The catalog connection is this Database's conn, the segments are opened as they are read.
+    Use it like a Database, every table but the SERVER_TABLES is partitioned:
+
+        the_db = PartitionedDatabase("path_to_directory", period="1 day")
+        the_db.make_table("your_table", columns, dtypes, vtypes)
+        the_db.get_table("your_table").append(column1=12)
+
+    Attributes:
+        dirname: the directory of the catalog and the segments
+        period: seconds of real time covered by a segment, None to not roll by time
+        max_bytes: size a segment is finished at, None to not roll by size
+    """
+    def __init__(self, dirname, period=None, max_bytes=None, readonly=False, pool_size=None):
+        """
+        Open the catalog of a partitioned database, creating the directory and the catalog if needed.
+
+        The period and size are kept in the catalog, so they are only given when the database is made
+        or to change them.  Without either a segment covers a day.
+
+        Args:
+            dirname: path to the directory
+            period: real time covered by a segment, seconds or a duration such as '1h' or '1 day'
+            max_bytes: size in bytes a segment is finished at
+            readonly: only read the database, the directory has to exist
+            pool_size: take the catalog connection from this process's pool instead of opening one,
+                a read-only pool of this size or the writable one, used by pooled
+        """
+        self.dirname = dirname
+        self.readonly = readonly
+        self.pool_size = pool_size
+        catalog = os.path.join(dirname, CATALOG)
+        self.pool_ = None
+        if pool_size is not None:
+            self.pool_ = get_pool(catalog, readonly, pool_size)
+            super().__init__(catalog, conn=self.pool_.acquire())
+        elif readonly:
+            super().__init__(catalog, conn=connect(catalog, readonly=True))
+        else:
+            os.makedirs(dirname, exist_ok=True)
+            super().__init__(catalog)
+        if not readonly:
+            with self.conn:
+                curs = self.conn.cursor()
+                create_catalog(curs)
+                settings = dict(curs.execute("SELECT key, value FROM partitioning;").fetchall())
+                if period is not None or max_bytes is not None or not settings:
+                    settings = {"period": None if period is None else parse_interval(period),
+                                "max_bytes": max_bytes}
+                    if period is None and max_bytes is None:
+                        settings["period"] = parse_interval("1 day")
+                    curs.executemany("INSERT OR REPLACE INTO partitioning(key, value) VALUES(?, ?);",
+                                     settings.items())
+        else:
+            settings = dict(self.conn.execute("SELECT key, value FROM partitioning;").fetchall())
+        self.period = settings.get("period")
+        self.max_bytes = settings.get("max_bytes")
+
+        # Open segments, keyed by segment number
+        self.paths_ = {}
+        self.segment_dbs_ = {}
+        # The segment being written to and its Tables
+        self.writer_seq_ = None
+        self.writer_period_ = None
+        self.writer_db_ = None
+        self.writers_ = {}
+        self.writes_ = 0
+
+    def close(self):
+        """
+        Flush the tables written to and close the segments, giving the catalog connection back to its pool.
+        """
+        for the_tab in self.writers_.values():
+            the_tab.flush()
+        for seq in list(self.segment_dbs_):
+            self.close_segment(seq)
+        if self.writer_db_ is not None:
+            self.writer_db_.conn.close()
+        self.segment_dbs_ = {}
+        self.writer_db_ = None
+        self.writer_seq_ = None
+        self.writers_ = {}
+        if self.pool_ is not None:
+            self.pool_.release(self.conn)
+            self.pool_ = None
+
+    def segments(self, table_name=None):
+        """
+        Get the segments in order, along with the bounds of a table in the finished ones.
+
+        Args:
+            table_name: the table whose bounds are returned
+        Returns:
+            A list of (segment number, bounds) tuples, bounds is None for the segment being written to,
+            otherwise a dict of the table's rows and (smallest, largest) tuples of its l_time, r_time and rowids,
+            with no rows if the table was not in the segment
+        """
+        cur = self.conn.execute(
+            "SELECT s.seq, s.path, s.sealed, b.rows, b.l_min, b.l_max, b.r_min, b.r_max, b.rowid_min, b.rowid_max "
+            "FROM segments AS s LEFT JOIN segment_bounds AS b ON b.seq = s.seq AND b.table_name = ? "
+            "ORDER BY s.seq;", (table_name,))
+        segments = []
+        for row in cur:
+            self.paths_[row[0]] = os.path.join(self.dirname, row[1])
+            bounds = None
+            if row[2]:
+                bounds = {"rows": row[3] or 0, "l_time": (row[4], row[5]), "r_time": (row[6], row[7]),
+                          "rowids": (row[8], row[9])}
+            segments.append((row[0], bounds))
+        return segments
+
+    def segment_db(self, seq):
+        """
+        Get a Database on a segment, the writer's for the segment being written to, read-only otherwise.
+        """
+        if seq == self.writer_seq_ and self.writer_db_ is not None:
+            return self.writer_db_
+        if seq not in self.segment_dbs_:
+            if seq not in self.paths_:
+                self.segments()
+            path = self.paths_[seq]
+            if self.pool_size is not None:
+                conn = get_pool(path, True, self.pool_size).acquire()
+            else:
+                conn = connect(path, readonly=True)
+            self.segment_dbs_[seq] = Database(path, conn=conn)
+        return self.segment_dbs_[seq]
+
+    def close_segment(self, seq):
+        """
+        Close the read-only Database on a segment, giving its connection back to its pool.
+        """
+        seg_db = self.segment_dbs_.pop(seq, None)
+        if seg_db is None:
+            return
+        if self.pool_size is not None:
+            get_pool(seg_db.filename, True, self.pool_size).release(seg_db.conn)
+        else:
+            seg_db.conn.close()
+
+    def segment_table(self, seq, table_name):
+        """
+        Get the Table of a segment holding its part of a partitioned table.
+        """
+        return self.segment_db(seq).get_table(table_name)
+
+    def start_segment(self):
+        """
+        Start a new segment holding every partitioned table, finishing the one being written to.
+
+        The new file is made before it is added to the catalog, and the old one is finished
+        in the same transaction, so readers always find every row in exactly one listed segment.
+        """
+        if self.readonly:
+            raise ValueError(f"Partitioned database {self.dirname} is read-only")
+        for the_tab in self.writers_.values():
+            the_tab.flush()
+        self.writers_ = {}
+        seq = (self.conn.execute("SELECT max(seq) FROM segments;").fetchone()[0] or 0) + 1
+        path = SEGMENT_NAME.format(seq)
+        seg_db = Database(os.path.join(self.dirname, path))
+        for table_name, (columns, dtypes, vtypes, _, _, rollups) in self.get_meta().items():
+            if table_name not in SERVER_TABLES:
+                seg_db.make_table(table_name, columns, dtypes, vtypes, rollups=rollups)
+        old_seq, old_db = self.writer_seq_, self.writer_db_
+        bounds = []
+        if old_db is not None:
+            for table_name, meta in old_db.get_meta().items():
+                l_column, r_column = meta[3], meta[4]
+                row = old_db.conn.execute(
+                    f'SELECT count(*), min("{l_column}"), max("{l_column}"), min("{r_column}"), max("{r_column}"), '
+                    f'min(rowid), max(rowid) FROM "{table_name}";').fetchone()
+                bounds.append((old_seq, table_name) + tuple(row))
+        period = None if self.period is None else int(_now_timestamp() // self.period)
+        with self.conn:
+            if old_db is not None:
+                self.conn.executemany("INSERT OR REPLACE INTO segment_bounds VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                                      bounds)
+                self.conn.execute("UPDATE segments SET sealed = 1 WHERE seq = ?;", (old_seq,))
+            self.conn.execute("INSERT INTO segments(seq, path, period) VALUES(?, ?, ?);", (seq, path, period))
+        if old_db is not None:
+            # The finished segment is left as a single file
+            old_db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+            old_db.conn.close()
+        self.paths_[seq] = os.path.join(self.dirname, path)
+        self.writer_seq_, self.writer_period_, self.writer_db_ = seq, period, seg_db
+        self.writes_ = 0
+
+    def open_writer(self):
+        """
+        Open the segment being written to, starting one if there is none or it should be finished.
+        """
+        row = self.conn.execute("SELECT seq, path, period FROM segments WHERE sealed = 0 "
+                                "ORDER BY seq DESC LIMIT 1;").fetchone()
+        if row is None:
+            self.start_segment()
+            return
+        self.writer_seq_, self.writer_period_ = row[0], row[2]
+        self.paths_[row[0]] = os.path.join(self.dirname, row[1])
+        self.writer_db_ = Database(self.paths_[row[0]])
+        self.writes_ = 0
+        self.check_roll()
+
+    def check_roll(self):
+        """
+        Start a new segment if the real time has left the current segment's period,
+        or, every SIZE_CHECK_WRITES writes, if the segment has grown past max_bytes.
+        """
+        if self.writer_db_ is None:
+            self.open_writer()
+            return
+        if self.period is not None and int(_now_timestamp() // self.period) != self.writer_period_:
+            self.start_segment()
+        elif self.max_bytes is not None and self.writes_ % SIZE_CHECK_WRITES == 0 and \
+                segment_size(self.paths_[self.writer_seq_]) >= self.max_bytes:
+            self.start_segment()
+        self.writes_ += 1
+
+    def writer_table(self, table_name):
+        """
+        Get the Table of the segment being written to for a partitioned table, rolling segments first if due.
+
+        The logical time carries on from the finished segments.
+        """
+        self.check_roll()
+        the_tab = self.writers_.get(table_name)
+        if the_tab is None:
+            the_tab = self.writer_db_.get_table(table_name)
+            cur = self.conn.execute("SELECT max(l_max) FROM segment_bounds WHERE table_name = ?;", (table_name,))
+            the_tab.logical_time = max(the_tab.logical_time, float(cur.fetchone()[0] or 0.0))
+            self.writers_[table_name] = the_tab
+        return the_tab
+
+    def make_table(self, table_name, columns, dtypes, vtypes, rollups=None):
+        """
+        Make a Table in the catalog and in the segment being written to, see Database.make_table.
+        """
+        exists = self.check_if_table_exists(table_name)
+        super().make_table(table_name, columns, dtypes, vtypes, rollups=rollups)
+        if exists or table_name in SERVER_TABLES:
+            return
+        if self.writer_db_ is None:
+            self.open_writer()
+        # A segment started by open_writer already has every table of the catalog
+        if not self.writer_db_.check_if_table_exists(table_name):
+            self.writer_db_.make_table(table_name, columns, dtypes, vtypes, rollups=rollups)
+
+    def add_rollup(self, table_name, interval, columns):
+        """
+        Add a rollup to a table in the catalog and in every segment, see Database.add_rollup.
+        """
+        super().add_rollup(table_name, interval, columns)
+        if table_name in SERVER_TABLES:
+            return
+        for seq, _ in self.segments(table_name):
+            if seq == self.writer_seq_ and self.writer_db_ is not None:
+                self.writer_db_.add_rollup(table_name, interval, columns)
+                self.writers_.pop(table_name, None)
+            else:
+                seg_db = Database(self.paths_[seq])
+                if seg_db.check_if_table_exists(table_name):
+                    seg_db.add_rollup(table_name, interval, columns)
+                seg_db.conn.close()
+
+    def get_table(self, table_name):
+        """
+        Get the PartitionedTable with the specified name, or the Table of one of the SERVER_TABLES.
+        """
+        if table_name in SERVER_TABLES:
+            return super().get_table(table_name)
+        meta = self.get_meta().get(table_name)
+        if meta is None:
+            raise ValueError("This table hasn't been made yet. Make this table before getting it")
+        columns, dtypes, vtypes, l_time_, r_time_, rollups = meta
+        return PartitionedTable(self, table_name, str(l_time_), str(r_time_), columns=columns, vtypes=vtypes,
+                                dtypes=dtypes, rollups=rollups)
+
+    def remove_table(self, table_name):
+        """
+        Remove the table from the catalog and every segment.
+        """
+        if table_name not in SERVER_TABLES:
+            self.writers_.pop(table_name, None)
+            for seq, _ in self.segments(table_name):
+                if seq == self.writer_seq_ and self.writer_db_ is not None:
+                    self.writer_db_.remove_table(table_name)
+                else:
+                    self.close_segment(seq)
+                    seg_db = Database(self.paths_[seq])
+                    seg_db.remove_table(table_name)
+                    seg_db.conn.close()
+            with self.conn:
+                self.conn.execute("DELETE FROM segment_bounds WHERE table_name = ?;", (table_name,))
+        super().remove_table(table_name)
+
+    def drop_segments(self, before):
+        """
+        Delete the finished segments whose rows are all older than a real time, a file at a time.
+
+        Args:
+            before: real time, as a timestamp in seconds or anything pd.Timestamp accepts
+        Returns:
+            The numbers of the segments deleted
+        """
+        if not isinstance(before, numbers.Number):
+            before = pd.Timestamp(before).timestamp()
+        cur = self.conn.execute("SELECT s.seq, s.path FROM segments AS s WHERE s.sealed = 1 AND NOT EXISTS "
+                                "(SELECT 1 FROM segment_bounds AS b WHERE b.seq = s.seq AND b.r_max >= ?) "
+                                "ORDER BY s.seq;", (before,))
+        dropped = cur.fetchall()
+        with self.conn:
+            for seq, _ in dropped:
+                self.conn.execute("DELETE FROM segment_bounds WHERE seq = ?;", (seq,))
+                self.conn.execute("DELETE FROM segments WHERE seq = ?;", (seq,))
+        for seq, path in dropped:
+            self.close_segment(seq)
+            if self.pool_size is not None:
+                # Close the idle connections of the pool on the deleted file
+                get_pool(os.path.join(self.dirname, path), True, self.pool_size).close()
+            for name in glob.glob(os.path.join(self.dirname, path) + "*"):
+                os.remove(name)
+        return [seq for seq, _ in dropped]
+
+    def set_retention(self, table_name, max_rows=None, max_age=None, keep_rollups=False):
+        """
+        Partitioned databases drop whole segments instead of pruning rows, see drop_segments.
+        """
+        raise ValueError("Partitioned databases are pruned with drop_segments")
+
+    def change_token(self, table_name):
+        """
+        Get the smallest and largest global rowid of a table, see Database.change_token.
+        """
+        if table_name in SERVER_TABLES:
+            return super().change_token(table_name)
+        first, last = None, None
+        for seq, bounds in self.segments(table_name):
+            if bounds is None:
+                low, high = self.segment_db(seq).change_token(table_name)
+            else:
+                low, high = bounds["rowids"]
+            if low is not None:
+                first = global_rowid(seq, low) if first is None else first
+                last = global_rowid(seq, high)
+        return (first, last)
+
+    def make_pid_table(self):
+        """
+        Partitioned databases do not hold the long-format PID table, PIDs are kept in tables of their own.
+        """
+        raise ValueError("Partitioned databases do not hold the long-format PID table")
+
+    def get_pid_table(self):
+        """
+        Get the long-format PID table, which partitioned databases do not hold.
+
+        Returns:
+            None
+        """
+        return None
+
+    def pid_key(self, table_name):
+        """
+        Get the (user, pid) key of a PID chart name in the long-format PID table, which partitioned databases
+        do not hold.
+
+        Returns:
+            None, every PID chart reads a table of its own
+        """
+        return None
+
+    def consolidate_pid_tables(self):
+        """
+        Partitioned databases do not hold the long-format PID table, PIDs are kept in tables of their own.
+        """
+        raise ValueError("Partitioned databases do not hold the long-format PID table")
+
+class PartitionedTable(Table):
+    """
+    A Table whose rows are split over the segments of a PartitionedDatabase.
+
+    Rows are written to the newest segment.  Reads run on every segment overlapping their time window
+    and are put together in segment order, rowids are global rowids, see global_rowid.
+    Rollups are kept in every segment, a bucket that a new segment starts in the middle of is read as two rows.
+    """
+    def __init__(self, the_db, table_name, l_column, r_column, columns, vtypes, dtypes, rollups):
+        # The catalog holds an empty table with the same columns, which reads with no segments fall back on
+        super().__init__(the_db.filename, table_name, l_column, r_column, conn=the_db.conn, columns=columns,
+                         vtypes=vtypes, dtypes=dtypes, rollups=rollups)
+        self.db_ = the_db
+        self.writer_ = None
+
+    def writer(self):
+        """
+        Get the Table of the segment being written to, in the buffered mode of this table.
+        """
+        the_tab = self.db_.writer_table(self.table_name)
+        if the_tab is not self.writer_:
+            if self.buffer_rows_ is not None:
+                the_tab.buffered(self.buffer_rows_, self.flush_interval_)
+            self.writer_ = the_tab
+        return the_tab
+
+    def buffered(self, max_rows=1000, interval=1.0):
+        """
+        Switch the table to buffered writes, including the Table of the segment being written to, see Table.buffered.
+
+        Returns:
+            self
+        """
+        super().buffered(max_rows, interval)
+        if self.writer_ is not None:
+            self.writer_.buffered(max_rows, interval)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Flush and leave buffered mode, on the Table of the segment being written to as well.
+        """
+        super().__exit__(exc_type, exc_value, traceback)
+        if self.writer_ is not None:
+            self.writer_.__exit__(exc_type, exc_value, traceback)
+
+    def flush(self):
+        """
+        Write the rows buffered by the Table of the segment being written to.
+        """
+        if self.writer_ is not None:
+            self.writer_.flush()
+
+    def flush_each(self):
+        """
+        Write the rows buffered by the Table of the segment being written to one at a time, see Table.flush_each.
+
+        Returns:
+            A list of (row, error) tuples of the rows that were not written
+        """
+        if self.writer_ is None:
+            return []
+        return self.writer_.flush_each()
+
+    def append(self, l_time=None, r_time=None, *args, **kwargs):
+        """
+        Append a row to the segment being written to, see Table.append.
+        """
+        the_tab = self.writer()
+        the_tab.append(l_time, r_time, *args, **kwargs)
+        self.logical_time = the_tab.logical_time
+
+    def extend(self, data, chunk_size=10000):
+        """
+        Append many rows to the segment being written to, see Table.extend.
+
+        Returns:
+            num_rows (int): the number of rows appended
+        """
+        the_tab = self.writer()
+        num_rows = the_tab.extend(data, chunk_size)
+        self.logical_time = the_tab.logical_time
+        return num_rows
+
+    def segment_tables(self, start=None, end=None, by="logical"):
+        """
+        Get the Tables of the segments that may hold rows in a time window, in order.
+
+        Finished segments are chosen by their bounds in the catalog, the segment being written to is always read.
+
+        Returns:
+            A list of (segment number, Table) tuples
+        """
+        key = "l_time" if self.time_column(by) == self.l_column_ else "r_time"
+        start, end = self.to_time_value(start, by), self.to_time_value(end, by)
+        tables = []
+        for seq, bounds in self.db_.segments(self.table_name):
+            if bounds is not None:
+                low, high = bounds[key]
+                if not bounds["rows"] or (start is not None and high < start) or (end is not None and low > end):
+                    continue
+            tables.append((seq, self.db_.segment_table(seq, self.table_name)))
+        return tables
+
+    def len(self):
+        """
+        Get the number of rows in every segment.
+
+        Returns:
+            the_length (int): the length of the table
+        """
+        self.flush()
+        return sum(the_tab.len() for _, the_tab in self.segment_tables())
+
+    def stats(self):
+        """
+        Combine the statistics of every segment, see Table.stats.
+
+        Returns:
+            A dict with the number of rows, the ranges of the time columns and the ranges of the numeric columns
+        """
+        self.flush()
+        stats = None
+        for _, the_tab in self.segment_tables():
+            part = the_tab.stats()
+            if stats is None:
+                stats = part
+                continue
+            stats = {
+                "rows": stats["rows"] + part["rows"],
+                "l_time": _merge_range(stats["l_time"], part["l_time"]),
+                "r_time": _merge_range(stats["r_time"], part["r_time"]),
+                "columns": {column: _merge_range(stats["columns"][column], part["columns"][column])
+                            for column in stats["columns"]},
+            }
+        return super().stats() if stats is None else stats
+
+    def last_rowid(self):
+        """
+        Get the global rowid of the newest row, see global_rowid.
+
+        Returns:
+            rowid (int): the largest global rowid of the table, 0 if the table is empty
+        """
+        self.flush()
+        for seq, the_tab in reversed(self.segment_tables()):
+            rowid = the_tab.last_rowid()
+            if rowid:
+                return global_rowid(seq, rowid)
+        return 0
+
+    def rows_since(self, rowid=None, l_time=None):
+        """
+        Get the rows of every segment that were added after a global rowid or logical time, see Table.rows_since.
+
+        Args:
+            rowid (int): only return rows with a larger global rowid
+            l_time (float): only return rows with a larger logical time
+        Returns:
+            A tuple containing (pd.DataFrame of the new rows, global rowid of the last row)
+        """
+        self.flush()
+        if rowid is not None:
+            first_seq, first_rowid = split_rowid(rowid)
+            tables = [(seq, the_tab) for seq, the_tab in self.segment_tables() if seq >= first_seq]
+        else:
+            tables = self.segment_tables(start=l_time)
+        frames = []
+        last = None
+        for seq, the_tab in tables:
+            if rowid is not None:
+                dframe, seg_rowid = the_tab.rows_since(rowid=first_rowid if seq == first_seq else 0)
+            else:
+                dframe, seg_rowid = the_tab.rows_since(l_time=l_time)
+            if len(dframe.index):
+                frames.append(dframe)
+                last = global_rowid(seq, seg_rowid)
+        if not frames:
+            return super().rows_since(rowid=0)[0], self.last_rowid() if rowid is None else rowid
+        return pd.concat(frames, ignore_index=True), last
+
+    def time_range(self, by="logical"):
+        """
+        Get the smallest and largest time of a time column, from the catalog for the finished segments.
+
+        Returns:
+            A tuple containing (smallest time, largest time), (None, None) if the table is empty
+        """
+        self.flush()
+        key = "l_time" if self.time_column(by) == self.l_column_ else "r_time"
+        time_range = (None, None)
+        for seq, bounds in self.db_.segments(self.table_name):
+            if bounds is None:
+                time_range = _merge_range(time_range, self.db_.segment_table(seq, self.table_name).time_range(by))
+            elif bounds["rows"]:
+                time_range = _merge_range(time_range, bounds[key])
+        return time_range
+
+    def count(self, start=None, end=None, by="logical"):
+        """
+        Count the rows in a time window, in the segments that overlap it.
+
+        Without a window this is len().
+        """
+        if start is None and end is None:
+            return self.len()
+        return sum(the_tab.count(start, end, by) for _, the_tab in self.segment_tables(start, end, by))
+
+    def count_capped(self, cap, start=None, end=None, by="logical"):
+        """
+        Count the rows in a time window, stopping at cap, segment by segment.
+        """
+        total = 0
+        for _, the_tab in self.segment_tables(start, end, by):
+            total += the_tab.count_capped(cap - total, start, end, by)
+            if total >= cap:
+                break
+        return total
+
+    def count_buckets(self, seconds, cap, start=None, end=None, by="logical"):
+        """
+        Count the buckets of a rollup in a time window, stopping at cap, segment by segment.
+        """
+        total = 0
+        for _, the_tab in self.segment_tables(start, end, by):
+            total += the_tab.count_buckets(seconds, cap - total, start, end, by)
+            if total >= cap:
+                break
+        return total
+
+    def to_numpy(self, start=None, end=None, columns=None, limit=None, by="logical", datetimes=False):
+        """
+        Read the segments that overlap a time window into NumPy arrays and put them together, see Table.to_numpy.
+
+        With a limit the newest segments are read first, until there are enough rows.
+
+        Returns:
+            A dict mapping column names to np.ndarray
+        """
+        self.flush()
+        tables = self.segment_tables(start, end, by)
+        parts = []
+        if limit is None:
+            parts = [the_tab.to_numpy(start, end, columns, None, by) for _, the_tab in tables]
+        else:
+            # Newest segments first, until the limit is reached
+            remaining = int(limit)
+            for _, the_tab in reversed(tables):
+                if remaining <= 0:
+                    break
+                part = the_tab.to_numpy(start, end, columns, remaining, by)
+                remaining -= len(next(iter(part.values()), []))
+                parts.insert(0, part)
+        if not parts:
+            return super().to_numpy(start, end, columns, limit, by, datetimes)
+        data = {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+        if datetimes and self.r_column_ in data:
+            data[self.r_column_] = epoch_to_datetime64(data[self.r_column_])
+        return data
+
+    def iter_chunks(self, chunk_size=100000, start=None, end=None, columns=None, by="logical", numpy=False):
+        """
+        Read the rows of a time window in chunks, segment by segment, see Table.iter_chunks.
+
+        A chunk never spans two segments, so chunks at the end of a segment may be smaller.
+        """
+        self.flush()
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        for _, the_tab in self.segment_tables(start, end, by):
+            yield from the_tab.iter_chunks(chunk_size, start, end, columns, by, numpy)
+
+    def read_rollup(self, seconds, start=None, end=None, columns=None, by="logical", aggregate="mean"):
+        """
+        Read the buckets of a rollup from every segment that overlaps a time window, see Table.read_rollup.
+
+        Returns:
+            pd.DataFrame of the buckets, a bucket that a new segment starts in the middle of is two rows
+        """
+        self.flush()
+        frames = [the_tab.read_rollup(seconds, start, end, columns, by, aggregate)
+                  for _, the_tab in self.segment_tables(start, end, by)]
+        frames = [dframe for dframe in frames if len(dframe.index)]
+        if not frames:
+            return super().read_rollup(seconds, start, end, columns, by, aggregate)
+        return pd.concat(frames, ignore_index=True)
+
+    def aggregate(self, aggregates, group_by=(), bin_column=None, bin_step=None,
+                  start=None, end=None, limit=None, by="logical"):
+        """
+        Aggregate every segment in SQL, then combine the groups found in several segments, see combine_aggregates.
+        """
+        self.flush()
+        tables = self.segment_tables(start, end, by)
+        if not tables:
+            return super().aggregate(aggregates, group_by, bin_column, bin_step, start, end, limit, by)
+        groups = ([] if bin_column is None else [bin_column]) + [col for col in group_by if col != bin_column]
+        frames = [partial_aggregate(the_tab, aggregates, group_by, bin_column, bin_step, start, end, limit, by)
+                  for _, the_tab in tables]
+        return combine_aggregates(frames, aggregates, groups, limit)
@@ -0,0 +1,197 @@
+"""
+Long-format storage of the usage of every PID in a single table.
+
+getpid writes one table per PID, named after the user and the PID like rootpid1234,
+so a page of PID charts runs one query per PID and the database grows a table, and two indexes, per process.
+A PidTable holds the rows of every PID in one table keyed by (user, pid, time),
+whose composite indexes let many PIDs be read in one query.
+PID charts keep their {user}pid{pid} names, which are looked up in the long table when no such table exists.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+from .. import metrics
+from .table import Table, numpy_dtype, read_columns
+
+PID_TABLE = "pid_usage"
+PID_COLUMNS = ["logic_time", "real_time", "user", "pid", "cpu_percent", "mem_percent"]
+PID_DTYPES = ["FLOAT", "INT", "TEXT", "INT", "FLOAT", "FLOAT"]
+PID_VTYPES = ["Q", "T", "N", "O", "Q", "Q"]
+# Columns of the charts, the same as the columns of a per-PID table
+USAGE_COLUMNS = ["logic_time", "real_time", "cpu_percent", "mem_percent"]
+PID_NAME = re.compile(r"^(.+)pid(\d+)$")
+
+def pid_table_name(user, pid):
+    """
+    Get the name getpid gives the table of a PID, which is also the name of its chart.
+    """
+    return f"{user}pid{pid}"
+
+def parse_pid_table_name(table_name):
+    """
+    Get the (user, pid) key out of a PID table name.
+
+    Returns:
+        A tuple containing (user, pid), None if table_name is not a PID table name
+    """
+    match = PID_NAME.match(table_name)
+    if match is None:
+        return None
+    return (match.group(1), int(match.group(2)))
+
+def create_pid_indexes(curs):
+    """
+    Create the composite indexes of the long-format PID table.
+
+    SQLite ends every index with the rowid, so (user, pid) also serves rowid ranges of one PID.
+    """
+    curs.execute(f'CREATE INDEX IF NOT EXISTS "{PID_TABLE}__user_pid" ON "{PID_TABLE}"("user", "pid");')
+    curs.execute(f'CREATE INDEX IF NOT EXISTS "{PID_TABLE}__user_pid_real_time" '
+                 f'ON "{PID_TABLE}"("user", "pid", "real_time");')
+
+class PidTable(Table):
+    """
+    The long-format table holding the usage of every PID, keyed by (user, pid, time).
+
+    Rows are appended like in any Table, with the user and pid columns set:
+
+        pid_tab.append(user="root", pid=1234, cpu_percent=12.5, mem_percent=3.0)
+
+    The logical time counts up over the rows of every PID.
+    """
+    def __init__(self, filename, conn=None, columns=None, vtypes=None, dtypes=None, rollups=None):
+        super().__init__(filename, PID_TABLE, PID_COLUMNS[0], PID_COLUMNS[1], conn=conn, columns=columns,
+                         vtypes=vtypes, dtypes=dtypes, rollups=rollups)
+
+    def keys(self):
+        """
+        Get the (user, pid) of every PID in the table, read from the composite index.
+        """
+        self.flush()
+        cur = self.conn_.execute(f'SELECT DISTINCT "user", "pid" FROM "{PID_TABLE}" ORDER BY "user", "pid";')
+        return [tuple(row) for row in cur]
+
+    def has_pid(self, key):
+        """
+        Return True if the table holds rows of the (user, pid) key.
+        """
+        self.flush()
+        cur = self.conn_.execute(f'SELECT 1 FROM "{PID_TABLE}" WHERE "user" = ? AND "pid" = ? LIMIT 1;', key)
+        return cur.fetchone() is not None
+
+    def change_tokens(self, keys):
+        """
+        Get the change token of several PIDs in one query, like Database.change_token for a table.
+
+        Args:
+            keys: iterable of (user, pid) tuples
+        Returns:
+            A dict mapping every key to a tuple containing (smallest rowid, largest rowid),
+            both None for PIDs without rows
+        """
+        self.flush()
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        # Correlated subqueries, so both ends of every PID's range are read from the (user, pid) index
+        cur = self.conn_.execute(
+            f'SELECT keys.column1, keys.column2, '
+            f'(SELECT min(rowid) FROM "{PID_TABLE}" WHERE "user" = keys.column1 AND "pid" = keys.column2), '
+            f'(SELECT max(rowid) FROM "{PID_TABLE}" WHERE "user" = keys.column1 AND "pid" = keys.column2) '
+            f'FROM ({self.values_sql(keys)}) AS keys;', [value for key in keys for value in key])
+        return {(row[0], row[1]): (row[2], row[3]) for row in cur}
+
+    @staticmethod
+    def values_sql(keys):
+        """
+        Get a VALUES list with a (user, pid) row of parameters per key.
+        """
+        return "VALUES " + ", ".join(["(?, ?)"] * len(keys))
+
+    def read_pids(self, keys, start=None, end=None, by="real", columns=None):
+        """
+        Read the rows of several PIDs in one query, in time order.
+
+        The keys are joined to the table so every PID is a range of the (user, pid, real_time) index.
+
+        Args:
+            keys: iterable of (user, pid) tuples
+            start, end, by: only read the rows in this time window, like in Table.to_pandas
+            columns: list of columns to read, defaults to USAGE_COLUMNS
+        Returns:
+            A dict mapping every key to a pandas DataFrame, empty for PIDs without rows
+        """
+        self.flush()
+        keys = list(dict.fromkeys(keys))
+        columns = USAGE_COLUMNS if columns is None else columns
+        self.check_columns(columns)
+        frames = {key: pd.DataFrame({column: [] for column in columns}) for key in keys}
+        if not keys:
+            return frames
+
+        time_column = self.time_column(by)
+        params = [value for key in keys for value in key]
+        where = ""
+        if start is not None:
+            where += f' AND p."{time_column}" >= ?'
+            params.append(self.to_time_value(start, by))
+        if end is not None:
+            where += f' AND p."{time_column}" <= ?'
+            params.append(self.to_time_value(end, by))
+        selected = ", ".join(f'p."{column}"' for column in ["user", "pid"] + columns)
+        query = (f'SELECT {selected} FROM ({self.values_sql(keys)}) AS keys JOIN "{PID_TABLE}" AS p '
+                 f'ON p."user" = keys.column1 AND p."pid" = keys.column2{where} '
+                 f'ORDER BY p."user", p."pid", p."{time_column}", p.rowid;')
+        dtypes = [np.dtype(object), np.dtype(np.int64)]
+        dtypes += [numpy_dtype(self.dtypes[self.columns.index(column)]) for column in columns]
+        with metrics.timed("sql"):
+            try:
+                arrays = read_columns(self.conn_.execute(query, params), dtypes)
+            except ValueError:
+                # A value that does not match its declared type, let pandas work the columns out
+                dframe = pd.read_sql(query, self.conn_, params=tuple(params))
+                arrays = [dframe.iloc[:, i].to_numpy() for i in range(len(dframe.columns))]
+        metrics.inc("simdash_sql_rows_total", len(arrays[0]))
+        if len(arrays[0]) == 0:
+            return frames
+
+        # Rows come grouped by key, split them where the key changes
+        users, pids = arrays[0], arrays[1].astype(np.int64)
+        bounds = np.flatnonzero((users[1:] != users[:-1]) | (pids[1:] != pids[:-1])) + 1
+        for begin, stop in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(users)]))):
+            key = (users[begin], int(pids[begin]))
+            frames[key] = pd.DataFrame({column: values[begin:stop] for column, values in zip(columns, arrays[2:])})
+        return frames
+
+    def rows_since_pid(self, key, rowid=None, l_time=None):
+        """
+        Get the rows of one PID added after a given rowid or logical time, like Table.rows_since.
+
+        Args:
+            key: tuple containing (user, pid)
+            rowid (int): only return rows with a larger rowid
+            l_time (float): only return rows with a larger logical time
+        Returns:
+            A tuple containing (pd.DataFrame of the new rows with USAGE_COLUMNS, largest rowid seen)
+        """
+        self.flush()
+        selected = ", ".join(f'"{column}"' for column in USAGE_COLUMNS)
+        query = f'SELECT rowid AS rowid_, {selected} FROM "{PID_TABLE}" WHERE "user" = ? AND "pid" = ?'
+        params = list(key)
+        if rowid is not None:
+            query += " AND rowid > ?"
+            params.append(rowid)
+        elif l_time is not None:
+            query += f' AND "{self.l_column_}" > ?'
+            params.append(l_time)
+        with metrics.timed("sql"):
+            dframe = pd.read_sql(query + " ORDER BY rowid;", self.conn_, params=tuple(params))
+        metrics.inc("simdash_sql_rows_total", len(dframe.index))
+        rowids = dframe.pop("rowid_")
+        if len(rowids):
+            rowid = int(rowids.iloc[-1])
+        elif rowid is None:
+            rowid = self.change_tokens([key])[key][1] or 0
+        return dframe, rowid
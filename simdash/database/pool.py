@@ -0,0 +1,159 @@
+"""
+Shared SQLite connections.
+
+Opening a connection and setting it up costs more than most of the queries the server runs,
+so connections are kept in per-process pools, one pool per database file and access mode.
+Read-only pools hold several connections that threads take turns on,
+a writable pool holds a single connection since SQLite only allows one writer at a time.
+"""
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+
+# Number of prepared statements kept by every connection
+CACHED_STATEMENTS = 256
+# Seconds a connection waits for a lock held by another connection
+BUSY_TIMEOUT = 30.0
+# Bytes the write-ahead log is truncated to after a checkpoint, so it does not stay at its largest size
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+def connect(filename, readonly=False, check_same_thread=True):
+    """
+    Open a connection to a database file with SimDash's settings.
+
+    Args:
+        filename: path to the database file
+        readonly: open the file read-only, the file has to exist
+        check_same_thread: passed on to sqlite3.connect,
+            pooled connections are shared between threads and set this to False
+    Returns:
+        sqlite3.Connection
+    """
+    if readonly:
+        uri = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(filename))
+        conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread,
+                               cached_statements=CACHED_STATEMENTS)
+    else:
+        conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread,
+                               cached_statements=CACHED_STATEMENTS)
+        # Only takes effect on a new file, pages freed by pruning can then be given back, see retention
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        conn.execute("PRAGMA journal_mode=wal;")
+        conn.execute(f"PRAGMA journal_size_limit = {JOURNAL_SIZE_LIMIT};")
+    return conn
+
+def file_identity(filename):
+    """
+    Get what tells a database file from one made again with the same name, such as after it was deleted,
+    for caches of what the file holds, which also check PRAGMA schema_version.
+
+    Returns:
+        A tuple of the device, inode and change time of the file, None if the file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_ctime_ns)
+
+class ConnectionPool:
+    """
+    A thread-safe pool of connections to one database file.
+
+    Attributes:
+        filename: path to the database file
+        readonly: whether the connections are read-only
+        size: the largest number of open connections
+    """
+    def __init__(self, filename, readonly=True, size=8):
+        self.filename = filename
+        self.readonly = readonly
+        self.size = size if readonly else 1
+        self.idle_ = queue.LifoQueue()
+        self.opened_ = 0
+        self.lock_ = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Take a connection from the pool, opening one if none is idle and the pool is not full.
+
+        Args:
+            timeout: seconds to wait for a connection when the pool is full, None waits forever
+        Returns:
+            sqlite3.Connection, to be given back with release
+        """
+        try:
+            return self.idle_.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock_:
+            if self.opened_ < self.size:
+                self.opened_ += 1
+                try:
+                    return connect(self.filename, self.readonly, check_same_thread=False)
+                except sqlite3.Error:
+                    self.opened_ -= 1
+                    raise
+        return self.idle_.get(timeout=timeout)
+
+    def release(self, conn):
+        """
+        Give a connection back to the pool.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle_.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager that lends a connection from the pool.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Close the idle connections of the pool.
+        """
+        while True:
+            try:
+                conn = self.idle_.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock_:
+                self.opened_ -= 1
+            conn.close()
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_POOLS_PID = os.getpid()
+
+def get_pool(filename, readonly=True, size=8):
+    """
+    Get the pool of this process for a database file, creating it on first use.
+
+    Connections can not be carried over a fork, so a forked process starts with no pools.
+
+    Args:
+        filename: path to the database file
+        readonly: whether to get the read-only or the writable pool
+        size: largest number of connections of a new read-only pool
+    Returns:
+        ConnectionPool
+    """
+    global _POOLS_PID
+    key = (os.path.abspath(filename), readonly)
+    with _POOLS_LOCK:
+        if _POOLS_PID != os.getpid():
+            _POOLS.clear()
+            _POOLS_PID = os.getpid()
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(filename, readonly, size)
+        return _POOLS[key]
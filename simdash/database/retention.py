@@ -0,0 +1,165 @@
+"""
+Pruning of the rows tables no longer keep, following the retention policies set by Database.set_retention.
+
+Rows are deleted in small batches, each in a transaction of its own,
+so readers and writers of the database only ever wait for one batch.
+Pages freed by the deleted rows are reused by new rows, and given back to the file system
+by incremental vacuum in databases made with auto_vacuum, which connect turns on for new files.
+The write-ahead log is checkpointed after pruning so it does not grow with the deletes.
+"""
+import threading
+import time
+
+import logbook
+
+from .database import get_database
+from .table import _now_timestamp, rollup_table_name
+
+log = logbook.Logger(__name__)
+
+# Number of rows deleted, or pages vacuumed, per transaction
+BATCH_SIZE = 1000
+# Seconds slept between batches, letting other connections take the write lock
+PAUSE = 0.05
+
+def delete_batches(conn, table_name, select_sql, params, limit=None, batch_size=BATCH_SIZE, pause=PAUSE):
+    """
+    Delete the rows a query selects, batch_size rows per transaction.
+
+    Args:
+        conn: writable connection
+        table_name: table to delete from
+        select_sql: query selecting the rowids to delete, oldest first
+        params: parameters of the query
+        limit: largest number of rows deleted, None for every row selected
+    Returns:
+        The number of rows deleted
+    """
+    deleted = 0
+    while limit is None or deleted < limit:
+        size = batch_size if limit is None else min(batch_size, limit - deleted)
+        with conn:
+            cur = conn.execute(f'DELETE FROM "{table_name}" WHERE rowid IN ({select_sql} LIMIT ?);',
+                               list(params) + [size])
+        deleted += cur.rowcount
+        if cur.rowcount < size:
+            break
+        time.sleep(pause)
+    return deleted
+
+def prune_table(the_db, table_name, now=None, batch_size=BATCH_SIZE, pause=PAUSE):
+    """
+    Delete the rows of a table that its retention policy does not keep, oldest first.
+
+    Args:
+        the_db: writable Database
+        table_name: name of the table
+        now: current real time in seconds, as stored in the real time column, defaults to the current time
+    Returns:
+        The number of rows deleted
+    """
+    retention = the_db.get_retention(table_name)
+    if not retention:
+        return 0
+    _, _, _, _, r_column, rollups = the_db.get_meta()[table_name]
+    conn = the_db.conn
+    deleted = 0
+    if "max_age" in retention:
+        cutoff = (_now_timestamp() if now is None else now) - retention["max_age"]
+        deleted += delete_batches(conn, table_name, f'SELECT rowid FROM "{table_name}" WHERE "{r_column}" < ?',
+                                  [cutoff], batch_size=batch_size, pause=pause)
+    if "max_rows" in retention:
+        excess = conn.execute(f'SELECT count(*) FROM "{table_name}";').fetchone()[0] - retention["max_rows"]
+        if excess > 0:
+            deleted += delete_batches(conn, table_name, f'SELECT rowid FROM "{table_name}" ORDER BY rowid', [],
+                                      limit=excess, batch_size=batch_size, pause=pause)
+    if deleted and not retention.get("keep_rollups"):
+        oldest = conn.execute(f'SELECT min("{r_column}") FROM "{table_name}";').fetchone()[0]
+        for seconds in rollups:
+            rollup_name = rollup_table_name(table_name, seconds)
+            if oldest is None:
+                select_sql, params = f'SELECT rowid FROM "{rollup_name}"', []
+            else:
+                select_sql, params = f'SELECT rowid FROM "{rollup_name}" WHERE "bucket" + {seconds} <= ?', [oldest]
+            delete_batches(conn, rollup_name, select_sql, params, batch_size=batch_size, pause=pause)
+    return deleted
+
+def vacuum(the_db, batch_size=BATCH_SIZE, pause=PAUSE):
+    """
+    Give the free pages of a database made with auto_vacuum back to the file system, batch_size pages at a time,
+    and checkpoint the write-ahead log.
+    """
+    conn = the_db.conn
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+        while conn.execute("PRAGMA freelist_count;").fetchone()[0] > 0:
+            with conn:
+                conn.execute(f"PRAGMA incremental_vacuum({batch_size});").fetchall()
+            time.sleep(pause)
+    # A passive checkpoint does not wait for readers, the log is truncated to journal_size_limit
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchall()
+
+def prune_database(the_db, now=None, batch_size=BATCH_SIZE, pause=PAUSE):
+    """
+    Prune every table with a retention policy, then vacuum the freed pages.
+
+    Returns:
+        A dict mapping the names of the tables rows were deleted from to the number of rows deleted
+    """
+    pruned = {}
+    for table_name in the_db.get_table_list():
+        deleted = prune_table(the_db, table_name, now, batch_size, pause)
+        if deleted:
+            pruned[table_name] = deleted
+    if pruned:
+        vacuum(the_db, batch_size, pause)
+    return pruned
+
+class Pruner:
+    """
+    Prunes a database every interval seconds on a background thread, with a connection of its own.
+    """
+    def __init__(self, filename, interval=60.0, batch_size=BATCH_SIZE, pause=PAUSE):
+        self.filename = filename
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stop_ = threading.Event()
+        self.thread_ = None
+
+    def start(self):
+        """
+        Start pruning in the background.
+
+        Returns:
+            self
+        """
+        self.stop_.clear()
+        self.thread_ = threading.Thread(target=self.run, daemon=True, name="simdash-pruner")
+        self.thread_.start()
+        return self
+
+    def run(self):
+        """
+        Prune until stop is called, errors are logged and retried at the next interval.
+        """
+        the_db = get_database(self.filename)
+        try:
+            while True:
+                try:
+                    for table_name, deleted in prune_database(the_db, batch_size=self.batch_size,
+                                                              pause=self.pause).items():
+                        log.info(f"Pruned {deleted} rows of {table_name}")
+                except Exception as err: # pylint: disable=broad-except
+                    log.error(f"Could not prune {self.filename}: {err!r}")
+                if self.stop_.wait(self.interval):
+                    return
+        finally:
+            the_db.conn.close()
+
+    def stop(self, timeout=None):
+        """
+        Stop pruning, waiting for the batch being deleted.
+        """
+        self.stop_.set()
+        if self.thread_ is not None:
+            self.thread_.join(timeout)
@@ -6,9 +6,175 @@ It is the data structure used to store changing values.
 """
 
 import json
+import numbers
+import os
 import sqlite3
+import time
+
+import dateutil.tz
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from .. import metrics
+from .pool import connect, file_identity
+
+# Aggregate functions of Table.aggregate and the SQL they run
+AGGREGATES = {"mean": "avg", "sum": "sum", "min": "min", "max": "max", "count": "count"}
+# Statistics of every table keyed by path and table name, along with the pool.file_identity and
+# PRAGMA schema_version they were read at, kept between Table objects so they are only extended with new rows
+_STATS_CACHE = {}
+
+def _now_timestamp():
+    """
+    Return the current local wall clock time in seconds.
+
+    This is the same value as pd.Timestamp("now").timestamp(),
+    without paying for a Timestamp object on every row.
+    """
+    now = time.time()
+    return now + time.localtime(now).tm_gmtoff
+
+
+def epoch_to_datetime64(seconds):
+    """
+    Convert timestamps in seconds to local datetimes, like datetime.fromtimestamp but for a whole array.
+
+    Args:
+        seconds: array of timestamps in seconds, NaN for missing times
+    Returns:
+        np.ndarray of datetime64[us], NaT for missing times
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    missing = np.isnan(seconds)
+    micros = np.round(np.where(missing, 0.0, seconds) * 1e6).astype(np.int64)
+    # The zone file of the local time zone lets pandas convert every time at once
+    zone = dateutil.tz.gettz() or dateutil.tz.tzlocal()
+    times = pd.DatetimeIndex(micros.astype("datetime64[us]")).tz_localize("UTC")
+    values = times.tz_convert(zone).tz_localize(None).to_numpy().astype("datetime64[us]")
+    values[missing] = np.datetime64("NaT")
+    return values
+
+
+def numpy_dtype(dtype):
+    """
+    Get the NumPy dtype a column of an SQLite declared type is read into, following SQLite's type affinity.
+    """
+    dtype = str(dtype).upper()
+    if "INT" in dtype:
+        return np.dtype(np.int64)
+    if any(name in dtype for name in ("REAL", "FLOA", "DOUB")):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def read_columns(rows, dtypes):
+    """
+    Fill one NumPy array per column straight from an iterable of rows, such as a cursor.
+
+    Integer columns are read as floats so missing values become NaN,
+    they are only made integer if every value is a whole number.
+
+    Args:
+        rows: iterable of row tuples
+        dtypes: list of the NumPy dtypes of the columns, from numpy_dtype
+    Returns:
+        A list of np.ndarray, one per column
+    Raises:
+        ValueError if a value can not be stored in its column's dtype
+    """
+    read_as = [np.dtype(np.float64) if dtype.kind == "i" else dtype for dtype in dtypes]
+    records = np.fromiter(rows, dtype=np.dtype([(f"f{i}", dtype) for i, dtype in enumerate(read_as)]))
+    arrays = []
+    for i, dtype in enumerate(dtypes):
+        values = np.ascontiguousarray(records[f"f{i}"])
+        if dtype.kind == "i" and np.all(np.isfinite(values)) and np.all(values == np.round(values)):
+            values = values.astype(np.int64)
+        arrays.append(values)
+    return arrays
+
+
+def parse_interval(value):
+    """
+    Get a number of seconds out of a number or a duration such as '1min' or '2 hours'.
+    """
+    if isinstance(value, numbers.Number):
+        return float(value)
+    return pd.Timedelta(value).total_seconds()
+
+
+def rollup_table_name(table_name, seconds):
+    """
+    Get the name of the table holding a rollup of a table, see Database.add_rollup.
+    """
+    return f"{table_name}__rollup_{int(seconds)}"
+
+
+def partial_aggregate(the_tab, aggregates, group_by=(), bin_column=None, bin_step=None,
+                      start=None, end=None, limit=None, by="logical"):
+    """
+    Aggregate a table into a part that combine_aggregates puts together with the parts of other tables.
+
+    Arguments are the same as in Table.aggregate.
+    Means are read as sums, along with the counts they are divided by in {column}__count columns.
+    The last limit groups of a table hold every one of the last limit groups of all the tables it has a part of,
+    so the limit is applied to every part as well.
+    """
+    sums = {column: "sum" if func == "mean" else func for column, func in aggregates.items()}
+    means = {column: "count" for column, func in aggregates.items() if func == "mean"}
+    dframe = the_tab.aggregate(sums, group_by, bin_column, bin_step, start, end, limit, by)
+    if means:
+        counts = the_tab.aggregate(means, group_by, bin_column, bin_step, start, end, limit, by)
+        for column in means:
+            dframe[f"{column}__count"] = counts[column].to_numpy()
+    return dframe
+
+
+def combine_aggregates(frames, aggregates, groups, limit=None):
+    """
+    Combine the parts made by partial_aggregate into the groups Table.aggregate would give for all their rows.
+
+    Sums and counts are added up, and means are the sum of the sums over the sum of the counts.
+
+    Args:
+        frames: list of DataFrames made by partial_aggregate
+        aggregates: dict mapping columns to one of the functions in AGGREGATES
+        groups: list of the group columns, the bin column first
+        limit (int): only return the last limit groups
+    Returns:
+        A pd.DataFrame like the one of Table.aggregate
+    """
+    dframe = pd.concat(frames, ignore_index=True)
+    if groups:
+        grouped = dframe.groupby(groups, sort=True, dropna=False)
+    else:
+        grouped = dframe.groupby(np.zeros(len(dframe.index)))
+    combined = {}
+    for column, func in aggregates.items():
+        if func in ("min", "max"):
+            combined[column] = getattr(grouped[column], func)()
+        elif func == "mean":
+            combined[column] = grouped[column].sum(min_count=1) / grouped[f"{column}__count"].sum()
+        else:
+            combined[column] = grouped[column].sum(min_count=1 if func == "sum" else 0)
+    dframe = pd.DataFrame(combined).reset_index(drop=not groups)
+    if groups and limit is not None:
+        dframe = dframe.iloc[-int(limit):].reset_index(drop=True)
+    return dframe
+
+
+def _merge_range(old, new):
+    """
+    Combine two (smallest, largest) tuples whose values may be None.
+    """
+    lows = [value for value in (old[0], new[0]) if value is not None]
+    highs = [value for value in (old[1], new[1]) if value is not None]
+    return (min(lows) if lows else None, max(highs) if highs else None)
+
 
 class Table:
     """
@@ -20,22 +186,39 @@ class Table:
     Attributes:
         table_name: the name of the table
         columns: list of data columns
+        dtypes: list of the SQLite types of the columns
+        vtypes: list of the Vega-Lite types of the columns
+        rollups: dict mapping the bucket seconds of every rollup of the table to its columns
     """
-    def __init__(self, filename, table_name, l_column, r_column):
+    # Column telling apart the rows of different runs, drawn as separate series, see federation.FederatedTable
+    run_column_ = None
+
+    def __init__(self, filename, table_name, l_column, r_column, conn=None, columns=None, vtypes=None,
+                 dtypes=None, rollups=None):
+        self.filename_ = filename
         self.table_name = table_name
         self.l_column_ = l_column
         self.r_column_ = r_column
 
-        self.conn_ = sqlite3.connect(filename)
-        self.conn_.execute("PRAGMA journal_mode=wal")
+        if conn is None:
+            conn = connect(filename)
+        self.conn_ = conn
 
-        # Load the column names
-        with self.conn_:
-            sql = f"SELECT columns from meta_table where table_name = ?;"
-            cur = self.conn_.execute(sql, (self.table_name,))
-            columns = cur.fetchone()[0]
-            columns = json.loads(columns)
-            self.columns = columns
+        # Load the column names and types
+        if columns is None or vtypes is None or dtypes is None or rollups is None:
+            with self.conn_:
+                sql = f"SELECT columns, vtypes, dtypes, rollups from meta_table where table_name = ?;"
+                cur = self.conn_.execute(sql, (self.table_name,))
+                row = cur.fetchone()
+                columns = json.loads(row[0]) if columns is None else columns
+                vtypes = json.loads(row[1]) if vtypes is None else vtypes
+                dtypes = json.loads(row[2]) if dtypes is None else dtypes
+                if rollups is None:
+                    rollups = {int(seconds): names for seconds, names in json.loads(row[3] or "{}").items()}
+        self.columns = columns
+        self.vtypes = vtypes
+        self.dtypes = dtypes
+        self.rollups = rollups
 
         # Load the max logical time
         with self.conn_:
@@ -53,6 +236,82 @@ class Table:
         sql = sql % (",".join(["?"] * len(self.columns)))
         self.insert_sql_ = sql
 
+        # Write buffer, only used in buffered mode
+        self.buffer_ = []
+        self.buffer_rows_ = None
+        self.flush_interval_ = None
+        self.last_flush_ = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        self.buffer_rows_ = None
+        self.flush_interval_ = None
+
+    def buffered(self, max_rows=1000, interval=1.0):
+        """
+        Switch the table to buffered writes.
+
+        Appended rows are kept in memory and written with a single executemany
+        once max_rows rows are pending or interval seconds have passed since the last flush.
+        The interval is checked on append; call flush() to force pending rows to disk.
+        Using the table as a context manager flushes and leaves buffered mode on exit:
+
+            with table.buffered(max_rows=5000, interval=2.0):
+                for ...:
+                    table.append(...)
+
+        Args:
+            max_rows (int): flush when this many rows are pending
+            interval (float): flush when this many seconds have passed since the last flush,
+                None disables timed flushes
+        Returns:
+            self
+        """
+        if max_rows < 1:
+            raise ValueError("max_rows must be at least 1")
+        self.buffer_rows_ = max_rows
+        self.flush_interval_ = interval
+        self.last_flush_ = time.monotonic()
+        return self
+
+    def flush(self):
+        """
+        Write all pending buffered rows to the database in one transaction.
+        """
+        self.last_flush_ = time.monotonic()
+        if not self.buffer_:
+            return
+        with self.conn_:
+            self.conn_.executemany(self.insert_sql_, self.buffer_)
+        # Rows that could not be written stay buffered
+        self.buffer_ = []
+
+    def flush_each(self):
+        """
+        Write the pending buffered rows one at a time in one transaction, leaving out the rows that fail,
+        such as after flush raised sqlite3.Error for a batch holding a value SQLite can not bind.
+
+        Returns:
+            A list of (row, error) tuples of the rows that were not written
+        """
+        self.last_flush_ = time.monotonic()
+        failed = []
+        rows, self.buffer_ = self.buffer_, []
+        try:
+            with self.conn_:
+                for row in rows:
+                    try:
+                        self.conn_.execute(self.insert_sql_, row)
+                    except sqlite3.Error as err:
+                        failed.append((row, err))
+        except sqlite3.Error as err:
+            # The transaction was rolled back, none of the rows were written
+            failed = [(row, err) for row in rows]
+        return failed
+
     def append(self, l_time=None, r_time=None, *args, **kwargs):
         """
         Append a row of values to the table.
@@ -68,6 +327,7 @@ class Table:
                 logical time (starts at 0.0)
             r_time (int): the real time of the data point that is being uploaded,
                 if not specified: this defaults to the pandas.Timestamp("now").timestamp()
+                of the moment append is called, even in buffered mode
             **kwargs: in the form of column_name=value, allows input into the table in any
                 order as long as the column is specified
         """
@@ -91,10 +351,11 @@ class Table:
         if r_time is None:
             r_time = kwargs.get(self.r_column_, None)
         if r_time is None:
-            r_time = pd.Timestamp("now")
-        if not isinstance(r_time, pd.Timestamp):
-            r_time = pd.Timestamp(r_time)
-        r_time = r_time.timestamp()
+            r_time = _now_timestamp()
+        else:
+            if not isinstance(r_time, pd.Timestamp):
+                r_time = pd.Timestamp(r_time)
+            r_time = r_time.timestamp()
         kwargs[self.r_column_] = r_time
 
         # Set default l_time
@@ -105,10 +366,93 @@ class Table:
         # Construct the parameters
         params = tuple(kwargs.get(param, None) for param in self.columns)
 
+        if self.buffer_rows_ is not None:
+            self.buffer_.append(params)
+            if len(self.buffer_) >= self.buffer_rows_:
+                self.flush()
+            elif (self.flush_interval_ is not None
+                  and time.monotonic() - self.last_flush_ >= self.flush_interval_):
+                self.flush()
+            return
+
         # Execute the sql
         with self.conn_:
             self.conn_.execute(self.insert_sql_, params)
 
+    def extend(self, data, chunk_size=10000):
+        """
+        Append many rows at once from a DataFrame or a dict of column arrays.
+
+        Columns are checked against the table once instead of once per row.
+        A missing logical time column is filled by counting up from the highest logical time,
+        a missing real time column is filled with the current time for every row.
+        Real time values that are not numeric are parsed with pandas.to_datetime,
+        numeric real time values are taken to be timestamps in seconds.
+        In buffered mode the rows are added to the buffer and written with the appended rows.
+
+        Args:
+            data: a pandas DataFrame or a dict mapping column names to equal length arrays
+            chunk_size (int): number of rows written per transaction, or added to the buffer at a time
+        Returns:
+            num_rows (int): the number of rows appended
+        """
+        if isinstance(data, pd.DataFrame):
+            data = {key: data[key].to_numpy() for key in data.columns}
+        unknown = [key for key in data if key not in self.columns]
+        if unknown:
+            raise ValueError(f"Columns {unknown} are not in table {self.table_name}")
+        lengths = {len(values) for values in data.values()}
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same length")
+        num_rows = lengths.pop() if lengths else 0
+        if num_rows == 0:
+            return 0
+
+        if self.l_column_ in data:
+            l_times = np.asarray(data[self.l_column_], dtype=float)
+        else:
+            l_times = self.logical_time + np.arange(1, num_rows + 1, dtype=float)
+
+        if self.r_column_ in data:
+            r_times = np.asarray(data[self.r_column_])
+            if r_times.dtype.kind not in "iuf":
+                times = pd.DatetimeIndex(pd.to_datetime(r_times))
+                if times.tz is not None:
+                    times = times.tz_convert(None)
+                r_times = (times - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+                r_times = np.asarray(r_times, dtype=float)
+        else:
+            r_times = np.full(num_rows, _now_timestamp())
+
+        columns = []
+        for column in self.columns:
+            if column == self.l_column_:
+                columns.append(l_times)
+            elif column == self.r_column_:
+                columns.append(np.asarray(r_times))
+            elif column in data:
+                columns.append(data[column])
+            else:
+                columns.append(None)
+
+        if self.buffer_rows_ is None:
+            # Keep buffered rows ahead of these ones
+            self.flush()
+        for start in range(0, num_rows, chunk_size):
+            # Only a chunk of the rows is turned into Python objects at a time
+            stop = min(start + chunk_size, num_rows)
+            rows = zip(*([None] * (stop - start) if column is None else np.asarray(column[start:stop]).tolist()
+                         for column in columns))
+            if self.buffer_rows_ is not None:
+                self.buffer_.extend(rows)
+                if len(self.buffer_) >= self.buffer_rows_:
+                    self.flush()
+                continue
+            with self.conn_:
+                self.conn_.executemany(self.insert_sql_, rows)
+        self.logical_time = float(l_times[-1])
+        return num_rows
+
     def len(self):
         """
         Get the length of the table which is equivalent to the number of datapoints.
@@ -116,19 +460,520 @@ class Table:
         Returns:
             the_length (int): the length of the table
         """
-        query = 'SELECT * FROM "%s"' %self.table_name
-        dframe = pd.read_sql(query, self.conn_)
-        the_length = len(dframe.index)
-        return the_length
+        self.flush()
+        cur = self.conn_.execute(f'SELECT count(*) FROM "{self.table_name}";')
+        return cur.fetchone()[0]
+
+    def stats(self):
+        """
+        Get the number of rows, the first and last times and the range of every numeric column.
+
+        The statistics of every table are kept between calls and Table objects, until the schema changes
+        or the file is replaced, see pool.file_identity.
+        While the rows seen last time are all still there, which the count of rows tells,
+        only rows past the last rowid seen are aggregated,
+        otherwise, such as after rows were deleted, the whole table is aggregated again.
+
+        Returns:
+            A dict with
+                rows: the number of rows
+                l_time, r_time: tuples of the smallest and largest logical and real time
+                columns: dict mapping every numeric data column to a tuple of its smallest and largest value
+            Smallest and largest values are None if the table is empty
+        """
+        rows = self.len()
+        version = self.conn_.execute("PRAGMA schema_version;").fetchone()[0]
+        key = (os.path.abspath(self.filename_), self.table_name)
+        identity = file_identity(self.filename_)
+        cached = _STATS_CACHE.get(key)
+        if cached is not None and cached[:2] == (identity, version) and cached[3]["rows"] <= rows:
+            seen, stats = cached[2], cached[3]
+        else:
+            seen, stats = None, None
+
+        columns = [self.l_column_, self.r_column_]
+        columns += [column for column, vtype in zip(self.columns[2:], self.vtypes[2:]) if vtype == "Q"]
+        select = ", ".join(f'min("{column}"), max("{column}")' for column in columns)
+        query = f'SELECT count(*), max(rowid), {select} FROM "{self.table_name}"'
+        row = None
+        if seen is not None:
+            row = self.conn_.execute(query + " WHERE rowid > ?", (seen,)).fetchone()
+            if stats["rows"] + row[0] != rows:
+                # Rows seen before are gone
+                row, stats = None, None
+            elif row[0] == 0:
+                return stats
+        if row is None:
+            row = self.conn_.execute(query).fetchone()
+
+        ranges = [(row[i], row[i + 1]) for i in range(2, len(row), 2)]
+        if stats is not None:
+            old_ranges = [stats["l_time"], stats["r_time"]] + list(stats["columns"].values())
+            ranges = [_merge_range(old, new) for old, new in zip(old_ranges, ranges)]
+        stats = {
+            "rows": rows,
+            "l_time": ranges[0],
+            "r_time": ranges[1],
+            "columns": dict(zip(columns[2:], ranges[2:])),
+        }
+        _STATS_CACHE[key] = (identity, version, row[1] if row[1] is not None else seen, stats)
+        return stats
+
+    def last_rowid(self):
+        """
+        Get the rowid of the newest row in the table.
 
-    def to_pandas(self):
+        Returns:
+            rowid (int): the largest rowid in the table, 0 if the table is empty
+        """
+        self.flush()
+        cur = self.conn_.execute(f'SELECT max(rowid) FROM "{self.table_name}";')
+        rowid = cur.fetchone()[0]
+        return 0 if rowid is None else rowid
+
+    def rows_since(self, rowid=None, l_time=None):
+        """
+        Get the rows that were added after a given rowid or logical time.
+
+        Args:
+            rowid (int): only return rows with a larger rowid
+            l_time (float): only return rows with a larger logical time
+        Returns:
+            A tuple containing (pd.DataFrame of the new rows, largest rowid seen)
+            The returned rowid can be passed back in to get the next batch of rows.
+        """
+        self.flush()
+        query = f'SELECT rowid AS rowid_, * FROM "{self.table_name}"'
+        if rowid is not None:
+            query += " WHERE rowid > ? ORDER BY rowid"
+            params = (rowid,)
+        elif l_time is not None:
+            query += f' WHERE "{self.l_column_}" > ? ORDER BY rowid'
+            params = (l_time,)
+        else:
+            query += " ORDER BY rowid"
+            params = ()
+        with metrics.timed("sql"):
+            dframe = pd.read_sql(query, self.conn_, params=params)
+        metrics.inc("simdash_sql_rows_total", len(dframe.index))
+        rowids = dframe.pop("rowid_")
+        if len(rowids):
+            rowid = int(rowids.iloc[-1])
+        elif rowid is None:
+            rowid = self.last_rowid()
+        return dframe, rowid
+
+    def time_column(self, by="logical"):
+        """
+        Get the name of the logical ('logical') or real ('real') time column.
+        """
+        if by == "logical":
+            return self.l_column_
+        if by == "real":
+            return self.r_column_
+        raise ValueError("by must be 'logical' or 'real', not %s" % by)
+
+    def to_time_value(self, value, by="logical"):
+        """
+        Convert a time given to a query to the value stored in the time column.
+
+        Real times that are not numbers are parsed with pd.Timestamp like in append,
+        numbers are taken to be timestamps in seconds.
+        """
+        if value is None:
+            return value
+        if isinstance(value, numbers.Number):
+            # NumPy numbers would be bound as blobs
+            return float(value)
+        if by == "logical":
+            return value
+        if not isinstance(value, pd.Timestamp):
+            value = pd.Timestamp(value)
+        return value.timestamp()
+
+    def time_range(self, by="logical"):
+        """
+        Get the first and last time in the table, using the time column's index.
+
+        Args:
+            by: 'logical' or 'real'
+        Returns:
+            A tuple containing (smallest time, largest time), both None if the table is empty
+        """
+        self.flush()
+        column = self.time_column(by)
+        cur = self.conn_.execute(f'SELECT min("{column}"), max("{column}") FROM "{self.table_name}";')
+        return cur.fetchone()
+
+    def check_columns(self, columns):
+        """
+        Raise a ValueError if any of the columns is not in the table.
+        """
+        unknown = [column for column in columns if column not in self.columns]
+        if unknown:
+            raise ValueError(f"Columns {unknown} are not in table {self.table_name}")
+
+    def count(self, start=None, end=None, by="logical"):
+        """
+        Count the rows in a time window, through the time column's index.
+
+        Without a window this is len().
+        """
+        if start is None and end is None:
+            return self.len()
+        where, params = self.window_sql(start, end, by)
+        cur = self.conn_.execute(f'SELECT count(*) FROM "{self.table_name}"{where};', params)
+        return cur.fetchone()[0]
+
+    def window_sql(self, start=None, end=None, by="logical"):
+        """
+        Build the WHERE clause that selects a time window.
+
+        Returns:
+            A tuple containing (the clause with a leading space or an empty string, list of parameters)
+        """
+        time_column = self.time_column(by)
+        where = []
+        params = []
+        if start is not None:
+            where.append(f'"{time_column}" >= ?')
+            params.append(self.to_time_value(start, by))
+        if end is not None:
+            where.append(f'"{time_column}" <= ?')
+            params.append(self.to_time_value(end, by))
+        if not where:
+            return "", params
+        return " WHERE " + " AND ".join(where), params
+
+    def select_sql(self, start=None, end=None, columns=None, limit=None, by="logical"):
+        """
+        Build the query of to_pandas and to_numpy.
+
+        Returns:
+            A tuple containing (query, list of parameters, list of the columns selected)
+        """
+        if columns is None:
+            columns = self.columns
+        self.check_columns(columns)
+        select = ", ".join(f'"{column}"' for column in columns)
+        time_column = self.time_column(by)
+        where, params = self.window_sql(start, end, by)
+        query = f'SELECT {select} FROM "{self.table_name}"{where}'
+        if limit is not None:
+            query += f' ORDER BY "{time_column}" DESC LIMIT ?'
+            params.append(int(limit))
+        return query, params, list(columns)
+
+    def to_numpy(self, start=None, end=None, columns=None, limit=None, by="logical", datetimes=False):
+        """
+        Read columns into NumPy arrays straight from the cursor, without a Python object per value.
+
+        Arguments are the same as in to_pandas.
+        Numeric columns are read into float64 or int64 arrays, other columns into object arrays.
+
+        Args:
+            datetimes: convert the real time column to local datetime64 values
+        Returns:
+            A dict mapping the column names to np.ndarray
+        """
+        self.flush()
+        query, params, columns = self.select_sql(start, end, columns, limit, by)
+        dtypes = [numpy_dtype(self.dtypes[self.columns.index(column)]) for column in columns]
+        with metrics.timed("sql"):
+            try:
+                arrays = read_columns(self.conn_.execute(query, params), dtypes)
+            except ValueError:
+                # A value that does not match its declared type, let pandas work the columns out
+                dframe = pd.read_sql(query, self.conn_, params=tuple(params))
+                arrays = [dframe[column].to_numpy() for column in columns]
+        metrics.inc("simdash_sql_rows_total", len(arrays[0]) if arrays else 0)
+        if limit is not None:
+            arrays = [np.ascontiguousarray(values[::-1]) for values in arrays]
+        data = dict(zip(columns, arrays))
+        if datetimes and self.r_column_ in data:
+            data[self.r_column_] = epoch_to_datetime64(data[self.r_column_])
+        return data
+
+    def to_pandas(self, start=None, end=None, columns=None, limit=None, by="logical"):
         """
         Create and return a Pandas DataFrame (reindexed so that any of its values can be used in charts).
 
+        Without arguments all rows and columns are returned.
+        A time window only reads the rows in it through the index on the time column.
+
+        Args:
+            start: only return rows at or after this time
+            end: only return rows at or before this time
+            columns: list of columns to return, defaults to all columns
+            limit (int): only return the last limit rows of the window
+            by: whether start and end are 'logical' or 'real' times,
+                real times may be given as anything pd.Timestamp accepts or as timestamps in seconds
         Returns:
             dframe (pd.DataFrame): a Pandas DataFrame with all of the data from the table of the SQL file
         """
-        query = 'SELECT * FROM "%s"' %self.table_name
-        dframe = pd.read_sql(query, self.conn_)
-        dframe.reindex()
+        return pd.DataFrame(self.to_numpy(start, end, columns, limit, by))
+
+    def to_arrow(self, start=None, end=None, columns=None, limit=None, by="logical"):
+        """
+        Read columns into an Arrow table, with the real time column as local timestamps.
+
+        Arguments are the same as in to_pandas, pyarrow has to be installed.
+
+        Returns:
+            pyarrow.Table
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed for Arrow export, install simdash[arrow]")
+        return pyarrow.table(self.to_numpy(start, end, columns, limit, by, datetimes=True))
+
+    def write_arrow(self, sink, chunk_size=100000, start=None, end=None, columns=None, by="logical"):
+        """
+        Write rows as an Arrow IPC stream, one record batch per chunk of iter_chunks.
+
+        Args:
+            sink: path or writable binary file
+            chunk_size, start, end, columns, by: as in iter_chunks
+        Returns:
+            num_rows (int): the number of rows written
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed for Arrow export, install simdash[arrow]")
+        num_rows = 0
+        writer = None
+        try:
+            for chunk in self.iter_chunks(chunk_size, start, end, columns, by, numpy=True):
+                if self.r_column_ in chunk:
+                    chunk[self.r_column_] = epoch_to_datetime64(chunk[self.r_column_])
+                batch = pyarrow.record_batch(list(chunk.values()), names=list(chunk))
+                if writer is None:
+                    writer = pyarrow.ipc.new_stream(sink, batch.schema)
+                writer.write_batch(batch)
+                num_rows += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        return num_rows
+
+    def iter_chunks(self, chunk_size=100000, start=None, end=None, columns=None, by="logical", numpy=False):
+        """
+        Read the table in chunks of at most chunk_size rows, so only one chunk is in memory at a time.
+
+        Every chunk is a separate query that carries on after the last row of the previous one,
+        so no read transaction is held open between chunks.
+        Chunks are in rowid order, or in order of the time column when a time window is given.
+
+        Args:
+            chunk_size (int): largest number of rows of a chunk
+            start, end, by: only read the rows in this time window, like in to_pandas
+            columns: list of columns to read, defaults to all columns
+            numpy: yield dicts mapping column names to NumPy arrays instead of DataFrames
+        Yields:
+            pd.DataFrame, or a dict of np.ndarray, of the next chunk_size rows
+        """
+        self.flush()
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if columns is None:
+            columns = self.columns
+        self.check_columns(columns)
+        select = ", ".join(f'"{column}"' for column in columns)
+        where, params = self.window_sql(start, end, by)
+        # Key the chunks on the time column's index when there is a window, on rowid otherwise
+        keys = [f'"{self.time_column(by)}"', "rowid"] if where else ["rowid"]
+        key = ", ".join(keys)
+        key_dtypes = [np.dtype(object)] * len(keys)
+        dtypes = [numpy_dtype(self.dtypes[self.columns.index(column)]) for column in columns]
+        last = None
+        while True:
+            clause = where
+            args = list(params)
+            if last is not None:
+                clause += (" AND " if clause else " WHERE ") + f"({key}) > ({', '.join(['?'] * len(keys))})"
+                args += last
+            query = f'SELECT {key}, {select} FROM "{self.table_name}"{clause} ORDER BY {key} LIMIT ?;'
+            with metrics.timed("sql"):
+                rows = self.conn_.execute(query, args + [chunk_size]).fetchall()
+            metrics.inc("simdash_sql_rows_total", len(rows))
+            if not rows:
+                return
+            last = list(rows[-1][:len(keys)])
+            try:
+                arrays = read_columns(rows, key_dtypes + dtypes)[len(keys):]
+            except ValueError:
+                dframe = pd.DataFrame.from_records(rows, coerce_float=True)
+                arrays = [dframe[i].to_numpy() for i in range(len(keys), len(keys) + len(columns))]
+            chunk = dict(zip(columns, arrays))
+            yield chunk if numpy else pd.DataFrame(chunk)
+            if len(rows) < chunk_size:
+                return
+
+    def count_capped(self, cap, start=None, end=None, by="logical"):
+        """
+        Count the rows in a time window, stopping at cap, so the cost is bounded however many rows there are.
+        """
+        if start is None and end is None:
+            return min(self.len(), cap)
+        where, params = self.window_sql(start, end, by)
+        cur = self.conn_.execute(f'SELECT count(*) FROM (SELECT 1 FROM "{self.table_name}"{where} LIMIT ?);',
+                                 params + [cap])
+        return cur.fetchone()[0]
+
+    def rollup_window_sql(self, seconds, start=None, end=None, by="logical"):
+        """
+        Build the WHERE clause that selects the buckets of a rollup overlapping a time window.
+
+        Returns:
+            A tuple containing (the clause with a leading space or an empty string, list of parameters)
+        """
+        where = []
+        params = []
+        if by == "real":
+            low, high = f'"bucket" + {seconds} > ?', '"bucket" <= ?'
+        elif by == "logical":
+            low, high = '"l_max" >= ?', '"l_min" <= ?'
+        else:
+            raise ValueError("by must be 'logical' or 'real', not %s" % by)
+        if start is not None:
+            where.append(low)
+            params.append(self.to_time_value(start, by))
+        if end is not None:
+            where.append(high)
+            params.append(self.to_time_value(end, by))
+        if not where:
+            return "", params
+        return " WHERE " + " AND ".join(where), params
+
+    def choose_rollup(self, max_points, start=None, end=None, columns=None, by="logical"):
+        """
+        Choose the rollup to chart a time window from, instead of the rows.
+
+        Rows are read while the window holds at most max_points of them.
+        Otherwise the finest rollup with at most max_points buckets in the window is chosen,
+        or the coarsest one if they all have more.
+
+        Args:
+            max_points: number of points the chart is downsampled to, None never chooses a rollup
+            start, end, by: the time window, like in to_pandas
+            columns: the columns the chart needs, every column by default,
+                only rollups of all of them that are not time columns are chosen
+        Returns:
+            The bucket seconds of the rollup, None to read the rows
+        """
+        if max_points is None or not self.rollups:
+            return None
+        needed = set(self.columns if columns is None else columns) - {self.l_column_, self.r_column_}
+        candidates = sorted(seconds for seconds, names in self.rollups.items() if needed <= set(names))
+        if not candidates or self.count_capped(max_points + 1, start, end, by) <= max_points:
+            return None
+        for seconds in candidates:
+            if self.count_buckets(seconds, max_points + 1, start, end, by) <= max_points:
+                return seconds
+        return candidates[-1]
+
+    def count_buckets(self, seconds, cap, start=None, end=None, by="logical"):
+        """
+        Count the buckets of a rollup overlapping a time window, stopping at cap.
+        """
+        where, params = self.rollup_window_sql(seconds, start, end, by)
+        cur = self.conn_.execute(
+            f'SELECT count(*) FROM (SELECT 1 FROM "{rollup_table_name(self.table_name, seconds)}"{where} '
+            f'LIMIT ?);', params + [cap])
+        return cur.fetchone()[0]
+
+    def read_rollup(self, seconds, start=None, end=None, columns=None, by="logical", aggregate="mean"):
+        """
+        Read a rollup as rows of the table, one per bucket of real time.
+
+        The real time of a row is the start of its bucket and the logical time is the last one in the bucket.
+
+        Args:
+            seconds: bucket seconds of the rollup
+            start, end, by: only read the buckets overlapping this time window, like in to_pandas
+            columns: list of columns to read, the time columns and the rolled up columns by default
+            aggregate: 'mean', 'min' or 'max', the value of every column
+        Returns:
+            pandas DataFrame
+        """
+        self.flush()
+        if aggregate not in ("mean", "min", "max"):
+            raise ValueError(f"Rollups keep the mean, min or max, not {aggregate}")
+        rolled_up = self.rollups[seconds]
+        if columns is None:
+            columns = [self.l_column_, self.r_column_] + rolled_up
+        selected = []
+        for column in columns:
+            if column == self.l_column_:
+                selected.append(f'"l_max" AS "{column}"')
+            elif column == self.r_column_:
+                selected.append(f'"bucket" AS "{column}"')
+            elif column not in rolled_up:
+                raise ValueError(f"Column {column} is not in the {seconds} second rollup of {self.table_name}")
+            elif aggregate == "mean":
+                selected.append(f'"{column}__sum" / nullif("{column}__count", 0) AS "{column}"')
+            else:
+                selected.append(f'"{column}__{aggregate}" AS "{column}"')
+        where, params = self.rollup_window_sql(seconds, start, end, by)
+        query = (f'SELECT {", ".join(selected)} FROM "{rollup_table_name(self.table_name, seconds)}"{where} '
+                 f'ORDER BY "bucket";')
+        dtypes = [np.dtype(np.float64)] * len(columns)
+        with metrics.timed("sql"):
+            arrays = read_columns(self.conn_.execute(query, params), dtypes)
+        metrics.inc("simdash_sql_rows_total", len(arrays[0]) if arrays else 0)
+        return pd.DataFrame(dict(zip(columns, arrays)))
+
+    def aggregate(self, aggregates, group_by=(), bin_column=None, bin_step=None,
+                  start=None, end=None, limit=None, by="logical"):
+        """
+        Aggregate the rows of the table in SQL, returning one row per group.
+
+        Args:
+            aggregates: dict mapping columns to one of the functions in AGGREGATES
+            group_by: list of columns whose values make up the groups
+            bin_column: column that is grouped on in bins of bin_step, every bin is labelled by its start,
+                bins of the real time column are in seconds
+            bin_step: width of the bins
+            start, end, by: only aggregate the rows in this time window, like in to_pandas
+            limit (int): only return the last limit groups
+        Returns:
+            A pd.DataFrame with a column for every group column then every aggregated column,
+            named like the table's columns and sorted by the group columns
+        """
+        self.flush()
+        groups = ([] if bin_column is None else [bin_column]) + [col for col in group_by if col != bin_column]
+        self.check_columns(groups + list(aggregates))
+        both = [col for col in aggregates if col in groups]
+        if both:
+            raise ValueError(f"Columns {both} can not be both grouped on and aggregated")
+        unknown = [func for func in aggregates.values() if func not in AGGREGATES]
+        if unknown:
+            raise ValueError(f"Aggregates {unknown} are not known, must be one of {sorted(AGGREGATES)}")
+
+        select = []
+        for column in groups:
+            if column == bin_column:
+                step = float(bin_step)
+                if step <= 0:
+                    raise ValueError("bin_step must be positive")
+                # CAST truncates toward zero, values below their truncated bin are moved down a bin to floor them
+                ratio = f'"{column}" / {step!r}'
+                select.append(f'(CAST({ratio} AS INTEGER) - ({ratio} < CAST({ratio} AS INTEGER))) * {step!r} '
+                              f'AS "{column}"')
+            else:
+                select.append(f'"{column}"')
+        select += [f'{AGGREGATES[func]}("{column}") AS "{column}"' for column, func in aggregates.items()]
+
+        where, params = self.window_sql(start, end, by)
+        query = f'SELECT {", ".join(select)} FROM "{self.table_name}"{where}'
+        if groups:
+            positions = [str(i + 1) for i in range(len(groups))]
+            order = positions if limit is None else [f"{position} DESC" for position in positions]
+            query += f" GROUP BY {', '.join(positions)} ORDER BY {', '.join(order)}"
+            if limit is not None:
+                query += " LIMIT ?"
+                params.append(int(limit))
+        with metrics.timed("sql"):
+            dframe = pd.read_sql(query, self.conn_, params=tuple(params))
+        metrics.inc("simdash_sql_rows_total", len(dframe.index))
+        if groups and limit is not None:
+            dframe = dframe.iloc[::-1].reset_index(drop=True)
         return dframe
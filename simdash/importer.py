@@ -0,0 +1,117 @@
+"""
+Import CSV or Parquet files into a SimDash database.
+"""
+import os
+
+import click
+import logbook
+import pandas as pd
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import cli_main
+from .database import database
+
+log = logbook.Logger(__name__)
+
+def infer_types(dframe):
+    """
+    Guess the SQL datatypes and Altair variable types of the columns of a DataFrame.
+
+    Args:
+        dframe: pandas DataFrame
+    Returns:
+        A tuple containing (list of dtypes, list of vtypes)
+    """
+    dtypes = []
+    vtypes = []
+    for column in dframe.columns:
+        kind = dframe[column].dtype.kind
+        if kind in "iub":
+            dtypes.append("INT")
+            vtypes.append("Q")
+        elif kind == "f":
+            dtypes.append("FLOAT")
+            vtypes.append("Q")
+        else:
+            dtypes.append("TEXT")
+            vtypes.append("N")
+    return dtypes, vtypes
+
+def read_chunks(filename, chunk_size):
+    """
+    Yield DataFrames of at most chunk_size rows from a CSV or Parquet file.
+
+    Args:
+        filename: path to a .csv or .parquet file
+        chunk_size: number of rows per chunk
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".csv":
+        yield from pd.read_csv(filename, chunksize=chunk_size)
+    elif ext in (".parquet", ".pq"):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to import Parquet files, install simdash[arrow]")
+        # Read a batch at a time like the CSV chunks, rather than the whole file at once
+        for batch in pyarrow.parquet.ParquetFile(filename).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Don't know how to import {filename}, expected a .csv or .parquet file")
+
+def import_file(the_db, table_name, filename, l_column="logic_time", r_column="real_time", chunk_size=10000):
+    """
+    Append the rows of a CSV or Parquet file to a table, creating the table if needed.
+
+    Args:
+        the_db: Database to import into
+        table_name: name of the table
+        filename: path to a .csv or .parquet file
+        l_column: name of the logical time column used if the table is created
+        r_column: name of the real time column used if the table is created
+        chunk_size: number of rows read and written at a time
+    Returns:
+        num_rows (int): the number of rows imported
+    """
+    num_rows = 0
+    the_tab = None
+    for dframe in read_chunks(filename, chunk_size):
+        if the_tab is None:
+            if not the_db.check_if_table_exists(table_name):
+                others = [col for col in dframe.columns if col not in (l_column, r_column)]
+                dtypes, vtypes = infer_types(dframe[others])
+                the_db.make_table(table_name, [l_column, r_column] + others,
+                                  ["FLOAT", "INT"] + dtypes, ["Q", "T"] + vtypes)
+            the_tab = the_db.get_table(table_name)
+        num_rows += the_tab.extend(dframe, chunk_size=chunk_size)
+    return num_rows
+
+@cli_main.command("import")
+@click.option("-d", "--database1", required=True, help="Path to database file")
+@click.option("-t", "--table", "table_name", required=True, help="Name of the table to import into")
+@click.option("--l-column", default="logic_time", show_default=True,
+              help="Logical time column name, used when the table is created.")
+@click.option("--r-column", default="real_time", show_default=True,
+              help="Real time column name, used when the table is created.")
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Number of rows written per transaction.")
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def import_(database1, table_name, l_column, r_column, chunk_size, files):
+    """
+    Import CSV or Parquet files into a table.
+    """
+    the_db = database.Database(database1)
+    for filename in files:
+        num_rows = import_file(the_db, table_name, filename, l_column, r_column, chunk_size)
+        log.info(f"Imported {num_rows} rows from {filename} into {table_name}")
+
+@cli_main.command("consolidate-pids")
+@click.option("-d", "--database1", required=True, help="Path to database file")
+def consolidate_pids(database1):
+    """
+    Move the rows of every per-PID table into the long-format PID table.
+    """
+    moved = database.Database(database1).consolidate_pid_tables()
+    log.info(f"Moved {len(moved)} PID tables into the long-format PID table")
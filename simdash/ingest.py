@@ -0,0 +1,482 @@
+"""
+Ingest daemon that owns the writer connection of a database.
+
+SQLite lets one connection write at a time, so many simulation processes appending to one file
+wait on each other for the write lock and stall on `database is locked`.
+Instead they can send their rows to `simdash ingest`, which writes the rows of everyone
+in large transactions on its single connection.
+Rows are sent as JSON lines over a Unix socket, or put on a multiprocessing queue,
+by IngestClient, whose TableProxy objects append like a Table without waiting on the disk.
+
+Every message is a dict with an 'op' and the 'table' it applies to:
+    append: 'l_time', 'r_time', 'args' and 'kwargs' of Table.append
+    extend: 'data', a dict of column lists as in Table.extend
+    make_table: 'columns', 'dtypes', 'vtypes' and 'rollups' of Database.make_table
+Messages carry the real 'time' they were sent at, used when they do not give a real time.
+"""
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+
+import click
+import logbook
+import numpy as np
+import pandas as pd
+
+from . import cli_main
+from .database import database, retention
+from .database.table import _now_timestamp
+
+log = logbook.Logger(__name__)
+
+# Number of rows written per transaction at most
+MAX_ROWS = 10000
+# Seconds the writer waits for rows before writing the ones it has
+INTERVAL = 0.5
+# Number of messages a client keeps while the daemon can not take them, more are dropped
+MAX_PENDING = 100000
+
+def to_json_value(value):
+    """
+    Convert a value json can not serialize, such as a NumPy scalar.
+    """
+    if hasattr(value, "item"):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return str(value)
+
+def check_values(values):
+    """
+    Raise TypeError unless every value can be bound by SQLite, such as a list sent in place of a number.
+    """
+    for value in values:
+        if value is not None and not isinstance(value, (int, float, str, bytes)):
+            raise TypeError(f"{value!r} is not a number, string or None")
+        if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+            raise TypeError(f"{value} does not fit in an SQLite integer")
+
+def check_column(values):
+    """
+    Raise TypeError unless a column of an extend message is flat and every value can be bound by SQLite.
+    """
+    values = np.asarray(values)
+    if values.ndim != 1:
+        raise TypeError("Columns must be flat lists of values")
+    if values.dtype == object:
+        check_values(values)
+    elif values.dtype.kind not in "biufUSM":
+        raise TypeError(f"Columns of {values.dtype} can not be written")
+
+def encode_message(message):
+    """
+    Serialize a message to a line of JSON.
+    """
+    return json.dumps(message, default=to_json_value).encode("utf-8") + b"\n"
+
+class IngestWriter:
+    """
+    Writes the messages of every client on a single connection to the database.
+
+    Rows are buffered per table and written once max_rows rows are pending or no more messages are waiting,
+    the rows of each table in one transaction.
+
+    Attributes:
+        num_rows: number of rows written
+    """
+    def __init__(self, db_file, max_rows=MAX_ROWS, interval=INTERVAL):
+        self.db_file = db_file
+        self.the_db = None
+        self.max_rows = max_rows
+        self.interval = interval
+        self.tables_ = {}
+        self.pending_ = 0
+        self.num_rows = 0
+
+    def get_table(self, table_name):
+        """
+        Get a buffered Table of the writer's connection, None if the table does not exist.
+        """
+        if table_name not in self.tables_:
+            if not self.the_db.check_if_table_exists(table_name):
+                return None
+            self.tables_[table_name] = self.the_db.get_table(table_name).buffered(max_rows=sys.maxsize,
+                                                                                   interval=None)
+        return self.tables_[table_name]
+
+    def handle(self, message):
+        """
+        Apply one message, errors are logged rather than raised so one bad client does not stop the others.
+        """
+        try:
+            if message["op"] == "make_table":
+                self.the_db.make_table(message["table"], message["columns"], message["dtypes"], message["vtypes"],
+                                       message.get("rollups"))
+                return
+            the_tab = self.get_table(message["table"])
+            if the_tab is None:
+                log.warning(f"Dropped rows of table {message['table']}, which does not exist")
+                return
+            if message["op"] == "append":
+                kwargs = message.get("kwargs", {})
+                r_time = message.get("r_time")
+                if r_time is not None:
+                    r_time = pd.Timestamp(r_time)
+                elif the_tab.r_column_ not in kwargs:
+                    r_time = pd.Timestamp(message["time"], unit="s")
+                # Checked here, as a value SQLite can not bind would fail the transaction of every client's rows
+                check_values([message.get("l_time"), *message.get("args", ()), *kwargs.values()])
+                the_tab.append(message.get("l_time"), r_time, *message.get("args", ()), **kwargs)
+                self.pending_ += 1
+            elif message["op"] == "extend":
+                data = message["data"]
+                for values in data.values():
+                    check_column(values)
+                num_rows = len(next(iter(data.values()), ()))
+                if the_tab.r_column_ not in data:
+                    data[the_tab.r_column_] = np.full(num_rows, message["time"])
+                # The rows are buffered with the appended ones, into the same transaction
+                self.pending_ += the_tab.extend(data)
+            else:
+                log.warning(f"Unknown ingest message {message['op']}")
+        except (KeyError, TypeError, ValueError, sqlite3.Error) as err:
+            log.error(f"Could not ingest a message to {message.get('table')}: {err!r}")
+
+    def flush(self):
+        """
+        Write the rows buffered for every table.
+
+        A table whose rows can not be written at once has them written one at a time,
+        and only the rows that fail are dropped.
+        """
+        for table_name, the_tab in self.tables_.items():
+            try:
+                the_tab.flush()
+            except sqlite3.Error as err:
+                log.error(f"Could not write the rows of {table_name} at once, writing them one at a time: {err!r}")
+                failed = the_tab.flush_each()
+                for row, row_err in failed:
+                    log.error(f"Dropped a row of {table_name}: {row_err!r}")
+                self.pending_ -= len(failed)
+        self.num_rows += self.pending_
+        self.pending_ = 0
+
+    def run(self, messages):
+        """
+        Write the messages of a queue until a None message is received.
+
+        Args:
+            messages: a queue.Queue or multiprocessing queue of message dicts
+        """
+        # The connection is opened on the thread that writes
+        if self.the_db is None:
+            self.the_db = database.get_database(self.db_file)
+        while True:
+            try:
+                message = messages.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            # Take every message already waiting, up to max_rows, into one transaction
+            while message is not None:
+                self.handle(message)
+                if self.pending_ >= self.max_rows:
+                    break
+                try:
+                    message = messages.get_nowait()
+                except queue.Empty:
+                    break
+            self.flush()
+            if message is None:
+                return
+
+class IngestRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads the JSON lines of one client connection onto the server's queue.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                self.server.messages.put(json.loads(line))
+            except ValueError:
+                log.error("Dropped a message that is not JSON")
+
+class IngestServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server putting the messages of every client on one queue.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, messages):
+        self.messages = messages
+        super().__init__(socket_path, IngestRequestHandler)
+
+def run_ingest(db_file, socket_path, max_rows=MAX_ROWS, interval=INTERVAL, prune_interval=None):
+    """
+    Write the rows sent to a Unix socket until the process is stopped.
+
+    Args:
+        db_file: path to the database file
+        socket_path: path of the Unix socket, a socket left behind by a previous run is replaced
+        max_rows: largest number of rows per transaction
+        interval: seconds the writer waits for more rows
+        prune_interval: seconds between prunes of the tables with a retention policy, None never prunes
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    messages = queue.Queue()
+    writer = IngestWriter(db_file, max_rows, interval)
+    server = IngestServer(socket_path, messages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if prune_interval:
+        retention.Pruner(db_file, prune_interval).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: messages.put(None))
+    log.info(f"Ingesting into {db_file} from {socket_path}")
+    try:
+        writer.run(messages)
+    except KeyboardInterrupt:
+        # Write whatever was received before stopping
+        messages.put(None)
+        writer.run(messages)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+        log.info(f"Wrote {writer.num_rows} rows")
+
+def run_queue_writer(db_file, messages, max_rows=MAX_ROWS, interval=INTERVAL):
+    """
+    Write the messages of a multiprocessing queue until a None message is received.
+    """
+    IngestWriter(db_file, max_rows, interval).run(messages)
+
+def start_ingest_process(db_file, max_rows=MAX_ROWS, interval=INTERVAL):
+    """
+    Start a process that writes the messages of a multiprocessing queue, for simulations that start their workers.
+
+    The queue can be passed to worker processes and to IngestClient, putting None on it stops the process.
+
+    Returns:
+        A tuple containing (the process, the queue)
+    """
+    context = multiprocessing.get_context("spawn")
+    messages = context.Queue()
+    process = context.Process(target=run_queue_writer, args=(db_file, messages, max_rows, interval), daemon=True)
+    process.start()
+    return process, messages
+
+class TableProxy:
+    """
+    Appends to a table through an IngestClient, with the same arguments as Table.append and Table.extend.
+
+    Real times are taken when rows are appended, not when the daemon writes them.
+    """
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+
+    def append(self, l_time=None, r_time=None, *args, **kwargs):
+        """
+        Send a row to the daemon, see Table.append.
+
+        Returns:
+            False if the row was dropped because too many messages are waiting
+        """
+        if r_time is not None:
+            r_time = pd.Timestamp(r_time).isoformat()
+        return self.client.send({"op": "append", "table": self.table_name, "l_time": l_time, "r_time": r_time,
+                                 "args": list(args), "kwargs": kwargs})
+
+    def extend(self, data):
+        """
+        Send many rows to the daemon, see Table.extend.
+
+        Returns:
+            False if the rows were dropped because too many messages are waiting
+        """
+        if isinstance(data, pd.DataFrame):
+            data = {key: data[key] for key in data.columns}
+        data = {key: np.asarray(values).tolist() for key, values in data.items()}
+        return self.client.send({"op": "extend", "table": self.table_name, "data": data})
+
+    def flush(self):
+        """
+        Wait until the rows appended so far are sent to the daemon.
+        """
+        self.client.flush()
+
+class IngestClient:
+    """
+    Sends rows to an ingest daemon without blocking the caller.
+
+    Messages are sent by a background thread; when the daemon can not keep up or is not running,
+    up to max_pending messages are kept and later ones are dropped and counted.
+
+        client = IngestClient("/tmp/simdash.sock")
+        the_tab = client.get_table("sys_usage")
+        the_tab.append(cpu_load=0.5)
+
+    Attributes:
+        dropped: number of messages dropped
+    """
+    def __init__(self, address, max_pending=MAX_PENDING, retry_interval=1.0):
+        """
+        Args:
+            address: path of the daemon's Unix socket, or a queue from start_ingest_process
+            max_pending: largest number of messages kept while they can not be sent
+            retry_interval: seconds between attempts to connect to the daemon
+        """
+        self.address = address
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        self.dropped = 0
+        self.pending_ = collections.deque()
+        self.cond_ = threading.Condition()
+        self.closed_ = False
+        self.sending_ = 0
+        self.sock_ = None
+        self.thread_ = None
+        if isinstance(address, str):
+            self.thread_ = threading.Thread(target=self.send_loop, daemon=True, name="simdash-ingest")
+            self.thread_.start()
+
+    def get_table(self, table_name):
+        """
+        Get a TableProxy that appends to a table of the daemon's database.
+        """
+        return TableProxy(self, table_name)
+
+    def make_table(self, table_name, columns, dtypes, vtypes, rollups=None):
+        """
+        Have the daemon make a table, see Database.make_table.
+        """
+        self.send({"op": "make_table", "table": table_name, "columns": columns, "dtypes": dtypes, "vtypes": vtypes,
+                   "rollups": rollups})
+
+    def send(self, message):
+        """
+        Queue a message for the daemon.
+
+        Returns:
+            False if the message was dropped
+        """
+        message["time"] = _now_timestamp()
+        if self.thread_ is None:
+            try:
+                self.address.put_nowait(message)
+            except queue.Full:
+                with self.cond_:
+                    self.dropped += 1
+                return False
+            return True
+        with self.cond_:
+            if len(self.pending_) >= self.max_pending:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 10000 == 0:
+                    log.warning(f"Dropped {self.dropped} messages the ingest daemon could not take")
+                return False
+            self.pending_.append(message)
+            self.cond_.notify()
+        return True
+
+    def connect(self):
+        """
+        Connect to the daemon's socket, returns False if it is not listening.
+        """
+        try:
+            self.sock_ = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock_.connect(self.address)
+            return True
+        except OSError:
+            self.sock_.close()
+            self.sock_ = None
+            return False
+
+    def send_loop(self):
+        """
+        Send the pending messages in batches, reconnecting when the daemon goes away.
+        """
+        while True:
+            with self.cond_:
+                while not self.pending_ and not self.closed_:
+                    self.cond_.wait()
+                if not self.pending_:
+                    return
+                batch = list(self.pending_)
+                self.pending_.clear()
+                self.sending_ = len(batch)
+            while self.sock_ is None and not self.connect():
+                if self.closed_:
+                    with self.cond_:
+                        self.dropped += len(batch)
+                    batch = []
+                    break
+                time.sleep(self.retry_interval)
+            try:
+                if batch:
+                    self.sock_.sendall(b"".join(encode_message(message) for message in batch))
+            except OSError:
+                # The batch may have been partly sent, it is dropped rather than sent twice
+                log.warning(f"Lost the connection to the ingest daemon, dropped {len(batch)} messages")
+                with self.cond_:
+                    self.dropped += len(batch)
+                self.sock_.close()
+                self.sock_ = None
+            with self.cond_:
+                self.sending_ = 0
+                self.cond_.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the pending messages are sent.
+
+        Returns:
+            False if the timeout passed first
+        """
+        if self.thread_ is None:
+            return True
+        with self.cond_:
+            return self.cond_.wait_for(lambda: not self.pending_ and not self.sending_, timeout)
+
+    def close(self, timeout=10.0):
+        """
+        Send the pending messages and close the connection to the daemon.
+        """
+        if self.thread_ is None:
+            return
+        with self.cond_:
+            self.closed_ = True
+            self.cond_.notify_all()
+        self.thread_.join(timeout)
+        if self.sock_ is not None:
+            self.sock_.close()
+            self.sock_ = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+@cli_main.command()
+@click.option("-d", "--database1", required=True, help="Path to database file")
+@click.option("-s", "--socket", "socket_path", default="simdash.sock", show_default=True,
+              help="Path of the Unix socket clients send rows to.")
+@click.option("--max-rows", default=MAX_ROWS, show_default=True, help="Largest number of rows per transaction.")
+@click.option("--interval", default=INTERVAL, show_default=True,
+              help="Seconds to wait for rows before writing the ones received.")
+@click.option("--prune-interval", default=60.0, show_default=True,
+              help="Seconds between prunes of the tables with a retention policy, 0 never prunes.")
+def ingest(database1, socket_path, max_rows, interval, prune_interval):
+    """
+    Write the rows sent by simulation processes to a database on a single connection.
+    """
+    run_ingest(database1, socket_path, max_rows, interval, prune_interval)
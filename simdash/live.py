@@ -0,0 +1,219 @@
+"""
+Push of new rows to the browsers viewing charts, over Server-Sent Events.
+
+Every server process has a single Watcher thread that looks for new rows of the tables browsers follow,
+instead of every browser polling /data/ for every chart.
+New rows of a table are read and serialized once, then put on the queue of every Subscription following it,
+so the work done grows with the rate rows are written rather than with the number of viewers.
+A single database file is only read when PRAGMA data_version says another connection committed to it.
+
+Rows may reach a browser twice, such as rows written while it subscribed, but are never missed.
+"""
+import queue
+import threading
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+# Largest number of events waiting for a client, a client that falls further behind is dropped and reconnects
+QUEUE_SIZE = 64
+
+class Subscription:
+    """
+    The tables a browser page follows and the events sent to it.
+
+    Events are tuples of (table name, rowid of the last row, JSON body).
+
+    Attributes:
+        rowids: dict mapping the names of the tables followed to the rowid the page has rows up to
+        dropped: True once the Watcher stopped sending events, the stream ends and the browser reconnects
+    """
+    def __init__(self, rowids):
+        self.rowids = dict(rowids)
+        self.events = queue.Queue(QUEUE_SIZE)
+        self.dropped = False
+
+    def send(self, event):
+        """
+        Put an event on the queue without waiting.
+
+        Returns:
+            False if the queue is full
+        """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            return False
+        return True
+
+class Watcher:
+    """
+    Reads the new rows of the tables subscriptions follow every interval seconds on a background thread,
+    and sends them to the subscriptions.
+
+    Attributes:
+        interval: seconds between looks for new rows
+        subscriptions: number of subscriptions
+    """
+    def __init__(self, open_database, read_rows, interval=1.0, data_version=True):
+        """
+        Args:
+            open_database: function with no arguments returning a context manager that gives a read-only Database,
+                kept open while the Watcher runs
+            read_rows: function of (Database, table name, rowid) returning a tuple of
+                (JSON body of the rows after rowid or None if there are none, rowid of the last row)
+            interval: seconds between looks for new rows
+            data_version: only read tables when PRAGMA data_version of the Database's connection changes,
+                which only covers databases kept in a single file
+        """
+        self.open_database = open_database
+        self.read_rows = read_rows
+        self.interval = interval
+        self.data_version = data_version
+        # Rowid every followed table has been read up to, keyed by table name
+        self.watermarks_ = {}
+        # Set when a table starts being followed, so it is read even if data_version did not change
+        self.new_tables_ = False
+        self.subscriptions_ = []
+        self.lock_ = threading.Lock()
+        self.stop_ = threading.Event()
+        self.thread_ = None
+
+    @property
+    def subscriptions(self):
+        with self.lock_:
+            return len(self.subscriptions_)
+
+    def start(self):
+        """
+        Start watching in the background.
+
+        Returns:
+            self
+        """
+        self.stop_.clear()
+        self.thread_ = threading.Thread(target=self.run, daemon=True, name="simdash-watcher")
+        self.thread_.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stop watching, ending every subscription.
+        """
+        self.stop_.set()
+        if self.thread_ is not None:
+            self.thread_.join(timeout)
+        with self.lock_:
+            for subscription in self.subscriptions_:
+                subscription.dropped = True
+            self.subscriptions_ = []
+            self.watermarks_ = {}
+
+    def subscribe(self, rowids):
+        """
+        Follow tables from the rowids a page has their rows up to.
+
+        Tables not followed yet are read from the rowid given.
+        Rows of tables that are followed already are sent from where the Watcher has read up to,
+        the page reads the rows in between itself, see catch_up.
+
+        Args:
+            rowids: dict mapping table names to rowids
+        Returns:
+            A Subscription
+        """
+        subscription = Subscription(rowids)
+        with self.lock_:
+            for table_name, rowid in rowids.items():
+                if table_name not in self.watermarks_:
+                    self.watermarks_[table_name] = rowid
+                    self.new_tables_ = True
+            self.subscriptions_.append(subscription)
+        return subscription
+
+    def catch_up(self, subscription):
+        """
+        Get the tables the Watcher has read further than a new subscription has rows.
+
+        Returns:
+            A dict mapping those table names to the subscription's rowids
+        """
+        with self.lock_:
+            return {table_name: rowid for table_name, rowid in subscription.rowids.items()
+                    if rowid < self.watermarks_.get(table_name, rowid)}
+
+    def unsubscribe(self, subscription):
+        """
+        Stop sending events to a subscription, and stop reading the tables no subscription follows.
+        """
+        with self.lock_:
+            self.remove(subscription)
+
+    def remove(self, subscription):
+        """
+        Remove a subscription, holding the lock.
+        """
+        if subscription in self.subscriptions_:
+            self.subscriptions_.remove(subscription)
+        followed = set()
+        for other in self.subscriptions_:
+            followed.update(other.rowids)
+        self.watermarks_ = {table_name: rowid for table_name, rowid in self.watermarks_.items()
+                            if table_name in followed}
+
+    def publish(self, table_name, rowid, body):
+        """
+        Send the new rows of a table to every subscription following it.
+
+        Subscriptions whose queues are full are dropped, their browsers reconnect and read the rows they missed.
+        """
+        with self.lock_:
+            if table_name not in self.watermarks_:
+                return
+            self.watermarks_[table_name] = rowid
+            for subscription in list(self.subscriptions_):
+                if table_name in subscription.rowids and not subscription.send((table_name, rowid, body)):
+                    log.warning("Dropped a client that fell behind")
+                    subscription.dropped = True
+                    self.remove(subscription)
+
+    def poll(self, the_db, version=None):
+        """
+        Read and publish the new rows of every followed table.
+
+        Args:
+            the_db: read-only Database
+            version: PRAGMA data_version at the last poll
+        Returns:
+            The current PRAGMA data_version, when data_version is used
+        """
+        with self.lock_:
+            watermarks = dict(self.watermarks_)
+            new_tables, self.new_tables_ = self.new_tables_, False
+        if self.data_version:
+            current = the_db.conn.execute("PRAGMA data_version;").fetchone()[0]
+            if current == version and not new_tables:
+                return current
+            version = current
+        for table_name, rowid in watermarks.items():
+            try:
+                body, last = self.read_rows(the_db, table_name, rowid)
+            except Exception as err: # pylint: disable=broad-except
+                log.error(f"Could not read new rows of {table_name}: {err!r}")
+                continue
+            if body is not None:
+                self.publish(table_name, last, body)
+        return version
+
+    def run(self):
+        """
+        Poll every interval seconds until stop is called.
+        """
+        with self.open_database() as the_db:
+            version = None
+            while not self.stop_.wait(self.interval):
+                with self.lock_:
+                    idle = not self.watermarks_
+                if not idle:
+                    version = self.poll(the_db, version)
@@ -0,0 +1,49 @@
+"""
+Commands that maintain a SimDash database: retention and pruning.
+"""
+import time
+
+import click
+import logbook
+
+from . import cli_main
+from .database import database, retention
+
+log = logbook.Logger(__name__)
+
+@cli_main.command("retention")
+@click.option("-d", "--database1", required=True, help="Path to database file")
+@click.option("-t", "--table", "table_name", required=True, help="Name of the table")
+@click.option("--max-rows", type=int, default=None, help="Largest number of rows kept.")
+@click.option("--max-age", default=None, help="Oldest rows kept, as seconds or a duration such as '7 days'.")
+@click.option("--keep-rollups", is_flag=True, help="Keep the table's rollups for the rows that are deleted.")
+def retention_(database1, table_name, max_rows, max_age, keep_rollups):
+    """
+    Set how many rows of a table are kept, with no limits every row is kept.
+    """
+    if max_age is not None and max_age.replace(".", "", 1).isdigit():
+        max_age = float(max_age)
+    the_db = database.Database(database1)
+    the_db.set_retention(table_name, max_rows, max_age, keep_rollups)
+    log.info(f"Retention of {table_name} is now {the_db.get_retention(table_name) or 'every row'}")
+
+@cli_main.command()
+@click.option("-d", "--database1", required=True, help="Path to database file")
+@click.option("--interval", default=0.0, show_default=True,
+              help="Prune every interval seconds until stopped, 0 prunes once.")
+@click.option("--batch-size", default=retention.BATCH_SIZE, show_default=True,
+              help="Number of rows deleted per transaction.")
+def prune(database1, interval, batch_size):
+    """
+    Delete the rows tables no longer keep, following their retention.
+    """
+    if interval > 0:
+        pruner = retention.Pruner(database1, interval, batch_size).start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pruner.stop()
+        return
+    pruned = retention.prune_database(database.Database(database1), batch_size=batch_size)
+    log.info(f"Pruned {sum(pruned.values())} rows from {len(pruned)} tables")
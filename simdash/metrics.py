@@ -0,0 +1,164 @@
+"""
+Timings, sizes and counts of what the server does, exposed in the Prometheus text format on /metrics.
+
+Stages of a request are timed with timed, such as the SQL queries of a Table ('sql'),
+downsampling ('downsample'), serializing chart specs ('serialize') and rendering templates ('render').
+Functions added with add_listener are told of every stage timed, which the server uses to break slow
+requests down by stage.
+Metrics are kept per process, charts built in chart processes are not counted.
+Every series is labelled with the pid of its server process, so the series of --workers processes are told apart,
+though a scrape only reaches one of them.
+"""
+import collections
+import contextlib
+import math
+import os
+import threading
+import time
+
+# Upper bounds of the buckets of histograms of seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds of the buckets of histograms of bytes or rows
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+HELP = {
+    "simdash_stage_seconds": "Seconds spent in each stage of serving charts.",
+    "simdash_request_seconds": "Seconds taken to answer requests, by route and status.",
+    "simdash_response_bytes": "Bytes in response bodies sent, by route.",
+    "simdash_sql_rows_total": "Rows read from SQLite by chart queries.",
+    "simdash_chart_bytes": "Bytes of the specs and datasets of charts built.",
+    "simdash_cache_hits_total": "Lookups answered from a cache.",
+    "simdash_cache_misses_total": "Lookups that were not in a cache.",
+    "simdash_cache_entries": "Number of entries in a cache.",
+    "simdash_event_streams": "Number of open /events/ streams.",
+}
+
+_COUNTERS = collections.defaultdict(float)
+# Histograms keyed like counters, every one a list of the counts in each bucket followed by the sum and count
+_HISTOGRAMS = {}
+_BUCKETS = {}
+_LOCK = threading.Lock()
+_LISTENERS = []
+_COLLECTORS = []
+
+def labels_key(labels):
+    """
+    Get a hashable key of a dict of labels.
+    """
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """
+    Add value to a counter.
+    """
+    with _LOCK:
+        _COUNTERS[(name, labels_key(labels))] += value
+
+def observe(name, value, buckets=TIME_BUCKETS, **labels):
+    """
+    Record a value in a histogram, whose buckets are fixed by the first value recorded.
+    """
+    key = (name, labels_key(labels))
+    with _LOCK:
+        buckets = _BUCKETS.setdefault(name, buckets)
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = [0] * len(buckets) + [0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def record(stage, seconds):
+    """
+    Record the seconds a stage took in simdash_stage_seconds, and tell the listeners.
+    """
+    observe("simdash_stage_seconds", seconds, stage=stage)
+    for listener in _LISTENERS:
+        listener(stage, seconds)
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Context manager that records the seconds its block takes as a stage, see record.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+def add_listener(listener):
+    """
+    Call listener(stage, seconds) in the thread of every stage recorded.
+    """
+    _LISTENERS.append(listener)
+
+def add_collector(collector):
+    """
+    Add a function called whenever the metrics are rendered,
+    returning a list of (name, 'counter' or 'gauge', labels dict, value) tuples, such as the hits of a cache.
+    """
+    _COLLECTORS.append(collector)
+
+def reset():
+    """
+    Forget every value recorded.
+    """
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+        _BUCKETS.clear()
+
+def format_labels(labels, **extra):
+    """
+    Format labels, given as a key of labels_key, like {a="1",b="2"}.
+    """
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in items]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def format_value(value):
+    """
+    Format a sample value, whole numbers without a fraction.
+    """
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render():
+    """
+    Render every metric in the Prometheus text exposition format, labelled with the pid of this process.
+    """
+    process = (("pid", os.getpid()),)
+    with _LOCK:
+        counters = dict(_COUNTERS)
+        histograms = {key: list(values) for key, values in _HISTOGRAMS.items()}
+        buckets = dict(_BUCKETS)
+    families = collections.OrderedDict()
+    for (name, labels), value in sorted(counters.items()):
+        families.setdefault((name, "counter"), []).append(
+            f"{name}{format_labels(labels + process)} {format_value(value)}")
+    for collector in _COLLECTORS:
+        for name, kind, labels, value in collector():
+            families.setdefault((name, kind), []).append(
+                f"{name}{format_labels(labels_key(labels) + process)} {format_value(value)}")
+    for (name, labels), values in sorted(histograms.items()):
+        lines = families.setdefault((name, "histogram"), [])
+        labels += process
+        for bound, count in zip(buckets[name], values):
+            lines.append(f"{name}_bucket{format_labels(labels, le=format_value(bound))} {count}")
+        lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {values[-1]}')
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(values[-2])}")
+        lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+    text = []
+    for (name, kind), lines in families.items():
+        if name in HELP:
+            text.append(f"# HELP {name} {HELP[name]}")
+        text.append(f"# TYPE {name} {kind}")
+        text += lines
+    return "\n".join(text) + "\n"
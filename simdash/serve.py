@@ -1,17 +1,694 @@
 """
 SimDash server.
 """
+import collections
+import concurrent.futures
+import datetime
+import functools
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
 import click
-from flask import Flask, flash, render_template, request
+import logbook
+from flask import (Flask, abort, before_render_template, copy_current_request_context, flash, g, has_request_context,
+                   make_response, render_template, request, template_rendered, url_for)
+
+from . import cli_main, live, metrics, wsgi
+from .cache import ChartCache
+from .database import database, retention
+from .viz import chart_toml, datasets, viz
 
-from . import cli_main
-from .database import database
-from .viz import chart_toml, viz
+log = logbook.Logger(__name__)
 
 app = Flask(__name__)
 app.secret_key = b'_5#y2L"F4Q*z\n3xec]/'
 CONFIG_PATH = None
 DB_PATH = None
+# How often the pages poll /data/ for new rows, in milliseconds, when the browser can not follow /events/
+REFRESH_INTERVAL = 5000
+# Seconds between looks for new rows by the watcher of every server process, see live.Watcher
+WATCH_INTERVAL = 1.0
+# Seconds an /events/ stream stays open before the browser reconnects, every open stream holds a request thread
+STREAM_SECONDS = 30
+# Largest number of /events/ streams open at once in every server process, pages past it are answered with 503
+# and poll /data/ instead, so streams never take every request thread
+MAX_STREAMS = 4
+_STREAMS = 0
+_STREAMS_LOCK = threading.Lock()
+# Seconds between comments sent on idle /events/ streams, which notice closed connections
+KEEP_ALIVE = 15.0
+_WATCHER = None
+_WATCHER_PID = None
+_WATCHER_LOCK = threading.Lock()
+# Requests that take at least this many seconds are logged with the time of each stage, None logs none
+SLOW_REQUEST = None
+# Charts are downsampled to about this many points per series, None keeps every row
+MAX_POINTS = 2000
+DOWNSAMPLE_METHOD = "lttb"
+# Rendered charts, rebuilt only when their table changes
+CHART_CACHE = ChartCache()
+# Columnar chart datasets by name, see viz.datasets, kept apart from the specs that use them
+DATASET_CACHE = ChartCache()
+# Largest number of read-only connections of every server process
+POOL_SIZE = 8
+# Number of charts of a page built at the same time by every server process
+CHART_THREADS = 4
+# Seconds a page waits for each of its charts once it starts building, slower charts are shown as placeholders,
+# None waits forever
+CHART_TIMEOUT = 30.0
+# Number of processes the chart threads hand charts to, 0 builds them on the threads,
+# chart building mostly holds the GIL so processes let charts run in parallel
+CHART_PROCESSES = 0
+_CHART_EXECUTOR = None
+_CHART_EXECUTOR_PID = None
+_CHART_PROCESS_POOL = None
+_CHART_PROCESS_POOL_PID = None
+# Responses at least this large are gzipped for clients that accept it
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = {"text/html", "application/json"}
+# Gzipped bodies of responses with an ETag, keyed by the ETag
+COMPRESSED_CACHE = ChartCache(max_entries=64)
+
+def get_change_tokens(the_db, table_names):
+    """
+    Get the change token of each table, see Database.change_token.
+
+    The largest rowid of a token is where the chart starts polling /data/ from.
+    Tokens are read before the charts are built,
+    so rows that arrive while a page renders may be sent twice but are never missed.
+    PIDs of the long-format PID table get their tokens in one query, from the rows of the PID alone.
+    """
+    keys = {name: the_db.pid_key(name) for name in table_names}
+    pid_tokens = {}
+    if any(keys.values()):
+        pid_tokens = the_db.get_pid_table().change_tokens(key for key in keys.values() if key is not None)
+    return [pid_tokens[keys[name]] if keys[name] is not None else the_db.change_token(name)
+            for name in table_names]
+
+def get_watermark(the_db, token):
+    """
+    Get the rowid charts poll /data/ from out of a change token,
+    None for databases whose charts are refreshed with the page, see Database.streams_rows.
+    """
+    if not the_db.streams_rows:
+        return None
+    return token[1] or 0
+
+def get_max_rows(watermark, max_points, every_row=True):
+    """
+    Get the number of rows the browser can add new rows to a chart up to, see simdashLiveChart in live_update.html.
+
+    Charts the server does more to than add rows, such as downsampled charts, charts read from rollups,
+    and charts of a window or of aggregates, are fetched again from /chart/ when their table changes instead.
+    A chart of at most max_points rows, which its watermark tells, is neither downsampled nor read from rollups.
+
+    Args:
+        watermark: the chart's watermark, see get_watermark
+        max_points: number of points the chart is downsampled to, None to keep every row
+        every_row: whether the chart draws every row of its table
+    Returns:
+        The number of rows, 0 for charts fetched again, None for no limit
+    """
+    if watermark is None or not every_row:
+        return 0
+    if max_points is None:
+        return None
+    return max_points if watermark <= max_points else 0
+
+def get_last_modified():
+    """
+    Get the time the database or config file was last written to.
+
+    Writes in WAL mode go to the -wal file first, so its time is included as well.
+    A partitioned database, or the runs of a federated one, are written to through the files in the directory
+    or matching the glob.
+    """
+    mtimes = [0.0]
+    paths = [DB_PATH, f"{DB_PATH}-wal" if DB_PATH else None, CONFIG_PATH]
+    if DB_PATH is not None and os.path.isdir(DB_PATH):
+        paths += glob.glob(os.path.join(DB_PATH, "*.db*"))
+    elif DB_PATH is not None and glob.has_magic(DB_PATH):
+        paths += glob.glob(f"{DB_PATH}*")
+    for path in paths:
+        if path is not None and os.path.exists(path):
+            mtimes.append(os.path.getmtime(path))
+    return datetime.datetime.fromtimestamp(int(max(mtimes)), tz=datetime.timezone.utc)
+
+def conditional_response(parts, render):
+    """
+    Answer with 304 Not Modified if the client already has the current version of a response.
+
+    The ETag is a hash of everything the response depends on, such as table change tokens,
+    so render is only called when the response changed.
+
+    Args:
+        parts: JSON serializable list of what the response depends on
+        render: function with no arguments that returns the response body
+    """
+    parts = [request.path, request.query_string.decode(), REFRESH_INTERVAL, MAX_POINTS, DOWNSAMPLE_METHOD] + parts
+    etag = hashlib.sha1(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+    last_modified = get_last_modified()
+    if request.if_none_match:
+        # compress_response tags gzipped bodies with a -gz suffix
+        if request.if_none_match.contains(etag + "-gz"):
+            etag += "-gz"
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    response = make_response("", 304) if not_modified else make_response(render())
+    if g.get("incomplete_charts"):
+        # Placeholders of slow charts must not be answered with 304 later
+        response.cache_control.no_store = True
+        return response
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+@app.before_request
+def start_timer():
+    """
+    Note when a request started, and collect the seconds of its stages, see metrics.timed.
+    """
+    request.environ["simdash.start"] = time.perf_counter()
+    request.environ["simdash.stages"] = collections.Counter()
+
+def record_stage(stage, seconds):
+    """
+    Add the seconds of a stage to the request it is part of, chart threads share the request of their page.
+    """
+    if has_request_context():
+        stages = request.environ.get("simdash.stages")
+        if stages is not None:
+            stages[stage] += seconds
+
+def start_render(sender, template, context, **extra):
+    """
+    Note when a template starts rendering.
+    """
+    request.environ["simdash.render"] = time.perf_counter()
+
+def end_render(sender, template, context, **extra):
+    """
+    Record the seconds a template took to render as the 'render' stage.
+    """
+    start = request.environ.pop("simdash.render", None)
+    if start is not None:
+        metrics.record("render", time.perf_counter() - start)
+
+metrics.add_listener(record_stage)
+before_render_template.connect(start_render, app)
+template_rendered.connect(end_render, app)
+
+# Registered before compress_response, so it runs after it and sees the gzipped size
+@app.after_request
+def record_request(response):
+    """
+    Record the seconds a request took and the size of its response, logging requests slower than SLOW_REQUEST.
+
+    Streamed responses are timed until their first byte and their size is not known.
+    """
+    start = request.environ.get("simdash.start")
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    route = request.endpoint or "unknown"
+    metrics.observe("simdash_request_seconds", seconds, route=route, status=response.status_code)
+    if not response.is_streamed:
+        metrics.observe("simdash_response_bytes", response.calculate_content_length() or 0,
+                        buckets=metrics.SIZE_BUCKETS, route=route)
+    if SLOW_REQUEST is not None and seconds >= SLOW_REQUEST:
+        stages = ", ".join(f"{stage} {total:.3f}s" for stage, total in request.environ["simdash.stages"].most_common())
+        log.warning(f"Slow request {request.full_path} took {seconds:.3f}s: {stages or 'no stages timed'}")
+    return response
+
+@app.after_request
+def compress_response(response):
+    """
+    Gzip large HTML and JSON responses, such as pages with chart specs, for clients that accept it.
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or "gzip" not in request.headers.get("Accept-Encoding", "")
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    etag, _ = response.get_etag()
+    if etag is None:
+        compressed = gzip.compress(data, compresslevel=6)
+    else:
+        compressed = COMPRESSED_CACHE.get_or_build(etag, lambda: gzip.compress(data, compresslevel=6))
+        response.set_etag(etag + "-gz")
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+def cached_chart(key, token, build, page):
+    """
+    Get a chart from the chart cache, building it if its table changed since it was cached.
+
+    The chart's datasets are moved out of the spec into DATASET_CACHE, to be loaded from /dataset/.
+
+    Args:
+        key: tuple describing the chart
+        token: change token of the chart's table
+        build: function with no arguments that returns the chart JSON
+        page: name of the page the chart is on, for rebuild_page
+    Returns:
+        The chart JSON without its data
+    """
+    def build_split():
+        spec, payloads = datasets.split_datasets(build(), lambda name: url_for("display_dataset", name=name, page=page))
+        metrics.observe("simdash_chart_bytes", len(spec) + sum(len(payload) for payload in payloads.values()),
+                        buckets=metrics.SIZE_BUCKETS)
+        return spec, payloads
+    spec, payloads = CHART_CACHE.get_or_build((DB_PATH, MAX_POINTS, DOWNSAMPLE_METHOD, token) + key, build_split)
+    for name, payload in payloads.items():
+        DATASET_CACHE.put(name, payload)
+    return spec
+
+def get_chart_executor():
+    """
+    Get the thread pool of this process that builds charts, threads do not survive a fork.
+    """
+    global _CHART_EXECUTOR
+    global _CHART_EXECUTOR_PID
+    if _CHART_EXECUTOR is None or _CHART_EXECUTOR_PID != os.getpid():
+        _CHART_EXECUTOR = concurrent.futures.ThreadPoolExecutor(CHART_THREADS, thread_name_prefix="simdash-chart")
+        _CHART_EXECUTOR_PID = os.getpid()
+    return _CHART_EXECUTOR
+
+def read_rows_json(the_db, table_name, rowid=None, l_time=None):
+    """
+    Get the rows of a table, or of a PID of the long-format PID table, added after a rowid or logical time.
+
+    Returns:
+        A tuple containing (number of rows, rowid of the last row, JSON body with the table name,
+        the rowid, the name of the real time column and the rows with real time as ISO datetimes)
+    """
+    key = the_db.pid_key(table_name)
+    if key is not None:
+        dframe, rowid = the_db.get_pid_table().rows_since_pid(key, rowid=rowid, l_time=l_time)
+        r_column = "real_time"
+    else:
+        the_tab = the_db.get_table(table_name)
+        dframe, rowid = the_tab.rows_since(rowid=rowid, l_time=l_time)
+        r_column = the_tab.r_column_
+    rows = viz.rows_to_json(viz.convert_real_time(dframe, r_column))
+    body = '{"table": %s, "rowid": %d, "r_column": %s, "rows": %s}' % (
+        json.dumps(table_name), rowid, json.dumps(r_column), rows)
+    return len(dframe.index), rowid, body
+
+def read_new_rows(the_db, table_name, rowid):
+    """
+    Read the rows of a table after rowid for the watcher, see live.Watcher.
+    """
+    num_rows, rowid, body = read_rows_json(the_db, table_name, rowid=rowid)
+    return (body if num_rows else None), rowid
+
+def get_watcher():
+    """
+    Get the watcher of this process that pushes new rows to /events/ streams, threads do not survive a fork.
+    """
+    global _WATCHER
+    global _WATCHER_PID
+    with _WATCHER_LOCK:
+        if _WATCHER is None or _WATCHER_PID != os.getpid():
+            # A partitioned database is written to through its segments, its catalog's data_version rarely changes
+            _WATCHER = live.Watcher(functools.partial(database.pooled, DB_PATH, size=POOL_SIZE), read_new_rows,
+                                    WATCH_INTERVAL, data_version=not os.path.isdir(DB_PATH)).start()
+            _WATCHER_PID = os.getpid()
+        return _WATCHER
+
+def cache_metrics():
+    """
+    Get the hits, misses and sizes of the caches of this process, see metrics.add_collector.
+    """
+    samples = []
+    for name, cache in [("chart", CHART_CACHE), ("dataset", DATASET_CACHE), ("compressed", COMPRESSED_CACHE),
+                        ("template", chart_toml.TEMPLATES)]:
+        samples += [("simdash_cache_hits_total", "counter", {"cache": name}, cache.hits),
+                    ("simdash_cache_misses_total", "counter", {"cache": name}, cache.misses),
+                    ("simdash_cache_entries", "gauge", {"cache": name}, len(cache))]
+    if _WATCHER is not None and _WATCHER_PID == os.getpid():
+        samples.append(("simdash_event_streams", "gauge", {}, _WATCHER.subscriptions))
+    return samples
+
+metrics.add_collector(cache_metrics)
+
+def exit_with_parent(parent_pid):
+    """
+    Make a chart process exit once the server process that started it is gone,
+    server worker processes end with os._exit or a signal and do not shut their pools down.
+    """
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1.0)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+def get_chart_process_pool():
+    """
+    Get the process pool of this server process that builds charts.
+
+    Processes are spawned rather than forked, since forking a process with running threads is unsafe.
+    """
+    global _CHART_PROCESS_POOL
+    global _CHART_PROCESS_POOL_PID
+    if _CHART_PROCESS_POOL is None or _CHART_PROCESS_POOL_PID != os.getpid():
+        _CHART_PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(
+            CHART_PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+            initializer=exit_with_parent, initargs=(os.getpid(),))
+        _CHART_PROCESS_POOL_PID = os.getpid()
+    return _CHART_PROCESS_POOL
+
+def placeholder_chart(message):
+    """
+    Make a chart spec that only shows a message, in place of a chart that could not be built in time.
+    """
+    return json.dumps({
+        "data": {"values": [{"message": message}]},
+        "mark": {"type": "text", "fontSize": 14},
+        "encoding": {"text": {"field": "message", "type": "nominal"}},
+        "width": 650,
+        "height": 60,
+    })
+
+def run_chart(started, func, *args):
+    """
+    Record the time a chart starts running on a chart thread in the started list, then build it.
+    """
+    started.append(time.monotonic())
+    return func(*args)
+
+def wait_for_chart(future, started):
+    """
+    Wait for a chart until CHART_TIMEOUT seconds after it started running,
+    the time it waits for a chart thread behind the charts of other pages is not counted.
+
+    Args:
+        future: the Future of run_chart
+        started: the list run_chart records the start time in
+    Returns:
+        True if the chart is done
+    """
+    while not future.done():
+        if not started:
+            concurrent.futures.wait([future], timeout=0.05)
+            continue
+        remaining = None if CHART_TIMEOUT is None else started[0] + CHART_TIMEOUT - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return False
+        concurrent.futures.wait([future], timeout=remaining)
+    return True
+
+def build_charts(tasks):
+    """
+    Build the charts of a page on the chart threads.
+
+    Charts that are not built within CHART_TIMEOUT seconds of starting, or fail, are replaced by placeholders
+    and the page is not cached; slow charts carry on building into the chart cache for the next request.
+
+    Args:
+        tasks: list of the arguments of cached_chart for every chart
+    Returns:
+        A list of chart JSON, in the order of tasks
+    """
+    executor = get_chart_executor()
+    starts = [[] for _ in tasks]
+    futures = [executor.submit(copy_current_request_context(run_chart), started, cached_chart, *task)
+               for task, started in zip(tasks, starts)]
+    charts = []
+    for task, future, started in zip(tasks, futures, starts):
+        if not wait_for_chart(future, started) or isinstance(future.exception(), concurrent.futures.TimeoutError):
+            log.warning(f"Chart {task[0]} was not built within {CHART_TIMEOUT} seconds")
+            charts.append(placeholder_chart("This chart is still being built, reload the page to see it."))
+            g.incomplete_charts = True
+        elif future.exception() is not None:
+            log.error(f"Chart {task[0]} could not be built: {future.exception()!r}")
+            charts.append(placeholder_chart("This chart could not be built."))
+            g.incomplete_charts = True
+        else:
+            charts.append(future.result())
+    return charts
+
+def build_chart_json(db_path, pool_size, func, *args):
+    """
+    Call func with a read-only Database of its own, followed by args.
+
+    Charts are built on several threads or processes at once, so each one takes its own connection from the pool.
+
+    Args:
+        db_path: path to the database file
+        pool_size: size of the read-only pool, if this process does not have one yet
+        func: function that builds the chart JSON
+    """
+    with database.pooled(db_path, size=pool_size) as the_db:
+        return func(the_db, *args)
+
+def with_pooled_database(func, *args):
+    """
+    Build a chart JSON with build_chart_json, in a chart process if there are any.
+
+    A chart process that takes longer than CHART_TIMEOUT seconds carries on, but its chart is not cached.
+    """
+    if CHART_PROCESSES:
+        future = get_chart_process_pool().submit(build_chart_json, DB_PATH, POOL_SIZE, func, *args)
+        return future.result(timeout=CHART_TIMEOUT)
+    return build_chart_json(DB_PATH, POOL_SIZE, func, *args)
+
+def build_config_charts(tables, tokens):
+    """
+    Get the charts of the /displayconfig/ page, one per [[tab]] block.
+    """
+    return build_charts([(("config", json.dumps(table, sort_keys=True)), token, functools.partial(
+        with_pooled_database, chart_toml.create_toml_chart_without_encodings, table, MAX_POINTS, DOWNSAMPLE_METHOD),
+                          "config") for table, token in zip(tables, tokens)])
+
+def build_pid_charts(titles, tokens):
+    """
+    Get the charts of the /pid/ page, one per displayed PID.
+    """
+    return build_charts([(("pid", title), token, functools.partial(
+        with_pooled_database, viz.make_pid_chart, title, MAX_POINTS, DOWNSAMPLE_METHOD),
+                          "pid") for title, token in zip(titles, tokens)])
+
+def build_sys_chart(token):
+    """
+    Get the chart of the /sys_usage page.
+    """
+    return build_charts([(("sys",), token, functools.partial(
+        with_pooled_database, viz.get_system_charts, MAX_POINTS, DOWNSAMPLE_METHOD), "sys")])[0]
+
+def get_displayed_charts(the_db):
+    """
+    Get the names of the PID tables shown on the /pid/ page, which may be PIDs of the long-format PID table.
+    """
+    if not the_db.check_if_table_exists("displayed_charts"):
+        return []
+    return the_db.get_table("displayed_charts").to_pandas()['chart_name'].tolist()
+
+def rebuild_page(the_db, page):
+    """
+    Build the charts of a page, which puts their datasets in DATASET_CACHE.
+
+    A dataset can be requested from a server process that did not render the page it is on.
+
+    Args:
+        the_db: read-only Database
+        page: 'config', 'pid' or 'sys'
+    Returns:
+        The list of chart JSONs of the page, empty for an unknown page
+    """
+    if page == "config" and CONFIG_PATH is not None:
+        tables = chart_toml.load_config(CONFIG_PATH)['tab']
+        return build_config_charts(tables, get_change_tokens(the_db, [table['table_name'] for table in tables]))
+    if page == "pid":
+        titles = get_displayed_charts(the_db)
+        return build_pid_charts(titles, get_change_tokens(the_db, titles))
+    if page == "sys" and the_db.check_if_table_exists("sys_usage"):
+        return [build_sys_chart(the_db.change_token("sys_usage"))]
+    return []
+
+@app.route("/dataset/<name>")
+def display_dataset(name):
+    """
+    Return a chart dataset as columnar JSON, see viz.datasets.
+
+    Dataset names are hashes of their rows, so the responses never change and can be cached for good.
+    """
+    if request.if_none_match.contains(name) or request.if_none_match.contains(name + "-gz"):
+        response = make_response("", 304)
+    else:
+        payload = DATASET_CACHE.get(name)
+        if payload is None and DB_PATH is not None:
+            with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+                rebuild_page(the_db, request.args.get("page"))
+            payload = DATASET_CACHE.get(name)
+        if payload is None:
+            abort(404)
+        response = app.response_class(payload, mimetype="application/json")
+    response.set_etag(name)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/chart/<page>/<int:index>")
+def display_chart(page, index):
+    """
+    Return the spec of a chart of a page as it is now, for pages to fetch again the charts that their
+    table's new rows can not be added to, see get_max_rows.
+    """
+    if DB_PATH is None:
+        abort(404)
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        charts = rebuild_page(the_db, page)
+    if index >= len(charts):
+        abort(404)
+    response = app.response_class(charts[index], mimetype="application/json")
+    if g.get("incomplete_charts"):
+        response.cache_control.no_store = True
+    return response
+
+@app.route("/data/<table_name>")
+def display_rows_since(table_name):
+    """
+    Return the rows of a table added after the rowid or l_time query parameter as JSON.
+
+    The response holds the new rows, with real time as ISO datetimes like in the chart specs,
+    the name of the real time column and the rowid to pass in the next request.
+    """
+    if DB_PATH is None:
+        abort(404)
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        key = the_db.pid_key(table_name)
+        if key is not None and not the_db.get_pid_table().has_pid(key):
+            abort(404)
+        if key is None and not the_db.check_if_table_exists(table_name):
+            abort(404)
+
+        def render():
+            _, _, body = read_rows_json(the_db, table_name, rowid=request.args.get("rowid", type=int),
+                                        l_time=request.args.get("l_time", type=float))
+            return app.response_class(body, mimetype="application/json")
+        return conditional_response(get_change_tokens(the_db, [table_name]), render)
+
+def format_event(rowids, body):
+    """
+    Format rows as a Server-Sent Event, whose id holds the rowids the browser has every table up to.
+    """
+    return f"id: {json.dumps(rowids, sort_keys=True)}\nevent: rows\ndata: {body}\n\n"
+
+def open_stream():
+    """
+    Take one of the MAX_STREAMS /events/ streams of this process, to be given back with close_stream.
+
+    Returns:
+        False if every stream is taken
+    """
+    global _STREAMS
+    with _STREAMS_LOCK:
+        if _STREAMS >= MAX_STREAMS:
+            return False
+        _STREAMS += 1
+        return True
+
+def close_stream():
+    """
+    Give back a stream taken with open_stream.
+    """
+    global _STREAMS
+    with _STREAMS_LOCK:
+        _STREAMS -= 1
+
+def stream_rows(watcher, subscription):
+    """
+    Yield the events of an /events/ stream, starting with the rows the watcher read before the browser subscribed.
+
+    The stream ends after STREAM_SECONDS, or when the watcher drops it, and the browser reconnects from its
+    last event id.
+    """
+    try:
+        catch_up = watcher.catch_up(subscription)
+        if catch_up:
+            with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+                for table_name, rowid in catch_up.items():
+                    num_rows, rowid, body = read_rows_json(the_db, table_name, rowid=rowid)
+                    if num_rows:
+                        subscription.rowids[table_name] = rowid
+                        yield format_event(subscription.rowids, body)
+        deadline = time.monotonic() + STREAM_SECONDS
+        while not subscription.dropped and time.monotonic() < deadline:
+            try:
+                table_name, rowid, body = subscription.events.get(timeout=KEEP_ALIVE)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            # Rows the browser already has from the page or the catch up
+            if rowid <= subscription.rowids[table_name]:
+                continue
+            subscription.rowids[table_name] = rowid
+            yield format_event(subscription.rowids, body)
+    finally:
+        watcher.unsubscribe(subscription)
+
+@app.route("/metrics")
+def display_metrics():
+    """
+    Return the metrics of this server process in the Prometheus text format, see metrics.
+    """
+    return app.response_class(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/events/")
+def stream_events():
+    """
+    Push the new rows of tables to the browser as Server-Sent Events, see live.Watcher.
+
+    The table and rowid query parameters, repeated for every table, give the rowid the page has each table up to.
+    A reconnecting browser sends the id of the last event it got instead.
+    Past MAX_STREAMS open streams the answer is 503, and the page polls /data/ instead.
+    """
+    if DB_PATH is None:
+        abort(404)
+    if request.headers.get("Last-Event-ID"):
+        try:
+            rowids = {str(name): int(rowid) for name, rowid in json.loads(request.headers["Last-Event-ID"]).items()}
+        except (ValueError, TypeError, AttributeError):
+            abort(400)
+    else:
+        rowids = dict(zip(request.args.getlist("table"), request.args.getlist("rowid", type=int)))
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        if not the_db.streams_rows or not rowids:
+            abort(404)
+        for table_name in rowids:
+            key = the_db.pid_key(table_name)
+            if (not the_db.get_pid_table().has_pid(key) if key is not None
+                    else not the_db.check_if_table_exists(table_name)):
+                abort(404)
+    if not open_stream():
+        log.warning(f"Refused an /events/ stream, {MAX_STREAMS} are open")
+        abort(503)
+    watcher = get_watcher()
+    subscription = watcher.subscribe(rowids)
+    response = app.response_class(stream_rows(watcher, subscription), mimetype="text/event-stream")
+    # Also run when the stream is closed before it starts
+    response.call_on_close(lambda: watcher.unsubscribe(subscription))
+    response.call_on_close(close_stream)
+    response.cache_control.no_cache = True
+    # Keeps proxies from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 @app.route("/displayconfig/")
 def display_from_config():
@@ -20,9 +697,43 @@ def display_from_config():
     """
     if CONFIG_PATH is None:
         return render_template("no_config_child.html", on_config=True)
-    chart_list = chart_toml.create_toml_charts_without_encodings(DB_PATH, CONFIG_PATH)
-    num_list = list(range(len(chart_list)))
-    return render_template("config_child.html", on_config=True, chart_list=chart_list, chart_label_list=num_list)
+    tables = chart_toml.load_config(CONFIG_PATH)['tab']
+    table_names = [table['table_name'] for table in tables]
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        tokens = get_change_tokens(the_db, table_names)
+        watermarks = [get_watermark(the_db, token) for token in tokens]
+        max_rows = [get_max_rows(watermark, table.get('max_points', MAX_POINTS), chart_toml.draws_every_row(table))
+                    for table, watermark in zip(tables, watermarks)]
+
+        def render():
+            chart_list = build_config_charts(tables, tokens)
+            num_list = list(range(len(chart_list)))
+            return render_template("config_child.html", on_config=True, chart_list=chart_list,
+                                   chart_label_list=num_list, table_names=table_names, watermarks=watermarks,
+                                   max_rows=max_rows, refresh_interval=REFRESH_INTERVAL)
+        return conditional_response([tables, tokens], render)
+
+def update_displayed_charts(the_db, form):
+    """
+    Apply a form posted to /pid/ to the displayed_charts table.
+
+    Args:
+        the_db: writable Database
+        form: the posted form
+    """
+    chart_tab = the_db.get_table("displayed_charts")
+    if form.get('UserValue') is not None:
+        table_name = f"{form.get('UserValue')}pid{form.get('PIDValue')}"
+        key = the_db.pid_key(table_name)
+        if the_db.check_if_table_exists(table_name) or (key is not None and the_db.get_pid_table().has_pid(key)):
+            chart_tab.append(chart_name=table_name)
+        else:
+            flash("This PID does not exist!")
+    for item in form.getlist('chartcheck'):
+        with the_db.conn:
+            the_db.conn.execute('DELETE FROM displayed_charts WHERE chart_name = ?;', (item,))
+    if form.get('remove_all') is not None:
+        the_db.remove_table("displayed_charts")
 
 @app.route("/pid/", methods=['GET', 'POST'])
 def display_pids():
@@ -35,45 +746,30 @@ def display_pids():
     if DB_PATH is None:
         return render_template("no_pid_child.html")
 
-    the_db = database.Database(DB_PATH)
-    if not the_db.check_if_table_exists("displayed_charts"):
-        the_db.make_table("displayed_charts", ["l_time", "r_time", "chart_name"], ["FLOAT", "INT", "TEXT"],
-                          ["Q", "T", "N"])
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        chart_tab_exists = the_db.check_if_table_exists("displayed_charts")
+    if request.method == 'POST' or not chart_tab_exists:
+        with database.pooled(DB_PATH, readonly=False) as the_db:
+            if not the_db.check_if_table_exists("displayed_charts"):
+                the_db.make_table("displayed_charts", ["l_time", "r_time", "chart_name"], ["FLOAT", "INT", "TEXT"],
+                                  ["Q", "T", "N"])
+            if request.method == 'POST':
+                update_displayed_charts(the_db, request.form)
 
-    chart_tab = the_db.get_table("displayed_charts")
-    chart_dframe = chart_tab.to_pandas()
-    chart_label_list = chart_dframe['chart_name'].tolist()
-    chart_list = []
-    for title in chart_label_list:
-        chart_list.append(viz.make_pid_chart(DB_PATH, title))
-
-    if request.method == 'GET':
-        return render_template("pid_child.html", on_pids=True, chart_label_list=chart_label_list, chart_list=chart_list)
-    if request.form.get('UserValue') is not None:
-        user_value = request.form.get('UserValue')
-        pid_value = request.form.get('PIDValue')
-        table_name = f"{user_value}pid{pid_value}"
-        if the_db.check_if_table_exists(table_name):
-            chart_tab.append(chart_name=table_name)
-            chart_label_list.append(table_name)
-            chart_list.append(viz.make_pid_chart(DB_PATH, table_name))
-        else:
-            flash("This PID does not exist!")
-    if request.form.getlist('chartcheck') is not None:
-        for item in request.form.getlist('chartcheck'):
-            chart_list.pop(chart_label_list.index(item))
-            chart_label_list.remove(item)
-            with the_db.conn:
-                curs = the_db.conn.cursor()
-                sql = f'DELETE FROM displayed_charts WHERE chart_name="{item}"'
-                curs.execute(sql)
-
-    if request.form.get('remove_all') is not None:
-        chart_label_list = []
-        chart_list = []
-        the_db.remove_table("displayed_charts")
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        chart_label_list = get_displayed_charts(the_db)
+        tokens = get_change_tokens(the_db, chart_label_list)
+        watermarks = [get_watermark(the_db, token) for token in tokens]
+        max_rows = [get_max_rows(watermark, MAX_POINTS) for watermark in watermarks]
 
-    return render_template("pid_child.html", on_pids=True, chart_label_list=chart_label_list, chart_list=chart_list)
+        def render():
+            chart_list = build_pid_charts(chart_label_list, tokens)
+            return render_template("pid_child.html", on_pids=True, chart_label_list=chart_label_list,
+                                   chart_list=chart_list, watermarks=watermarks, max_rows=max_rows,
+                                   refresh_interval=REFRESH_INTERVAL)
+        if request.method == 'GET':
+            return conditional_response([chart_label_list, tokens], render)
+        return render()
 
 @app.route("/")
 def display_homepage():
@@ -94,11 +790,20 @@ def display_sys_usage():
     """
     Display system usage charts from the database file.
     """
-    try:
-        the_chart = viz.get_system_charts(DB_PATH)
-        return render_template("system_usage_child.html", the_chart=the_chart, on_sys_usage=True)
-    except ValueError:
+    if DB_PATH is None:
         return render_template("no_sys_usage_chart.html", on_sys_usage=True)
+    with database.pooled(DB_PATH, size=POOL_SIZE) as the_db:
+        if not the_db.check_if_table_exists("sys_usage"):
+            return render_template("no_sys_usage_chart.html", on_sys_usage=True)
+        token = the_db.change_token("sys_usage")
+        watermark = get_watermark(the_db, token)
+        max_rows = get_max_rows(watermark, MAX_POINTS)
+
+        def render():
+            the_chart = build_sys_chart(token)
+            return render_template("system_usage_child.html", the_chart=the_chart, on_sys_usage=True,
+                                   watermark=watermark, max_rows=max_rows, refresh_interval=REFRESH_INTERVAL)
+        return conditional_response([token], render)
 
 @cli_main.command()
 @click.option("-h", "--host", default="localhost",
@@ -106,13 +811,70 @@ def display_sys_usage():
 @click.option("-p", "--port", default=8888,
               help="Port to bind to.")
 @click.option("-c", "--config", help="Path to config file")
-@click.option("-d", "--database1", help="Path to database file")
-def serve(host, port, config, database1):
+@click.option("-d", "--database1",
+              help="Path to database file, or a directory or quoted glob of the database files of many runs.")
+@click.option("--max-points", default=MAX_POINTS, show_default=True,
+              help="Downsample charts to about this many points per series, 0 to keep every row.")
+@click.option("--downsample", default=DOWNSAMPLE_METHOD, show_default=True, type=click.Choice(["lttb", "minmax"]),
+              help="Downsampling method, minmax keeps every spike.")
+@click.option("--cache-size", default=256, show_default=True,
+              help="Number of rendered charts to keep in memory, 0 disables the cache.")
+@click.option("--chart-threads", default=CHART_THREADS, show_default=True,
+              help="Number of charts of a page built at the same time.")
+@click.option("--chart-processes", default=CHART_PROCESSES, show_default=True,
+              help="Number of processes of every server process that build charts, 0 builds them on the threads.")
+@click.option("--chart-timeout", default=CHART_TIMEOUT, show_default=True,
+              help="Seconds a chart may build for before showing a placeholder, 0 waits forever.")
+@click.option("--prune-interval", default=0.0, show_default=True,
+              help="Seconds between prunes of the tables with a retention policy, 0 never prunes; "
+                   "leave it to simdash ingest or simdash prune when they write to the database.")
+@click.option("--workers", default=1, show_default=True,
+              help="Number of server processes, /metrics only covers the process answering it unless this is 1.")
+@click.option("--threads", default=8, show_default=True, help="Number of request threads of every process.")
+@click.option("--watch-interval", default=WATCH_INTERVAL, show_default=True,
+              help="Seconds between looks for new rows to push to the browsers.")
+@click.option("--max-streams", default=0, show_default=True,
+              help="Largest number of pages pushed new rows at once by every process, 0 for half the threads; "
+                   "other pages poll for them.")
+@click.option("--slow-request", default=0.0, show_default=True,
+              help="Log requests taking at least this many seconds with the time of each stage, 0 logs none.")
+@click.option("--debug", is_flag=True, help="Run Flask's single process debug server with the reloader.")
+def serve(host, port, config, database1, max_points, downsample, cache_size, chart_threads, chart_processes,
+          chart_timeout, prune_interval, workers, threads, watch_interval, max_streams, slow_request, debug):
     """
     Start the local simdash server.
     """
     global DB_PATH
     global CONFIG_PATH
+    global MAX_POINTS
+    global DOWNSAMPLE_METHOD
+    global POOL_SIZE
+    global CHART_THREADS
+    global CHART_PROCESSES
+    global CHART_TIMEOUT
+    global WATCH_INTERVAL
+    global MAX_STREAMS
+    global SLOW_REQUEST
     DB_PATH = database1
     CONFIG_PATH = config
-    app.run(host=host, port=port, debug=True)
+    MAX_POINTS = max_points or None
+    DOWNSAMPLE_METHOD = downsample
+    CHART_CACHE.max_entries = cache_size
+    CHART_THREADS = chart_threads
+    CHART_PROCESSES = chart_processes
+    CHART_TIMEOUT = chart_timeout or None
+    WATCH_INTERVAL = watch_interval
+    MAX_STREAMS = max_streams or max(1, threads // 2)
+    SLOW_REQUEST = slow_request or None
+    # Every request thread and chart thread can hold a connection at the same time, and the watcher holds one
+    POOL_SIZE = threads + chart_threads + 1
+    if DB_PATH is not None:
+        # Create the meta table and run migrations before the read-only connections open the file
+        database.get_database(DB_PATH)
+        if prune_interval > 0:
+            # Runs in this process only, which outlives the workers
+            retention.Pruner(DB_PATH, prune_interval).start()
+    if debug:
+        app.run(host=host, port=port, debug=True)
+    else:
+        wsgi.run(app, host, port, workers=workers, threads=threads)
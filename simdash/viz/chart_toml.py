@@ -1,62 +1,368 @@
 """
 Render charts from a toml config file.
+
+Config files are parsed again only when they change on disk, and every [[tab]] block is compiled once
+into a ChartTemplate, which holds the chart spec with the encodings resolved,
+so rendering a chart only reads its rows and puts them in the spec.
 """
-import datetime
+import copy
+import json
+import numbers
+import os
+import re
+import threading
 
 import altair as alt
+import pandas as pd
 import toml
 
+from .. import metrics
+from ..cache import ChartCache
 from ..database import database
+from .datasets import dataset_name
+from .downsample import downsample
+from .viz import convert_real_time, read_downsampled
+
+# Field of an Altair shorthand such as "a", "a:Q" or "mean(a):Q"
+SHORTHAND = re.compile(r"^\s*(?:\w+\()?\s*([^():]*?)\s*\)?\s*(?::\w+)?\s*$")
+
+# Parsed config files keyed by path, with the modification time and size they were parsed at
+_CONFIGS = {}
+_CONFIGS_LOCK = threading.Lock()
+# Compiled [[tab]] blocks, see compile_chart
+TEMPLATES = ChartCache(max_entries=256)
+
+def load_config(config_file):
+    """
+    Load a toml config file, parsed again only when its modification time or size changes.
+
+    The parsed config is shared by every caller and must not be changed.
+
+    Args:
+        config_file: String of path to configuration file
+    Returns:
+        The parsed config as a dictionary
+    """
+    stat = os.stat(config_file)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _CONFIGS_LOCK:
+        cached = _CONFIGS.get(config_file)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    with open(config_file, 'r', encoding='utf-8') as tfile:
+        config = toml.load(tfile)
+    with _CONFIGS_LOCK:
+        _CONFIGS[config_file] = (signature, config)
+    return config
+
+class ChartTemplate:
+    """
+    A [[tab]] block of a toml config compiled for the columns of its table.
+
+    The x and y encodings get the Altair types of their columns' vtypes.
+    The spec of the chart is built by Altair, and validated, the first time rows with new dtypes are rendered,
+    later renders put the rows in a copy of it.
+
+    Attributes:
+        table: the [[tab]] block
+        encode: the encodings, with the types of x and y
+    """
+    def __init__(self, table, columns, vtypes):
+        """
+        Args:
+            table: the [[tab]] block of the config
+            columns, vtypes: the columns of the table and their Altair variable types
+        Raises:
+            ValueError: if x or y is not a column of the table
+        """
+        self.table = table
+        self.encode = dict(table['encode'])
+        for channel in ('x', 'y'):
+            self.encode[channel] = f"{self.encode[channel]}:{vtypes[columns.index(self.encode[channel])]}"
+        # Specs without data keyed by the column names and dtypes of the rows they were built from
+        self.specs_ = {}
+        self.lock_ = threading.Lock()
+
+    def spec(self, dframe):
+        """
+        Get the spec of the chart without its data for rows like dframe's, building it with Altair if needed.
+        """
+        key = tuple((column, str(dtype)) for column, dtype in dframe.dtypes.items())
+        with self.lock_:
+            spec = self.specs_.get(key)
+        if spec is None:
+            # Types of encodings without one are inferred from the rows by Altair
+            chart = getattr(alt.Chart(dframe), "mark_%s" % self.table['mark'])().encode(**self.encode)
+            spec = chart.to_dict()
+            spec.pop('data', None)
+            spec.pop('datasets', None)
+            with self.lock_:
+                self.specs_[key] = spec
+        return spec
+
+    def to_json(self, dframe):
+        """
+        Render the chart of the rows of dframe, as Altair's to_json would.
+        """
+        with metrics.timed("serialize"):
+            values = alt.data_transformers.get()(dframe)['values']
+            name = dataset_name(values)
+            spec = copy.copy(self.spec(dframe))
+            spec['data'] = {'name': name}
+            spec['datasets'] = {name: values}
+            return json.dumps(spec, indent=2, sort_keys=True)
+
+def compile_chart(table, columns, vtypes):
+    """
+    Get the ChartTemplate of a [[tab]] block for a table with these columns, compiled once per process.
+    """
+    key = (json.dumps(table, sort_keys=True, default=str), tuple(columns), tuple(vtypes))
+    return TEMPLATES.get_or_build(key, lambda: ChartTemplate(table, list(columns), list(vtypes)))
+
+def encoding_field(value):
+    """
+    Get the column an encoding refers to.
+
+    Args:
+        value: an encoding of a [tab.encode] block, an Altair shorthand string or a dict with a field
+    Returns:
+        The column name, None if the encoding does not refer to one
+    """
+    if isinstance(value, dict):
+        value = value.get('field', value.get('shorthand'))
+    if not isinstance(value, str):
+        return None
+    match = SHORTHAND.match(value)
+    return match.group(1) if match and match.group(1) else None
+
+def encoded_columns(table, columns):
+    """
+    Get the columns of a table that the encodings of a [[tab]] block refer to, in table order.
+
+    Args:
+        table: the [[tab]] block of the config
+        columns: the columns of the table
+    """
+    fields = set()
+    for value in table.get('encode', {}).values():
+        for item in value if isinstance(value, list) else [value]:
+            fields.add(encoding_field(item))
+    return [column for column in columns if column in fields]
+
+def aggregates_for_chart(table, the_tab):
+    """
+    Get the SQL aggregation a [[tab]] block asks for.
 
-def create_all_charts_from_toml(db_file, config_file):
+    The key aggregate is a function (mean, sum, min, max or count) applied to the y column,
+    or a table mapping columns to functions.
+    The key bin groups the x column into bins of that width,
+    a duration such as "5min" when x is the real time column.
+    The key group_by lists the other columns to group on,
+    by default every other encoded column is grouped on.
+
+    Args:
+        table: the [[tab]] block of the config
+        the_tab: the Table the chart is drawn from
+    Returns:
+        None if the block does not aggregate, otherwise a dict of keyword arguments for Table.aggregate
+    """
+    if is_streamed(table):
+        return None
+    encode = table['encode']
+    x_column = encoding_field(encode.get('x'))
+    aggregates = table.get('aggregate', 'mean')
+    if isinstance(aggregates, str):
+        aggregates = {encoding_field(encode.get('y')): aggregates}
+    else:
+        aggregates = dict(aggregates)
+
+    bin_column = None
+    bin_step = table.get('bin')
+    if bin_step is not None:
+        bin_column = x_column
+        if not isinstance(bin_step, numbers.Number):
+            bin_step = pd.Timedelta(bin_step).total_seconds()
+
+    group_by = table.get('group_by')
+    if group_by is None:
+        group_by = [column for column in encoded_columns(table, the_tab.columns) if column not in aggregates]
+    elif x_column not in group_by and bin_column is None:
+        group_by = [x_column] + list(group_by)
+    return {"aggregates": aggregates, "group_by": group_by, "bin_column": bin_column, "bin_step": bin_step}
+
+def is_streamed(table):
+    """
+    Whether the chart of a [[tab]] block draws rows of the table rather than aggregates of them,
+    which is not the case for aggregated charts.
+    """
+    return 'aggregate' not in table and 'bin' not in table
+
+def draws_every_row(table):
+    """
+    Whether the chart of a [[tab]] block draws every row of the table, so new rows can be added to it in the browser,
+    which is not the case for aggregated charts or charts of a rolling window or of the last rows.
+    """
+    return is_streamed(table) and 'window' not in table and 'limit' not in table
+
+def window_for_chart(the_tab, table):
+    """
+    Get the start of the rolling window of a [[tab]] block, see read_for_chart.
+
+    Returns:
+        A tuple containing (start time or None, 'logical' or 'real')
+    """
+    window = table.get('window')
+    if window is None:
+        return None, "logical"
+    by = "logical" if isinstance(window, numbers.Number) else "real"
+    end = the_tab.time_range(by)[1]
+    if end is None:
+        return None, by
+    width = window if by == "logical" else pd.Timedelta(window).total_seconds()
+    return end - width, by
+
+def columns_for_chart(the_tab, table):
+    """
+    Get the time columns and the columns the encodings of a [[tab]] block refer to.
+    """
+    columns = [the_tab.l_column_, the_tab.r_column_]
+    return columns + [column for column in encoded_columns(table, the_tab.columns) if column not in columns]
+
+def read_for_chart(the_tab, table):
+    """
+    Read the rows of a table that a chart draws.
+
+    Only the time columns and the columns the encodings refer to are read.
+    The [[tab]] key window limits the rows to a rolling window ending at the newest row:
+    a string such as "2 hours" or "30min" is a real time window,
+    a number is a window of logical time.
+    The key limit keeps only the last limit rows.
+    Charts with the keys of aggregates_for_chart are aggregated in SQL,
+    the window applies to the rows aggregated and limit to the groups returned.
+
+    Args:
+        the_tab: the Table to read from
+        table: the [[tab]] block of the config
+    Returns:
+        pandas DataFrame
+    """
+    start, by = window_for_chart(the_tab, table)
+    limit = table.get('limit')
+    aggregation = aggregates_for_chart(table, the_tab)
+    if aggregation is not None:
+        return the_tab.aggregate(start=start, limit=limit, by=by, **aggregation)
+    return the_tab.to_pandas(start=start, columns=columns_for_chart(the_tab, table), limit=limit, by=by)
+
+def downsample_for_chart(dframe, table, the_tab, max_points=None, method="lttb"):
+    """
+    Downsample the rows of a table to the number of points a chart can draw.
+
+    The [[tab]] keys max_points and downsample ('lttb' or 'minmax') override the defaults.
+    Rows are selected along the encoded x column if it is numeric, otherwise along logical time,
+    aggregated rows without either are kept as they are.
+
+    Args:
+        dframe: pandas DataFrame read from the_tab, before real time conversion
+        table: the [[tab]] block of the config
+        the_tab: the Table the rows were read from
+        max_points: default target number of points, None to keep every row
+        method: default downsampling method
+    Returns:
+        The downsampled DataFrame
+    """
+    max_points = table.get('max_points', max_points)
+    method = table.get('downsample', method)
+    fields = encoded_columns(table, dframe.columns)
+    x_column = encoding_field(table['encode'].get('x'))
+    if x_column not in fields or dframe[x_column].dtype.kind not in "iuf":
+        x_column = the_tab.l_column_
+    if x_column not in dframe.columns:
+        return dframe
+    return downsample(dframe, x_column, fields, max_points, method, the_tab.run_column_)
+
+def read_downsampled_for_chart(the_tab, table, max_points=None, method="lttb"):
+    """
+    Read and downsample the rows a chart draws, like downsample_for_chart(read_for_chart(...)).
+
+    Rows that are downsampled without a limit are read in chunks, so large tables are never held in memory at once.
+
+    Args:
+        the_tab: the Table to read from
+        table: the [[tab]] block of the config
+        max_points: default target number of points, None to keep every row
+        method: default downsampling method
+    Returns:
+        The downsampled DataFrame
+    """
+    max_points = table.get('max_points', max_points)
+    method = table.get('downsample', method)
+    if max_points is None or 'limit' in table or not is_streamed(table):
+        return downsample_for_chart(read_for_chart(the_tab, table), table, the_tab, max_points, method)
+    start, by = window_for_chart(the_tab, table)
+    columns = columns_for_chart(the_tab, table)
+    x_column = encoding_field(table['encode'].get('x'))
+    if x_column not in columns or the_tab.vtypes[the_tab.columns.index(x_column)] not in ("Q", "T"):
+        x_column = the_tab.l_column_
+    return read_downsampled(the_tab, x_column, encoded_columns(table, columns), max_points, method,
+                            columns=columns, start=start, by=by)
+
+def create_all_charts_from_toml(db_file, config_file, max_points=None, method="lttb"):
     """
     Create Altair charts from a database and toml config file.
     Args:
-        db_file: String of path to database file
+        db_file: String of path to database file, or an open Database
         config_file: String of path to configuration file
+        max_points: default number of points to downsample each chart to, None to keep every row
+        method: default downsampling method, 'lttb' or 'minmax'
     Returns:
         chart_list: A list of altair chart objects converted to json
     """
     chart_list = []
-    dbase = database.Database(db_file)
-    with open(config_file, 'r', encoding='utf-8') as tfile:
-        master_dict = toml.load(tfile)
+    dbase = database.get_database(db_file)
+    master_dict = load_config(config_file)
 
     for table in master_dict['tab']:
         current_table = dbase.get_table(table['table_name'])
-        dframe = current_table.to_pandas()
-        dframe.iloc[:, 1] = dframe.iloc[:, 1].map(lambda x: datetime.datetime.fromtimestamp(x))
+        dframe = read_downsampled_for_chart(current_table, table, max_points, method)
+        if current_table.r_column_ in dframe.columns:
+            dframe = convert_real_time(dframe, current_table.r_column_)
         the_chart = alt.Chart(dframe)
         marked_chart = getattr(the_chart, "mark_%s" %table['mark'])()
         encoding_dict = table['encode']
         encoded_chart = marked_chart.encode(**encoding_dict).properties(width=650, height=400)
-        chart_list.append(encoded_chart.to_json())
+        with metrics.timed("serialize"):
+            chart_list.append(encoded_chart.to_json())
     return chart_list
 
-def create_toml_charts_without_encodings(db_file, config_file):
+def create_toml_chart_without_encodings(dbase, table, max_points=None, method="lttb"):
+    """
+    Create one Altair Chart from a [[tab]] block of a toml config file where encodings aren't specified.
+    Args:
+        dbase: the Database to read from
+        table: the [[tab]] block of the config
+        max_points: default number of points to downsample the chart to, None to keep every row
+        method: default downsampling method, 'lttb' or 'minmax'
+    Returns:
+        The Altair chart object converted to json
+    """
+    current_table = dbase.get_table(table['table_name'])
+    template = compile_chart(table, current_table.columns, current_table.vtypes)
+    dframe = read_downsampled_for_chart(current_table, table, max_points, method)
+    if current_table.r_column_ in dframe.columns:
+        dframe = convert_real_time(dframe, current_table.r_column_)
+    return template.to_json(dframe)
+
+def create_toml_charts_without_encodings(db_file, config_file, max_points=None, method="lttb"):
     """
     Create Altair Charts from a database and toml config file where encodings aren't specified.
     Args:
-        db_file: path to database file
+        db_file: path to database file, or an open Database
         config_file: path to Toml config file
+        max_points: default number of points to downsample each chart to, None to keep every row
+        method: default downsampling method, 'lttb' or 'minmax'
     Returns:
         chart_list: a list of Altair chart objects converted to json
     """
-    chart_list = []
-    dbase = database.Database(db_file)
-    with open(config_file, 'r', encoding='utf-8') as tfile:
-        master_dict = toml.load(tfile)
-
-    for table in master_dict['tab']:
-        current_table=dbase.get_table(table['table_name'])
-        dframe = current_table.to_pandas()
-        dframe.iloc[:, 1] = dframe.iloc[:, 1].map(lambda x: datetime.datetime.fromtimestamp(x))
-        cols_vtypes_tup = dbase.get_table_cols_and_vtypes(table['table_name'])
-        the_chart = alt.Chart(dframe)
-        marked_chart = getattr(the_chart, "mark_%s" %table['mark'])()
-        encoding_dict = table['encode']
-        encoding_dict['x'] = f"{encoding_dict['x']}:{cols_vtypes_tup[1][cols_vtypes_tup[0].index(encoding_dict['x'])]}"
-        encoding_dict['y'] = f"{encoding_dict['y']}:{cols_vtypes_tup[1][cols_vtypes_tup[0].index(encoding_dict['y'])]}"
-        encoded_chart = marked_chart.encode(**encoding_dict)
-        chart_list.append(encoded_chart.to_json())
-    return chart_list
+    dbase = database.get_database(db_file)
+    master_dict = load_config(config_file)
+    return [create_toml_chart_without_encodings(dbase, table, max_points, method) for table in master_dict['tab']]
@@ -0,0 +1,80 @@
+"""
+Move the data of chart specs out into compact columnar datasets that pages load by URL.
+
+Altair inlines every row of a chart as a JSON object under the spec's named datasets,
+repeating every column name in every row.
+The datasets are taken out of the spec and sent as one array per column instead.
+Altair names datasets after a hash of their rows,
+so a dataset shared by several charts is only sent once and never changes under its name.
+"""
+import hashlib
+import json
+
+def dataset_name(values):
+    """
+    Name the rows of a dataset after a hash of them, like Altair does.
+
+    Args:
+        values: list of row dicts
+    """
+    values_json = json.dumps(values, sort_keys=True, default=str)
+    return "data-" + hashlib.sha256(values_json.encode()).hexdigest()[:32]
+
+def temporal_fields(spec):
+    """
+    Get the fields that a Vega-Lite spec encodes as temporal.
+
+    Args:
+        spec: a parsed Vega-Lite spec, including concatenated and layered charts
+    Returns:
+        A set of field names
+    """
+    fields = set()
+    if isinstance(spec, dict):
+        if spec.get("type") == "temporal" and isinstance(spec.get("field"), str):
+            fields.add(spec["field"])
+        for value in spec.values():
+            fields |= temporal_fields(value)
+    elif isinstance(spec, list):
+        for value in spec:
+            fields |= temporal_fields(value)
+    return fields
+
+def columnar_json(rows):
+    """
+    Serialize the rows of a dataset as one array per column.
+
+    Args:
+        rows: list of row dicts, as in the datasets of a spec
+    Returns:
+        A JSON string of {"length": number of rows, "columns": {name: [values]}}
+    """
+    names = list(rows[0]) if rows else []
+    for row in rows:
+        if len(row) != len(names):
+            names += [name for name in row if name not in names]
+    columns = {name: [row.get(name) for row in rows] for name in names}
+    return json.dumps({"length": len(rows), "columns": columns}, separators=(",", ":"))
+
+def split_datasets(chart_json, dataset_url):
+    """
+    Take the datasets out of a chart spec.
+
+    The datasets are left empty in the spec, their URLs are listed under usermeta.simdashDatasets
+    and the temporal fields, which the page turns into dates, under usermeta.simdashTemporal.
+    live_update.html loads the datasets from there.
+
+    Args:
+        chart_json: the chart spec as JSON, as returned by Altair's to_json
+        dataset_url: function that returns the URL of a dataset from its name
+    Returns:
+        A tuple containing (the spec as compact JSON, dict mapping dataset names to columnar_json payloads)
+    """
+    spec = json.loads(chart_json)
+    datasets = spec.get("datasets", {})
+    payloads = {name: columnar_json(rows) for name, rows in datasets.items()}
+    usermeta = spec.setdefault("usermeta", {})
+    usermeta["simdashDatasets"] = {name: dataset_url(name) for name in datasets}
+    usermeta["simdashTemporal"] = sorted(temporal_fields(spec))
+    spec["datasets"] = {name: [] for name in datasets}
+    return json.dumps(spec, separators=(",", ":")), payloads
@@ -0,0 +1,161 @@
+"""
+Reduce large time series to a target number of points before they are charted.
+
+Two methods are available:
+    lttb: Largest-Triangle-Three-Buckets, keeps the points that best preserve the visual shape
+    minmax: keeps the smallest and largest value of every bucket, so no spike is ever dropped
+"""
+import numpy as np
+import pandas as pd
+
+from .. import metrics
+
+METHODS = ("lttb", "minmax")
+
+def lttb_indices(x, y, threshold):
+    """
+    Select the indices of the points kept by Largest-Triangle-Three-Buckets.
+
+    Args:
+        x: 1-d array of x values, sorted in increasing order
+        y: 1-d array of y values
+        threshold: number of points to keep
+    Returns:
+        Sorted array of the indices of the selected points
+    """
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+    x = np.asarray(x, dtype=float)
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+
+    # The first and last points are always kept, the rest is split into threshold - 2 buckets
+    edges = np.linspace(1, length - 1, threshold - 1).astype(int)
+    starts = edges[:-1]
+    ends = edges[1:]
+
+    # The average point of every bucket, used as the third corner of the triangle
+    csum_x = np.concatenate(([0.0], np.cumsum(x)))
+    csum_y = np.concatenate(([0.0], np.cumsum(y)))
+    next_starts = np.append(starts[1:], length - 1)
+    next_ends = np.append(ends[1:], length)
+    avg_x = (csum_x[next_ends] - csum_x[next_starts]) / (next_ends - next_starts)
+    avg_y = (csum_y[next_ends] - csum_y[next_starts]) / (next_ends - next_starts)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+    prev = 0
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        area = np.abs((x[prev] - avg_x[i]) * (y[start:end] - y[prev])
+                      - (x[prev] - x[start:end]) * (avg_y[i] - y[prev]))
+        prev = start + int(np.argmax(area))
+        selected[i + 1] = prev
+    return selected
+
+def minmax_indices(y, threshold):
+    """
+    Select the indices of the smallest and largest value of every bucket.
+
+    Args:
+        y: 1-d array of y values
+        threshold: number of points to keep, two points are kept per bucket
+    Returns:
+        Sorted array of the indices of the selected points
+    """
+    length = len(y)
+    num_buckets = threshold // 2
+    if threshold >= length or num_buckets < 1:
+        return np.arange(length)
+    y = np.asarray(y, dtype=float)
+
+    # Pad to equal sized buckets, with padding and NaN never picked as an extreme
+    size = -(-length // num_buckets)
+    padded = np.full(size * (-(-length // size)), np.inf)
+    padded[:length] = np.where(np.isnan(y), np.inf, y)
+    lows = padded.reshape(-1, size).argmin(axis=1)
+    padded[:length] = np.where(np.isnan(y), -np.inf, y)
+    padded[length:] = -np.inf
+    highs = padded.reshape(-1, size).argmax(axis=1)
+
+    offsets = np.arange(len(lows)) * size
+    selected = np.concatenate((offsets + lows, offsets + highs, [0, length - 1]))
+    return np.unique(np.minimum(selected, length - 1))
+
+def downsample(dframe, x_column, y_columns, threshold, method="lttb", series_column=None):
+    """
+    Reduce a DataFrame to about threshold rows for every y column.
+
+    The points selected for each numeric y column are combined,
+    so every column keeps its own shape in charts that draw several columns.
+
+    Args:
+        dframe: pandas DataFrame, with a numeric x column
+        x_column: name of the column used as x
+        y_columns: names of the columns that will be drawn
+        threshold: target number of points per y column, None to keep every row
+        method: one of 'lttb' or 'minmax'
+        series_column: column whose values are separate series, such as the runs of a federated table,
+            every series is reduced to threshold rows on its own
+    Returns:
+        A DataFrame with the selected rows, in x order within every series
+    """
+    if method not in METHODS:
+        raise ValueError("downsample method %s is not known, must be one of %s" % (method, METHODS))
+    if threshold is None or len(dframe.index) <= threshold:
+        return dframe
+    if series_column is not None and series_column in dframe.columns and dframe[series_column].nunique() > 1:
+        return pd.concat([downsample(series, x_column, y_columns, threshold, method)
+                          for _, series in dframe.groupby(series_column, sort=False)], ignore_index=True)
+
+    with metrics.timed("downsample"):
+        x = dframe[x_column].to_numpy(dtype=float)
+        order = None
+        if np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind="stable")
+            x = x[order]
+
+        selected = []
+        for column in y_columns:
+            if column == x_column or dframe[column].dtype.kind not in "iufb":
+                continue
+            y = dframe[column].to_numpy(dtype=float)
+            if order is not None:
+                y = y[order]
+            if method == "lttb":
+                selected.append(lttb_indices(x, y, threshold))
+            else:
+                selected.append(minmax_indices(y, threshold))
+        if not selected:
+            selected.append(np.linspace(0, len(x) - 1, threshold).astype(int))
+
+        indices = np.unique(np.concatenate(selected))
+        if order is not None:
+            indices = order[indices]
+        return dframe.iloc[indices].reset_index(drop=True)
+
+def downsample_chunks(chunks, x_column, y_columns, threshold, method="lttb", num_rows=None, series_column=None):
+    """
+    Downsample DataFrame chunks of a series without holding more than one chunk at a time.
+
+    Every chunk is reduced to its share of threshold, by the number of rows it holds out of num_rows,
+    and the reduced chunks are downsampled once more to threshold.
+    minmax keeps every extreme this way, lttb picks its points among the ones kept from every chunk.
+
+    Args:
+        chunks: iterable of pandas DataFrames, such as Table.iter_chunks
+        x_column, y_columns, threshold, method, series_column: as in downsample
+        num_rows: total number of rows of the chunks, chunks are reduced to threshold rows each if None
+    Returns:
+        A DataFrame with the selected rows, in x order, None if there were no chunks
+    """
+    reduced = []
+    for chunk in chunks:
+        share = threshold
+        if threshold is not None and num_rows:
+            # minmax keeps two points per bucket and lttb needs three to keep any
+            share = max(-(-threshold * len(chunk.index) // num_rows), 4)
+        reduced.append(downsample(chunk, x_column, y_columns, share, method, series_column))
+    if not reduced:
+        return None
+    return downsample(pd.concat(reduced, ignore_index=True), x_column, y_columns, threshold, method, series_column)
@@ -1,63 +1,179 @@
 """
 The visualization interface for creating charts from a database.
 """
-import datetime
-
 import altair as alt
 import pandas as pd
 
+from .. import metrics
 from ..database import database
+from ..database.pids import PID_TABLE, USAGE_COLUMNS
+from ..database.table import epoch_to_datetime64
+from .downsample import downsample, downsample_chunks
 
-def make_pid_chart(db_name, table_name):
+def convert_real_time(dframe, column="real_time"):
     """
-    Return a CPU and memory chart directly from a getpid database.
+    Convert the real time column of a DataFrame from timestamps to local datetimes in place.
 
     Args:
-        db_name: path to database file
-        table_name: name of table within database file to create a PID chart from
+        dframe: pandas DataFrame read from a Table
+        column: name of the real time column
+    Returns:
+        The same DataFrame
     """
-    the_db = database.Database(db_name)
-    the_tab = the_db.get_table(table_name)
-    dframe = the_tab.to_pandas()
-    dframe.iloc[:, 1] = dframe.iloc[:, 1].map(lambda x: datetime.datetime.fromtimestamp(x))
-    columns = list(dframe.columns)
-    dframe2 = dframe.melt(id_vars=[columns[0], columns[1]], var_name='usage', value_name='percent')
+    dframe[column] = epoch_to_datetime64(dframe[column].to_numpy(dtype=float))
+    return dframe
+
+def read_downsampled(the_tab, x_column, y_columns, max_points=None, method="lttb", columns=None,
+                     start=None, by="logical", chunk_size=100000):
+    """
+    Read the rows of a table and downsample them, reading chunks of chunk_size rows at a time.
+
+    Time series with more rows than max_points are read from the table's rollups when it has any,
+    see Table.choose_rollup, the minmax method reads both the min and the max of every bucket.
+    Every run of a federated table is downsampled on its own.
+
+    Args:
+        the_tab: the Table to read from
+        x_column, y_columns: columns the chart draws, as in downsample
+        max_points: number of points to downsample to, None to read every row at once
+        method: downsampling method, 'lttb' or 'minmax'
+        columns: list of columns to read, defaults to all columns
+        start, by: only read the rows from this time on, like in Table.to_pandas
+        chunk_size: largest number of rows read at a time
+    Returns:
+        pandas DataFrame
+    """
+    if x_column in (the_tab.l_column_, the_tab.r_column_):
+        seconds = the_tab.choose_rollup(max_points, start=start, columns=columns, by=by)
+        if seconds is not None:
+            if method == "minmax":
+                dframe = pd.concat([the_tab.read_rollup(seconds, start=start, columns=columns, by=by, aggregate=name)
+                                    for name in ("min", "max")], ignore_index=True)
+                dframe = dframe.sort_values(x_column, kind="stable", ignore_index=True)
+            else:
+                dframe = the_tab.read_rollup(seconds, start=start, columns=columns, by=by)
+            return downsample(dframe, x_column, y_columns, max_points, method, the_tab.run_column_)
+    num_rows = the_tab.count(start=start, by=by)
+    if max_points is None or num_rows <= chunk_size:
+        dframe = the_tab.to_pandas(start=start, columns=columns, by=by)
+        return downsample(dframe, x_column, y_columns, max_points, method, the_tab.run_column_)
+    chunks = the_tab.iter_chunks(chunk_size, start=start, columns=columns, by=by)
+    return downsample_chunks(chunks, x_column, y_columns, max_points, method, num_rows, the_tab.run_column_)
+
+def rows_to_json(dframe):
+    """
+    Serialize DataFrame rows to a JSON array of records, with datetimes as ISO strings.
+
+    Args:
+        dframe: pandas DataFrame
+    Returns:
+        A JSON string
+    """
+    return dframe.to_json(orient="records", date_format="iso")
+
+def get_usage_columns(the_tab):
+    """
+    Get the columns a usage chart of a table draws, every column but the time and run columns.
+    """
+    return [column for column in the_tab.columns[2:] if column != the_tab.run_column_]
+
+def run_encodings(run_column, channel="detail"):
+    """
+    Get the encodings that draw the rows of every run of a federated table as series of their own.
+
+    Args:
+        run_column: the run column of the table, None if the table is not federated
+        channel: 'detail' for charts that colour their series already, 'color' to colour the runs
+    Returns:
+        A dict of keyword arguments of Chart.encode, empty if run_column is None
+    """
+    if run_column is None:
+        return {}
+    return {channel: f"{run_column}:N"}
 
-    some_chart = alt.Chart(dframe2).mark_line(interpolate='basis').encode(
+def make_usage_chart(dframe, usage_columns, run_column=None):
+    """
+    Make a line chart with one line per usage column, drawn from the unmelted table rows.
+
+    The usage columns are folded by Vega-Lite so the chart's dataset holds the same rows as the table,
+    which lets new rows be streamed into it as they arrive.
+    The rows of a federated table are drawn as a line per run and usage column.
+    """
+    tooltip = ['usage:O', 'real_time:T'] + ([] if run_column is None else [f"{run_column}:N"])
+    some_chart = alt.Chart(dframe).transform_fold(
+        usage_columns, as_=['usage', 'percent']
+    ).mark_line(interpolate='basis').encode(
         x=alt.X('yearmonthdatehoursminutes(real_time):T', title="Real Time",
                 axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
         y=alt.Y('percent:Q', title="Percentage Used",
                 axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
         color=alt.Color('usage:O', scale=alt.Scale(range=['salmon', 'steelblue'])),
-        tooltip=['usage:O', 'real_time:T']
+        tooltip=tooltip,
+        **run_encodings(run_column)
     ).properties(width=650, height=400)
-    return some_chart.to_json()
+    return some_chart
+
+def pid_usage_chart(dframe, r_column, usage_columns, max_points=None, method="lttb"):
+    """
+    Downsample the rows of a PID and make its CPU and memory chart JSON.
+    """
+    dframe = downsample(dframe, r_column, usage_columns, max_points, method)
+    dframe = convert_real_time(dframe, r_column)
+    with metrics.timed("serialize"):
+        return make_usage_chart(dframe, usage_columns).to_json()
 
-def get_pid_charts(db_name):
+def make_pid_chart(db_name, table_name, max_points=None, method="lttb"):
+    """
+    Return a CPU and memory chart directly from a getpid database.
+
+    PIDs kept in the long-format PID table are read from it by their table name, see database.pids.
+
+    Args:
+        db_name: path to database file, or an open Database
+        table_name: name of table within database file to create a PID chart from
+        max_points: number of points to downsample the chart to, None to keep every row
+        method: downsampling method, 'lttb' or 'minmax'
+    """
+    the_db = database.get_database(db_name)
+    key = the_db.pid_key(table_name)
+    if key is not None:
+        dframe = the_db.get_pid_table().read_pids([key])[key]
+        return pid_usage_chart(dframe, "real_time", USAGE_COLUMNS[2:], max_points, method)
+    the_tab = the_db.get_table(table_name)
+    columns = get_usage_columns(the_tab)
+    dframe = read_downsampled(the_tab, the_tab.r_column_, columns, max_points, method)
+    dframe = convert_real_time(dframe, the_tab.r_column_)
+    with metrics.timed("serialize"):
+        return make_usage_chart(dframe, columns, the_tab.run_column_).to_json()
+
+def get_pid_charts(db_name, max_points=None, method="lttb"):
     """
     Return a list of layered memory and cpu charts, one for every PID in the database.
 
+    The charts of every table come first, followed by the PIDs of the long-format PID table,
+    which are all read in one query.
+
     Args:
-        db_name: path to the database file
+        db_name: path to the database file, or an open Database
+        max_points: number of points to downsample each chart to, None to keep every row
+        method: downsampling method, 'lttb' or 'minmax'
     """
     chart_list = []
-    the_db = database.Database(db_name)
+    the_db = database.get_database(db_name)
     table_list = the_db.get_table_list()
     for tab in table_list:
+        if tab == PID_TABLE:
+            continue
         the_table = the_db.get_table(tab)
-        dframe = the_table.to_pandas()
-        dframe.iloc[:, 1] = dframe.iloc[:, 1].map(lambda x: datetime.datetime.fromtimestamp(x))
-        columns = list(dframe.columns)
-        dframe2 = dframe.melt(id_vars=[columns[0], columns[1]], var_name='usage', value_name='percent')
-        some_chart = alt.Chart(dframe2).mark_line(interpolate='basis').encode(
-            x=alt.X('yearmonthdatehoursminutes(real_time):T', title="Real Time",
-                    axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
-            y=alt.Y('percent:Q', title="Percentage Used",
-                    axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
-            color=alt.Color('usage:O', scale=alt.Scale(range=['salmon', 'steelblue'])),
-            tooltip=['usage:O', 'real_time:T']
-        ).properties(width=650, height=400)
-        chart_list.append(some_chart.to_json())
+        columns = get_usage_columns(the_table)
+        dframe = read_downsampled(the_table, the_table.r_column_, columns, max_points, method)
+        dframe = convert_real_time(dframe, the_table.r_column_)
+        with metrics.timed("serialize"):
+            chart_list.append(make_usage_chart(dframe, columns, the_table.run_column_).to_json())
+    pid_tab = the_db.get_pid_table()
+    if pid_tab is not None:
+        for dframe in pid_tab.read_pids(pid_tab.keys()).values():
+            chart_list.append(pid_usage_chart(dframe, "real_time", USAGE_COLUMNS[2:], max_points, method))
     return chart_list
 
 def make_mem_chart(dframe):
@@ -85,53 +201,64 @@ def make_cpu_chart(dframe):
     )
     return ret_chart
 
-def get_system_charts(db_name):
+def get_system_charts(db_name, max_points=None, method="lttb"):
     """
     Produce system charts from file where getpid --system is run.
 
     Make a four-panel of charts for cpu load, average load, physical memory usage, and swap memory usage.
+    The runs of a federated database are drawn as series of their own.
     Args:
-        db_name: Path to the database file
+        db_name: Path to the database file, or an open Database
+        max_points: number of points to downsample the charts to, None to keep every row
+        method: downsampling method, 'lttb' or 'minmax'
     Returns:
         One Altair chart object containing each of the graphs hconcat and vconcat together
     """
-    the_db = database.Database(db_name)
+    the_db = database.get_database(db_name)
     the_sys_tab = the_db.get_table("sys_usage")
-    dframe = the_sys_tab.to_pandas()
-    dframe.iloc[:, 1] = dframe.iloc[:, 1].map(lambda x: datetime.datetime.fromtimestamp(x))
-    cpu_load_chart = make_cpu_load_chart(dframe)
-    load_avg_chart = make_load_avg_chart(dframe)
-    phys_mem_chart = make_phys_mem_chart(dframe)
-    swap_mem_chart = make_swap_mem_chart(dframe)
-    upper = alt.hconcat(phys_mem_chart, swap_mem_chart)
-    lower = alt.hconcat(cpu_load_chart, load_avg_chart)
-    final_chart = alt.vconcat(lower, upper)
-
-    return final_chart.to_json()
+    dframe = read_downsampled(the_sys_tab, the_sys_tab.r_column_,
+                              ['cpu_load', 'load_avg', 'used_phys_mem', 'used_swap_mem'], max_points, method)
+    dframe = convert_real_time(dframe, the_sys_tab.r_column_)
+    ranges = the_sys_tab.stats()["columns"]
+    run_column = the_sys_tab.run_column_
+    with metrics.timed("serialize"):
+        cpu_load_chart = make_cpu_load_chart(dframe, ranges.get("num_cpus", (None, None))[1], run_column)
+        load_avg_chart = make_load_avg_chart(dframe, run_column)
+        phys_mem_chart = make_phys_mem_chart(dframe, run_column)
+        swap_mem_chart = make_swap_mem_chart(dframe, ranges.get("total_swap_mem", (None, None))[1], run_column)
+        upper = alt.hconcat(phys_mem_chart, swap_mem_chart)
+        lower = alt.hconcat(cpu_load_chart, load_avg_chart)
+        final_chart = alt.vconcat(lower, upper)
+        return final_chart.to_json()
 
-def make_cpu_load_chart(dframe):
+def make_cpu_load_chart(dframe, num_cpus=None, run_column=None):
     """
     Create the chart for visualizing CPU load.
 
     Args:
         dframe: pandas dframe from getpid --system database
+        num_cpus: top of the y scale, taken from the first row of dframe by default
+        run_column: column of the run of every row of a federated database, coloured by
     Returns:
         An Altair chart object with time on the x axis and cpu_load on the y axis
     """
-    num_cpus = dframe.iloc[0, 3]
+    if num_cpus is None:
+        num_cpus = dframe.iloc[0, 3]
     the_chart = alt.Chart(dframe).mark_area(interpolate='linear').encode(
         x=alt.X('yearmonthdatehoursminutes(real_time):T', title="Real Time",
                 axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
         y=alt.Y('cpu_load:Q', title="CPU Load", scale=alt.Scale(domain=[0, num_cpus]), stack=None),
+        **run_encodings(run_column, "color")
     )
     return the_chart
 
-def make_load_avg_chart(dframe):
+def make_load_avg_chart(dframe, run_column=None):
     """
     Create the chart for visualizing load average.
 
     Args:
         dframe: pandas dframe from getpid --system database
+        run_column: column of the run of every row of a federated database, coloured by
     Returns:
         An Altair chart object with time on the x axis and load average on the y axis
     """
@@ -139,46 +266,48 @@ def make_load_avg_chart(dframe):
         x=alt.X('yearmonthdatehoursminutes(real_time):T', title="Real Time",
                 axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
         y=alt.Y('load_avg:Q', title="Load Average", stack=None),
+        **run_encodings(run_column, "color")
     )
     return the_chart
 
-def make_phys_mem_chart(dframe):
+def make_phys_mem_chart(dframe, run_column=None):
     """
     Create the chart for visualizing physical memory usage.
 
     Args:
         dframe: pandas dframe from getpid --system database
+        run_column: column of the run of every row of a federated database, drawn as an area per run
     Returns:
         An Altair chart object with time on the x axis and used and available memory usage on the y axis
     """
-    real_time = dframe['real_time']
-    logic_time = dframe['logic_time']
-    used_phys_mem = dframe['used_phys_mem']
-    total_phys_mem = dframe['total_phys_mem']
-    new_dframe = pd.DataFrame({'real_time': real_time, 'logic_time': logic_time,
-                               'total_phys_mem': total_phys_mem, 'used_phys_mem': used_phys_mem})
-    dframe2 = new_dframe.melt(id_vars=['real_time', 'logic_time'], var_name='type', value_name='mem_usage')
-    the_chart = alt.Chart(dframe2).mark_area(interpolate='linear').encode(
+    the_chart = alt.Chart(dframe).transform_fold(
+        ['total_phys_mem', 'used_phys_mem'], as_=['type', 'mem_usage']
+    ).mark_area(interpolate='linear').encode(
         x=alt.X('yearmonthdatehoursminutes(real_time):T', title="Real Time",
                 axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
         y=alt.Y('mem_usage:Q', title="Physical Memory", stack=None),
         color=alt.Color('type:O', scale=alt.Scale(range=['steelblue', 'salmon'])),
+        **run_encodings(run_column)
     )
     return the_chart
 
-def make_swap_mem_chart(dframe):
+def make_swap_mem_chart(dframe, total_swap_mem=None, run_column=None):
     """
     Create the chart for visualizing swap memory.
 
     Args:
         dframe: pandas dframe from getpid --system database
+        total_swap_mem: top of the y scale, taken from the first row of dframe by default
+        run_column: column of the run of every row of a federated database, coloured by
     Returns:
         An Altair chart object with time on the x axis and swap memory usage on the y axis
     """
-    total_swap_mem = dframe.iloc[0, 8]
+    if total_swap_mem is None:
+        total_swap_mem = dframe.iloc[0, 8]
     the_chart = alt.Chart(dframe).mark_area().encode(
         x=alt.X('yearmonthdatehoursminutes(real_time):T', title="Real Time",
                 axis=alt.Axis(labelFontSize=12.0, titleFontSize=14.0)),
-        y=alt.Y('used_swap_mem:Q', title="Swap Memory", scale=alt.Scale(domain=[0, total_swap_mem])),
+        y=alt.Y('used_swap_mem:Q', title="Swap Memory", scale=alt.Scale(domain=[0, total_swap_mem]), stack=None),
+        **run_encodings(run_column, "color")
     )
     return the_chart
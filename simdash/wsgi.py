@@ -0,0 +1,108 @@
+"""
+Run a WSGI app in production.
+
+The app is served by waitress when it is installed,
+otherwise by Werkzeug's server with a bounded pool of threads.
+Several worker processes can share one listening socket.
+"""
+import concurrent.futures
+import os
+import signal
+import socket
+import sys
+
+import logbook
+from werkzeug.serving import BaseWSGIServer
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+log = logbook.Logger(__name__)
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug's WSGI server handling requests on a fixed pool of threads,
+    instead of one new thread per request.
+    """
+    def __init__(self, host, port, app, threads, fd=None):
+        self.executor_ = concurrent.futures.ThreadPoolExecutor(threads)
+        super().__init__(host, port, app, fd=fd)
+
+    def process_request(self, request, client_address):
+        self.executor_.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """
+        Handle one request on a pool thread.
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception: # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+def serve_socket(app, sock, threads):
+    """
+    Serve app on an already bound and listening socket until the process is stopped.
+
+    Args:
+        app: the WSGI app
+        sock: listening socket
+        threads: number of requests handled at the same time
+    """
+    if waitress is not None:
+        waitress.serve(app, sockets=[sock], threads=threads)
+        return
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.executor_.shutdown(wait=False)
+
+def run(app, host, port, workers=1, threads=8):
+    """
+    Serve app with worker processes that each handle requests on a pool of threads.
+
+    Args:
+        app: the WSGI app
+        host: host to bind to
+        port: port to bind to
+        workers: number of processes, forked after the socket is bound
+        threads: number of threads of every process
+    """
+    sock = socket.create_server((host, port), backlog=128)
+    sock.set_inheritable(True)
+    server_name = "waitress" if waitress is not None else "werkzeug"
+    log.info(f"Serving on http://{host}:{port} with {workers} x {threads} {server_name} threads")
+    if workers <= 1:
+        serve_socket(app, sock, threads)
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_socket(app, sock, threads)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    sock.close()
+    # Stop the workers along with the parent
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
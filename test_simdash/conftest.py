@@ -0,0 +1,37 @@
+"""
+Fixtures shared by the simdash tests.
+"""
+import pytest
+
+from simdash import serve
+from simdash.database.database import Database
+
+SYS_COLUMNS = ["logic_time", "real_time", "cpu_load", "num_cpus", "load_avg", "total_phys_mem",
+               "used_phys_mem", "used_swap_mem", "total_swap_mem"]
+
+@pytest.fixture
+def served_db(tmp_path, monkeypatch):
+    """
+    Create a database like the ones written by getpid and point the server at it.
+
+    Returns:
+        Path to the database file
+    """
+    db_file = str(tmp_path / "served.db")
+    the_db = Database(db_file)
+    the_db.make_table("sys_usage", SYS_COLUMNS, ["FLOAT", "INT"] + ["FLOAT"] * 7, ["Q", "T"] + ["Q"] * 7)
+    the_db.make_table("rootpid1", ["logic_time", "real_time", "cpu_percent", "mem_percent"],
+                      ["FLOAT", "INT", "FLOAT", "FLOAT"], ["Q", "T", "Q", "Q"])
+    sys_tab = the_db.get_table("sys_usage")
+    pid_tab = the_db.get_table("rootpid1")
+    for i in range(5):
+        sys_tab.append(cpu_load=i, num_cpus=4, load_avg=i / 2, total_phys_mem=16, used_phys_mem=i,
+                       used_swap_mem=0, total_swap_mem=2, r_time=f"2019-08-06 10:0{i}")
+        pid_tab.append(cpu_percent=10 * i, mem_percent=i, r_time=f"2019-08-06 10:0{i}")
+
+    config_file = tmp_path / "served.toml"
+    config_file.write_text('[[tab]]\ntable_name = "rootpid1"\nmark = "line"\n'
+                           '[tab.encode]\nx = "logic_time"\ny = "cpu_percent"\n')
+    monkeypatch.setattr(serve, "DB_PATH", db_file)
+    monkeypatch.setattr(serve, "CONFIG_PATH", str(config_file))
+    return db_file
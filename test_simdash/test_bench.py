@@ -0,0 +1,35 @@
+"""
+Smoke test for the benchmark suite.
+"""
+import json
+
+from click.testing import CliRunner
+
+from simdash import cli_main
+from simdash.bench import run_benchmarks
+import simdash.cli
+
+def test_run_benchmarks(tmp_path):
+    """
+    Every benchmark runs on a small database and reports its timings.
+    """
+    results = run_benchmarks([200], str(tmp_path), repeats=1, num_appends=10)
+    names = [result["name"] for result in results]
+    assert names == ["generate", "to_pandas", "len", "render /displayconfig/", "render /pid/",
+                     "render /sys_usage", "append", "append buffered"]
+    transfer = results[3]["transfer"]
+    assert transfer["page_bytes"] > 0 and transfer["dataset_bytes"] > 0
+    assert transfer["bytes"] == transfer["page_bytes"] + transfer["dataset_bytes"]
+    assert 0 < results[5]["transfer"]["gzip_bytes"] < results[5]["transfer"]["bytes"]
+    assert all(result["rows"] == 200 for result in results)
+
+def test_bench_command(tmp_path):
+    """
+    simdash bench writes machine readable results.
+    """
+    output = tmp_path / "results.json"
+    result = CliRunner().invoke(cli_main, ["bench", "-s", "100", "-r", "1", "--appends", "5", "-o", str(output)])
+    assert result.exit_code == 0, result.output
+    data = json.loads(output.read_text())
+    assert data["environment"]["sqlite"]
+    assert len(data["results"]) == 8
@@ -0,0 +1,38 @@
+"""
+Tests for the chart cache of the server.
+"""
+from simdash import serve
+from simdash.cache import ChartCache
+from simdash.database.database import Database
+
+def test_lru_eviction():
+    """
+    The least recently used chart is dropped once the cache is full.
+    """
+    cache = ChartCache(max_entries=2)
+    assert cache.get_or_build("a", lambda: 1) == 1
+    assert cache.get_or_build("b", lambda: 2) == 2
+    assert cache.get_or_build("a", lambda: 10) == 1
+    assert cache.get_or_build("c", lambda: 3) == 3
+    assert len(cache) == 2
+    assert cache.get_or_build("b", lambda: 20) == 20
+    assert (cache.hits, cache.misses) == (1, 4)
+
+def test_charts_rebuilt_on_change(served_db, monkeypatch):
+    """
+    Pages reuse cached charts until their table gets new rows.
+    """
+    cache = ChartCache()
+    monkeypatch.setattr(serve, "CHART_CACHE", cache)
+    client = serve.app.test_client()
+    client.get("/displayconfig/")
+    client.get("/sys_usage")
+    assert (cache.hits, cache.misses) == (0, 2)
+    client.get("/displayconfig/")
+    client.get("/sys_usage")
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    Database(served_db).get_table("rootpid1").append(cpu_percent=1, mem_percent=2)
+    client.get("/displayconfig/")
+    client.get("/sys_usage")
+    assert (cache.hits, cache.misses) == (3, 3)
@@ -0,0 +1,103 @@
+"""
+Tests for downsampling time series before they are charted.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from simdash.database.database import Database
+from simdash.viz.chart_toml import create_toml_charts_without_encodings
+from simdash.viz.downsample import downsample, downsample_chunks, lttb_indices, minmax_indices
+
+def reference_lttb(x, y, threshold):
+    """
+    Straightforward loop implementation of LTTB to check the vectorized one against.
+    """
+    length = len(x)
+    every = (length - 2) / (threshold - 2)
+    selected = [0]
+    prev = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, length)
+        if i == threshold - 3:
+            next_start, next_end = length - 1, length
+        avg_x = np.mean(x[next_start:next_end])
+        avg_y = np.mean(y[next_start:next_end])
+        areas = [abs((x[prev] - avg_x) * (y[j] - y[prev]) - (x[prev] - x[j]) * (avg_y - y[prev]))
+                 for j in range(start, end)]
+        prev = start + int(np.argmax(areas))
+        selected.append(prev)
+    selected.append(length - 1)
+    return selected
+
+def test_lttb_matches_reference():
+    """
+    The vectorized LTTB picks the same points as the loop version.
+    """
+    rng = np.random.default_rng(0)
+    x = np.arange(1000, dtype=float)
+    y = np.cumsum(rng.normal(size=1000))
+    assert lttb_indices(x, y, 50).tolist() == reference_lttb(x, y, 50)
+    assert lttb_indices(x, y, 2000).tolist() == list(range(1000))
+
+def test_minmax_keeps_spikes():
+    """
+    Every bucket keeps its extremes, so a single spike survives.
+    """
+    y = np.zeros(10000)
+    y[4321] = 100.0
+    y[8765] = -100.0
+    indices = minmax_indices(y, 20)
+    assert len(indices) <= 22
+    assert 4321 in indices and 8765 in indices
+    assert indices[0] == 0 and indices[-1] == 9999
+
+def test_downsample_dataframe():
+    """
+    Downsampling keeps rows in x order and leaves small frames alone.
+    """
+    dframe = pd.DataFrame({"t": np.arange(5000.0), "a": np.sin(np.arange(5000.0) / 100), "s": ["x"] * 5000})
+    assert downsample(dframe, "t", ["a"], None) is dframe
+    small = downsample(dframe, "t", ["a", "s"], 100, "minmax")
+    assert len(small.index) <= 102
+    assert small["t"].is_monotonic_increasing
+    assert len(downsample(dframe, "t", ["s"], 100).index) == 100
+    with pytest.raises(ValueError):
+        downsample(dframe, "t", ["a"], 100, "median")
+
+def test_downsample_chunks():
+    """
+    Downsampling chunk by chunk keeps every spike and about as many points as downsampling at once.
+    """
+    y = np.zeros(10000)
+    y[4321] = 5.0
+    y[8765] = -5.0
+    dframe = pd.DataFrame({"t": np.arange(10000.0), "a": y})
+    chunks = (dframe.iloc[start:start + 1000] for start in range(0, 10000, 1000))
+    small = downsample_chunks(chunks, "t", ["a"], 100, "minmax", num_rows=10000)
+    assert len(small.index) <= 102
+    assert small["t"].is_monotonic_increasing
+    assert {4321.0, 8765.0} <= set(small["t"])
+    chunks = (dframe.iloc[start:start + 1000] for start in range(0, 10000, 1000))
+    assert len(downsample_chunks(chunks, "t", ["a"], 100, "lttb", num_rows=10000).index) == 100
+    assert downsample_chunks([], "t", ["a"], 100) is None
+
+def test_toml_max_points(tmp_path):
+    """
+    The max_points key of a [[tab]] block limits the rows sent to the chart.
+    """
+    db_file = str(tmp_path / "points.db")
+    the_db = Database(db_file)
+    the_db.make_table("points", ["logic_time", "real_time", "a"], ["FLOAT", "INT", "FLOAT"], ["Q", "T", "Q"])
+    the_db.get_table("points").extend({"a": np.random.default_rng(0).normal(size=3000)})
+    config_file = tmp_path / "points.toml"
+    config_file.write_text('[[tab]]\ntable_name = "points"\nmark = "line"\nmax_points = 100\n'
+                           'downsample = "minmax"\n[tab.encode]\nx = "logic_time"\ny = "a"\n')
+    spec = json.loads(create_toml_charts_without_encodings(db_file, str(config_file), max_points=1000)[0])
+    rows = list(spec["datasets"].values())[0]
+    assert 50 <= len(rows) <= 102
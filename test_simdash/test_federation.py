@@ -0,0 +1,97 @@
+"""
+Tests for the database files of many runs read as one database.
+"""
+import json
+
+import numpy as np
+import pytest
+
+from simdash.database import database, federation
+from simdash.database.database import Database
+from simdash.viz import viz
+from simdash.viz.chart_toml import create_toml_chart_without_encodings
+
+COLUMNS = ["logic_time", "real_time", "cpu", "host"]
+DTYPES = ["FLOAT", "INT", "FLOAT", "TEXT"]
+VTYPES = ["Q", "T", "Q", "N"]
+
+def write_run(path, offset, num_rows=100):
+    """
+    Write a run with a usage table of num_rows rows, whose cpu starts at offset.
+    """
+    the_db = Database(str(path))
+    the_db.make_table("usage", COLUMNS, DTYPES, VTYPES, rollups={"1min": ["cpu"]})
+    the_tab = the_db.get_table("usage")
+    the_tab.extend({"real_time": 1565085600 + 10 * np.arange(num_rows), "cpu": np.arange(num_rows) + offset,
+                    "host": np.array(["a", "b"] * (num_rows // 2), dtype=object)})
+    the_db.conn.close()
+
+@pytest.fixture
+def runs(tmp_path):
+    """
+    A directory with the files of three runs.
+    """
+    for num, offset in enumerate([0.0, 1000.0, 2000.0]):
+        write_run(tmp_path / f"run{num}.db", offset)
+    return tmp_path
+
+def test_merged_reads(runs):
+    """
+    Tables of every run are read as one with a run column, a glob matching the same files as the directory.
+    """
+    the_db = database.get_database(str(runs))
+    assert isinstance(the_db, federation.FederatedDatabase)
+    assert the_db.get_table_cols_and_vtypes("usage") == (COLUMNS + ["run"], VTYPES + ["N"])
+    the_tab = the_db.get_table("usage")
+    dframe = the_tab.to_pandas()
+    assert len(dframe.index) == the_tab.len() == 300
+    assert dframe.groupby("run")["cpu"].min().to_dict() == {"run0": 0.0, "run1": 1000.0, "run2": 2000.0}
+    assert the_tab.to_pandas(limit=10, columns=["cpu", "run"])["run"].tolist() == (
+        ["run2"] + ["run0", "run1", "run2"] * 3)
+    assert sum(len(chunk.index) for chunk in the_tab.iter_chunks(30, start=50)) == 153
+    assert the_tab.stats()["columns"]["cpu"] == (0.0, 2099.0)
+    assert set(the_tab.read_rollup(60)["run"]) == {"run0", "run1", "run2"}
+    with pytest.raises(ValueError):
+        the_tab.append(cpu=1.0)
+    the_db.close()
+    glob_db = database.get_database(str(runs / "run*.db"))
+    assert glob_db.get_table("usage").count(start=50) == 153
+
+def test_aggregate_by_run(runs):
+    """
+    Aggregates grouped by run match the aggregates of every file, and groups without it combine the runs.
+    """
+    the_db = database.get_database(str(runs))
+    the_tab = the_db.get_table("usage")
+    dframe = the_tab.aggregate({"cpu": "mean"}, group_by=["run", "host"], bin_column="logic_time", bin_step=50)
+    alone = Database(str(runs / "run1.db")).get_table("usage").aggregate(
+        {"cpu": "mean"}, group_by=["host"], bin_column="logic_time", bin_step=50)
+    mine = dframe[dframe["run"] == "run1"]
+    assert mine["cpu"].tolist() == alone["cpu"].tolist()
+    combined = the_tab.aggregate({"cpu": "mean"})
+    assert np.isclose(combined["cpu"].iloc[0], 1049.5)
+    assert the_tab.aggregate({"cpu": "count"}, group_by=["host"])["cpu"].tolist() == [150, 150]
+    the_db.close()
+
+def test_new_runs_and_charts(runs):
+    """
+    A new run file is picked up, only its meta is read, and charts coloured by run are built from a pooled database.
+    """
+    the_db = database.get_database(str(runs))
+    assert len(the_db.get_table("usage").members_) == 3
+    write_run(runs / "run3.db", 3000.0)
+    assert len(the_db.get_table("usage").members_) == 3
+    the_db.refresh()
+    assert the_db.get_table("usage").len() == 400
+    the_db.close()
+
+    with database.pooled(str(runs)) as the_db:
+        assert not the_db.streams_rows
+        chart = json.loads(create_toml_chart_without_encodings(
+            the_db, {"table_name": "usage", "mark": "line", "encode": {"x": "logic_time", "y": "cpu", "color": "run"}}))
+        rows = next(iter(chart["datasets"].values()))
+        assert len(rows) == 400 and {row["run"] for row in rows} == {"run0", "run1", "run2", "run3"}
+        # The built-in charts draw a line per run rather than one line across the runs
+        chart = json.loads(viz.make_pid_chart(the_db, "usage"))
+        assert chart["encoding"]["detail"] == {"field": "run", "type": "nominal"}
+        assert {row["run"] for row in next(iter(chart["datasets"].values()))} == {"run0", "run1", "run2", "run3"}
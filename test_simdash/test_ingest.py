@@ -0,0 +1,109 @@
+"""
+Tests for the ingest daemon and its client.
+"""
+import queue
+import threading
+import time
+
+from simdash import ingest
+from simdash.database.database import Database
+
+PID_COLUMNS = ["logic_time", "real_time", "cpu_percent", "mem_percent"]
+
+def test_ingest_socket(tmp_path):
+    """
+    Rows sent over the socket by several clients are written by the daemon.
+    """
+    db_file = str(tmp_path / "ingest.db")
+    socket_path = str(tmp_path / "ingest.sock")
+    messages = queue.Queue()
+    writer = ingest.IngestWriter(db_file, max_rows=3, interval=0.05)
+    server = ingest.IngestServer(socket_path, messages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    thread = threading.Thread(target=writer.run, args=(messages,))
+    thread.start()
+    try:
+        with ingest.IngestClient(socket_path) as client:
+            client.make_table("rootpid1", PID_COLUMNS, ["FLOAT", "INT", "FLOAT", "FLOAT"], ["Q", "T", "Q", "Q"])
+            the_tab = client.get_table("rootpid1")
+            for i in range(5):
+                assert the_tab.append(cpu_percent=i, mem_percent=2 * i)
+            the_tab.append(None, "2019-08-06 10:00", 50, 60)
+            the_tab.extend({"cpu_percent": [7, 8], "mem_percent": [9, 10]})
+            client.get_table("no_such_table").append(cpu_percent=1)
+        with ingest.IngestClient(socket_path) as client:
+            client.get_table("rootpid1").append(cpu_percent=99, mem_percent=1)
+        # The connection handlers queue the messages of a closed client shortly after
+        deadline = time.monotonic() + 10
+        while writer.num_rows < 9 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        server.shutdown()
+        server.server_close()
+        messages.put(None)
+        thread.join()
+
+    dframe = Database(db_file).get_table("rootpid1").to_pandas()
+    assert dframe["logic_time"].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0]
+    assert dframe["cpu_percent"].tolist() == [0.0, 1.0, 2.0, 3.0, 4.0, 50.0, 7.0, 8.0, 99.0]
+    assert dframe["real_time"].iloc[5] == 1565085600
+    assert dframe["real_time"].iloc[0] > 1565085600
+    assert writer.num_rows == 9
+
+def test_ingest_queue(tmp_path):
+    """
+    Clients can put their rows on a queue read by the writer instead of a socket.
+    """
+    db_file = str(tmp_path / "ingest.db")
+    the_db = Database(db_file)
+    the_db.make_table("rootpid1", PID_COLUMNS, ["FLOAT", "INT", "FLOAT", "FLOAT"], ["Q", "T", "Q", "Q"])
+    messages = queue.Queue()
+    client = ingest.IngestClient(messages)
+    client.get_table("rootpid1").extend({"cpu_percent": [1, 2, 3], "mem_percent": [4, 5, 6]})
+    messages.put(None)
+    ingest.run_queue_writer(db_file, messages)
+    assert the_db.get_table("rootpid1").len() == 3
+
+def test_bad_message(tmp_path):
+    """
+    A message with values SQLite can not bind is dropped without losing the rows of the other messages,
+    and a batch that fails to write is written one row at a time.
+    """
+    db_file = str(tmp_path / "ingest.db")
+    the_db = Database(db_file)
+    the_db.make_table("rootpid1", PID_COLUMNS, ["FLOAT", "INT", "FLOAT", "FLOAT"], ["Q", "T", "Q", "Q"])
+    messages = queue.Queue()
+    the_tab = ingest.IngestClient(messages).get_table("rootpid1")
+    the_tab.append(cpu_percent=1.0, mem_percent=2.0)
+    the_tab.append(cpu_percent=[1, 2], mem_percent=2.0)
+    messages.put({"op": "extend", "table": "rootpid1", "data": {"cpu_percent": [3, [4]], "mem_percent": [5, 6]},
+                  "time": 1565085600})
+    messages.put({"op": "extend", "table": "rootpid1", "data": {"cpu_percent": [[3], [4]], "mem_percent": [5, 6]},
+                  "time": 1565085600})
+    the_tab.append(cpu_percent=2 ** 64, mem_percent=2.0)
+    the_tab.extend({"cpu_percent": [3, 4], "mem_percent": [5, 6]})
+    messages.put(None)
+    writer = ingest.IngestWriter(db_file)
+    writer.run(messages)
+    assert the_db.get_table("rootpid1").to_pandas()["cpu_percent"].tolist() == [1.0, 3.0, 4.0]
+    assert writer.num_rows == 3
+
+    writer.handle({"op": "append", "table": "rootpid1", "kwargs": {"cpu_percent": 5.0}, "time": 1565085600})
+    # A row only SQLite rejects, as handle checks the values of messages
+    writer.tables_["rootpid1"].buffer_.append((6.0, 1565085600, [1, 2], None))
+    writer.pending_ += 1
+    writer.handle({"op": "append", "table": "rootpid1", "kwargs": {"cpu_percent": 7.0}, "time": 1565085600})
+    writer.flush()
+    assert the_db.get_table("rootpid1").to_pandas()["cpu_percent"].tolist() == [1.0, 3.0, 4.0, 5.0, 7.0]
+    assert writer.num_rows == 5 and not writer.tables_["rootpid1"].buffer_
+
+def test_client_without_daemon(tmp_path):
+    """
+    The client does not block when the daemon is not running, it keeps max_pending messages and drops the rest.
+    """
+    client = ingest.IngestClient(str(tmp_path / "missing.sock"), max_pending=2, retry_interval=0.01)
+    the_tab = client.get_table("rootpid1")
+    results = [the_tab.append(cpu_percent=i) for i in range(5)]
+    assert results.count(False) >= 3
+    client.close()
+    assert client.dropped == 5
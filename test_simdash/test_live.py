@@ -0,0 +1,98 @@
+"""
+Tests for new rows pushed to browsers by one watcher per server process.
+"""
+import json
+import threading
+
+import pytest
+
+from simdash import live, serve
+from simdash.database import database
+from simdash.database.database import Database
+from simdash.serve import app
+
+@pytest.fixture
+def watched(served_db, monkeypatch):
+    """
+    Point the server at served_db with a fast watcher and short streams, stopping the watcher afterwards.
+    """
+    monkeypatch.setattr(serve, "WATCH_INTERVAL", 0.05)
+    monkeypatch.setattr(serve, "STREAM_SECONDS", 1.0)
+    monkeypatch.setattr(serve, "KEEP_ALIVE", 0.2)
+    monkeypatch.setattr(serve, "_WATCHER", None)
+    monkeypatch.setattr(serve, "_STREAMS", 0)
+    yield served_db
+    if serve._WATCHER is not None:
+        serve._WATCHER.stop()
+
+def read_events(response):
+    """
+    Get the ids and data of the events of an /events/ stream.
+    """
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            events.append((json.loads(fields["id"]), json.loads(fields["data"])))
+    # Gives the stream back, as WSGI servers do
+    response.close()
+    return events
+
+def test_one_read_per_table(served_db):
+    """
+    The rows of a table are read once for every subscription, and not at all until another connection commits.
+    """
+    reads = []
+
+    def read_rows(the_db, table_name, rowid):
+        reads.append((table_name, rowid))
+        return serve.read_new_rows(the_db, table_name, rowid)
+    watcher = live.Watcher(lambda: database.pooled(served_db), read_rows)
+    subscriptions = [watcher.subscribe({"rootpid1": 3}) for _ in range(5)]
+    with database.pooled(served_db) as the_db:
+        version = watcher.poll(the_db)
+        assert reads == [("rootpid1", 3)]
+        assert all(sub.events.get_nowait()[:2] == ("rootpid1", 5) for sub in subscriptions)
+        assert watcher.poll(the_db, version) == version and len(reads) == 1
+        Database(served_db).get_table("rootpid1").append(cpu_percent=1, mem_percent=2)
+        watcher.poll(the_db, version)
+        assert reads[1:] == [("rootpid1", 5)]
+
+    late = watcher.subscribe({"rootpid1": 2})
+    assert watcher.catch_up(late) == {"rootpid1": 2}
+    for sub in subscriptions + [late]:
+        watcher.unsubscribe(sub)
+    assert not watcher.watermarks_
+
+def test_event_stream(watched):
+    """
+    A stream sends the rows after the page's rowid then rows as they are written, and resumes from its last id.
+    """
+    client = app.test_client()
+    writer = threading.Timer(0.3, lambda: Database(watched).get_table("rootpid1").append(cpu_percent=1,
+                                                                                           mem_percent=2))
+    writer.start()
+    events = read_events(client.get("/events/?table=rootpid1&rowid=3"))
+    writer.join()
+    assert [(ids, data["rowid"], len(data["rows"])) for ids, data in events] == [
+        ({"rootpid1": 5}, 5, 2), ({"rootpid1": 6}, 6, 1)]
+    assert events[0][1]["table"] == "rootpid1" and events[0][1]["r_column"] == "real_time"
+
+    events = read_events(client.get("/events/", headers={"Last-Event-ID": json.dumps({"rootpid1": 5})}))
+    assert [data["rowid"] for _, data in events] == [6]
+    assert serve._WATCHER.subscriptions == 0 and serve._STREAMS == 0
+    assert client.get("/events/?table=no_such_table&rowid=0").status_code == 404
+
+def test_stream_limit(watched, monkeypatch):
+    """
+    Streams past MAX_STREAMS are refused, so the page polls /data/ instead, and closed streams are given back.
+    """
+    monkeypatch.setattr(serve, "MAX_STREAMS", 1)
+    monkeypatch.setattr(serve, "STREAM_SECONDS", 0.3)
+    client = app.test_client()
+    response = client.get("/events/?table=rootpid1&rowid=5", buffered=False)
+    assert client.get("/events/?table=rootpid1&rowid=5").status_code == 503
+    response.close()
+    assert serve._STREAMS == 0 and serve._WATCHER.subscriptions == 0
+    assert read_events(client.get("/events/?table=rootpid1&rowid=5")) == []
+    assert serve._STREAMS == 0
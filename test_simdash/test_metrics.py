@@ -0,0 +1,53 @@
+"""
+Tests for the timings and counts exposed on /metrics.
+"""
+import os
+
+import logbook
+
+from simdash import metrics, serve
+from simdash.serve import app
+
+def test_render():
+    """
+    Counters, histograms and collected values are rendered in the Prometheus text format.
+    """
+    metrics.reset()
+    metrics.inc("simdash_sql_rows_total", 3)
+    metrics.inc("simdash_sql_rows_total", 4)
+    metrics.observe("test_seconds", 0.02, route="a")
+    metrics.observe("test_seconds", 3.0, route="a")
+    lines = metrics.render().splitlines()
+    pid = os.getpid()
+    assert "# TYPE simdash_sql_rows_total counter" in lines
+    assert f'simdash_sql_rows_total{{pid="{pid}"}} 7' in lines
+    assert "# TYPE test_seconds histogram" in lines
+    assert f'test_seconds_bucket{{route="a",pid="{pid}",le="0.01"}} 0' in lines
+    assert f'test_seconds_bucket{{route="a",pid="{pid}",le="0.025"}} 1' in lines
+    assert f'test_seconds_bucket{{route="a",pid="{pid}",le="+Inf"}} 2' in lines
+    assert f'test_seconds_sum{{route="a",pid="{pid}"}} 3.02' in lines
+    assert f'test_seconds_count{{route="a",pid="{pid}"}} 2' in lines
+    assert f'simdash_cache_hits_total{{cache="chart",pid="{pid}"}} {serve.CHART_CACHE.hits}' in lines
+
+def test_metrics_endpoint(served_db, monkeypatch):
+    """
+    Requests are timed by route and broken down by stage, and slow requests are logged with their stages.
+    """
+    metrics.reset()
+    monkeypatch.setattr(serve, "SLOW_REQUEST", 0.0)
+    client = app.test_client()
+    with logbook.TestHandler() as handler:
+        assert client.get("/displayconfig/").status_code == 200
+    assert any("Slow request /displayconfig/" in record.message and "sql" in record.message
+               and "render" in record.message for record in handler.records)
+
+    response = client.get("/metrics")
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    text = response.get_data(as_text=True)
+    pid = os.getpid()
+    for stage in ("sql", "serialize", "render"):
+        assert f'simdash_stage_seconds_count{{stage="{stage}",pid="{pid}"}}' in text
+    assert f'simdash_request_seconds_count{{route="display_from_config",status="200",pid="{pid}"}} 1' in text
+    assert f'simdash_response_bytes_count{{route="display_from_config",pid="{pid}"}} 1' in text
+    assert f'simdash_sql_rows_total{{pid="{pid}"}} 5' in text
+    assert f'simdash_cache_misses_total{{cache="chart",pid="{pid}"}}' in text
@@ -0,0 +1,113 @@
+"""
+Tests for databases partitioned into segment files.
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from simdash.database import database, partition
+from simdash.database.database import Database
+from simdash.database.pool import get_pool
+from simdash.viz.chart_toml import create_toml_chart_without_encodings
+
+START = 1565085600
+COLUMNS = ["logic_time", "real_time", "cpu", "host"]
+DTYPES = ["FLOAT", "INT", "FLOAT", "TEXT"]
+VTYPES = ["Q", "T", "Q", "N"]
+
+def write_hours(the_db, num_hours, monkeypatch):
+    """
+    Write an hour of rows, one every 10 seconds, for every hour from START, with the clock at that hour.
+    """
+    the_tab = the_db.get_table("usage")
+    for hour in range(num_hours):
+        now = START + 3600 * hour
+        monkeypatch.setattr(partition, "_now_timestamp", lambda now=now: now)
+        the_tab.extend({"real_time": now + 10 * np.arange(360), "cpu": np.arange(360.0) + hour,
+                        "host": np.array(["a", "b"] * 180, dtype=object)})
+    return the_tab
+
+@pytest.fixture
+def tables(tmp_path, monkeypatch):
+    """
+    The same three hours of rows in a database partitioned by hour and in a single file.
+    """
+    plain_db = Database(str(tmp_path / "plain.db"))
+    part_db = partition.PartitionedDatabase(str(tmp_path / "partitioned"), period="1h")
+    for the_db in (plain_db, part_db):
+        monkeypatch.setattr(partition, "_now_timestamp", lambda: START)
+        the_db.make_table("usage", COLUMNS, DTYPES, VTYPES, rollups={"1min": ["cpu"]})
+        write_hours(the_db, 3, monkeypatch)
+    yield part_db, part_db.get_table("usage"), plain_db.get_table("usage")
+    part_db.close()
+
+def test_segments(tables):
+    """
+    Every hour is a segment, the finished ones with their bounds in the catalog, and windows only read the
+    segments they overlap.
+    """
+    part_db, part_tab, _ = tables
+    segments = part_db.segments("usage")
+    assert [seq for seq, _ in segments] == [1, 2, 3]
+    assert segments[0][1]["r_time"] == (START, START + 3590)
+    assert segments[1][1]["l_time"] == (361.0, 720.0)
+    assert segments[2][1] is None
+    assert [seq for seq, _ in part_tab.segment_tables(start=START + 7200, by="real")] == [3]
+    assert [seq for seq, _ in part_tab.segment_tables(end=100)] == [1, 3]
+    assert part_tab.time_range() == (1.0, 1080.0)
+    assert part_db.drop_segments(START + 3600) == [1]
+    assert not os.path.exists(os.path.join(part_db.dirname, "segment_000001.db"))
+    assert part_tab.len() == 720
+
+def test_reads_match(tables):
+    """
+    Reads put together from the segments are the same as from a single file.
+    """
+    _, part_tab, plain_tab = tables
+    assert part_tab.to_pandas().equals(plain_tab.to_pandas())
+    assert part_tab.to_pandas(limit=400).equals(plain_tab.to_pandas(limit=400))
+    assert part_tab.to_pandas(start=START + 3000, end=START + 4000, by="real").equals(
+        plain_tab.to_pandas(start=START + 3000, end=START + 4000, by="real"))
+    assert part_tab.count(start=500) == plain_tab.count(start=500) == 581
+    assert sum(len(chunk.index) for chunk in part_tab.iter_chunks(100, start=500)) == 581
+    assert part_tab.stats() == plain_tab.stats()
+    assert part_tab.read_rollup(60).equals(plain_tab.read_rollup(60))
+    for kwargs in ({"aggregates": {"cpu": "mean"}, "group_by": ["host"], "bin_column": "real_time",
+                    "bin_step": 1800},
+                   {"aggregates": {"cpu": "sum"}, "bin_column": "logic_time", "bin_step": 100, "limit": 3},
+                   {"aggregates": {"cpu": "count"}}):
+        part, plain = part_tab.aggregate(**kwargs), plain_tab.aggregate(**kwargs)
+        assert list(part.columns) == list(plain.columns)
+        assert part.iloc[:, :-1].to_numpy().tolist() == plain.iloc[:, :-1].to_numpy().tolist()
+        assert np.allclose(part["cpu"], plain["cpu"])
+
+def test_rowids_and_charts(tables, monkeypatch):
+    """
+    Rowids carry on across segments, and charts are built from a pooled partitioned database.
+    """
+    part_db, part_tab, _ = tables
+    first, last = part_db.change_token("usage")
+    assert partition.split_rowid(first) == (1, 1) and partition.split_rowid(last) == (3, 360)
+    dframe, rowid = part_tab.rows_since(rowid=partition.global_rowid(2, 350))
+    assert len(dframe.index) == 370 and rowid == last
+    assert part_tab.rows_since(rowid=rowid)[0].empty
+    write_hours(part_db, 1, monkeypatch)
+    dframe, rowid = part_tab.rows_since(rowid=rowid)
+    assert dframe["logic_time"].tolist()[:2] == [1081.0, 1082.0]
+    assert partition.split_rowid(rowid) == (4, 360)
+
+    part_db.close()
+    with database.pooled(part_db.dirname) as the_db:
+        assert isinstance(the_db, partition.PartitionedDatabase)
+        chart = json.loads(create_toml_chart_without_encodings(
+            the_db, {"table_name": "usage", "mark": "line", "max_points": 100,
+                     "encode": {"x": "real_time", "y": "cpu"}}))
+        # The 1 minute rollup of every segment, downsampled to max_points
+        assert len(next(iter(chart["datasets"].values()))) == 100
+    # The segments are read on connections of their pools, given back when the database is closed
+    segment_pool = get_pool(os.path.join(part_db.dirname, "segment_000001.db"))
+    assert segment_pool.opened_ == 1 and segment_pool.idle_.qsize() == 1
+    with pytest.raises(ValueError):
+        part_db.set_retention("usage", max_rows=10)
@@ -0,0 +1,77 @@
+"""
+Tests for the long-format PID table.
+"""
+import json
+
+from simdash import serve
+from simdash.database.database import Database
+from simdash.serve import app
+from simdash.viz import viz
+
+def make_pid_tables(db_file):
+    """
+    Make two per-PID tables like getpid does, with three rows each.
+    """
+    the_db = Database(db_file)
+    for name in ("rootpid1", "alicepid22"):
+        the_db.make_table(name, ["logic_time", "real_time", "cpu_percent", "mem_percent"],
+                          ["FLOAT", "INT", "FLOAT", "FLOAT"], ["Q", "T", "Q", "Q"])
+        the_tab = the_db.get_table(name)
+        for i in range(3):
+            the_tab.append(cpu_percent=10 * i, mem_percent=i, r_time=f"2019-08-06 10:0{i}")
+    return the_db
+
+def test_consolidate_pid_tables(tmp_path):
+    """
+    Consolidating moves the rows of every per-PID table into the long table and drops the tables.
+    """
+    the_db = make_pid_tables(str(tmp_path / "pids.db"))
+    assert sorted(the_db.consolidate_pid_tables()) == ["alicepid22", "rootpid1"]
+    assert the_db.get_table_list() == ["pid_usage"]
+    assert the_db.consolidate_pid_tables() == []
+
+    pid_tab = the_db.get_pid_table()
+    assert pid_tab.keys() == [("alice", 22), ("root", 1)]
+    assert pid_tab.has_pid(("root", 1))
+    assert not pid_tab.has_pid(("root", 2))
+    assert the_db.pid_key("rootpid1") == ("root", 1)
+    assert the_db.pid_key("sys_usage") is None
+
+    frames = pid_tab.read_pids([("root", 1), ("alice", 22), ("root", 2)])
+    assert frames[("root", 1)]["cpu_percent"].tolist() == [0.0, 10.0, 20.0]
+    assert frames[("root", 1)]["logic_time"].tolist() == [1.0, 2.0, 3.0]
+    assert len(frames[("alice", 22)].index) == 3
+    assert frames[("root", 2)].empty
+    late = pid_tab.read_pids([("root", 1)], start="2019-08-06 10:01")[("root", 1)]
+    assert late["mem_percent"].tolist() == [1.0, 2.0]
+
+    tokens = pid_tab.change_tokens([("root", 1), ("root", 2)])
+    pid_tab.append(user="root", pid=1, cpu_percent=50, mem_percent=5)
+    assert pid_tab.change_tokens([("root", 1)])[("root", 1)][1] > tokens[("root", 1)][1]
+    assert tokens[("root", 2)] == (None, None)
+    assert len(viz.get_pid_charts(the_db)) == 2
+
+def test_served_long_format(tmp_path, monkeypatch):
+    """
+    The /pid/ page and /data/ serve PIDs of the long table by their table names.
+    """
+    db_file = str(tmp_path / "pids.db")
+    make_pid_tables(db_file).consolidate_pid_tables()
+    monkeypatch.setattr(serve, "DB_PATH", db_file)
+    client = app.test_client()
+
+    response = client.post("/pid/", data={"UserValue": "root", "PIDValue": "1"})
+    assert response.status_code == 200
+    assert b"This PID does not exist!" not in response.data
+    assert b'"rootpid1",\n                   3, 5000' in response.data
+    with app.test_request_context("/pid/"):
+        spec = json.loads(serve.build_pid_charts(["rootpid1"], [(1, 3)])[0])
+    assert spec["usermeta"]["simdashDatasets"]
+    response = client.post("/pid/", data={"UserValue": "root", "PIDValue": "9"})
+    assert b"This PID does not exist!" in response.data
+
+    data = client.get("/data/rootpid1?rowid=1").get_json()
+    assert data["rowid"] == 3
+    assert [row["cpu_percent"] for row in data["rows"]] == [10.0, 20.0]
+    assert client.get("/data/alicepid22?rowid=6").get_json()["rows"] == []
+    assert client.get("/data/bobpid3").status_code == 404
@@ -0,0 +1,69 @@
+"""
+Tests for pooled connections and cached table metadata.
+"""
+import sqlite3
+import threading
+
+import pytest
+
+from simdash.database import database
+from simdash.database.pool import ConnectionPool, get_pool
+
+def test_pool_reuses_connections(tmp_path):
+    """
+    Connections are given back and lent out again, and never more than size are opened.
+    """
+    db_file = str(tmp_path / "pool.db")
+    database.Database(db_file)
+    pool = ConnectionPool(db_file, readonly=True, size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    conns = [pool.acquire(), pool.acquire()]
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire(timeout=5)))
+    waiter.start()
+    pool.release(conns[0])
+    waiter.join()
+    assert got == [conns[0]]
+    assert pool.opened_ == 2
+    with pytest.raises(sqlite3.OperationalError):
+        conns[1].execute("CREATE TABLE nope(a INT);")
+    assert get_pool(db_file) is get_pool(db_file)
+
+def test_pooled_database(tmp_path):
+    """
+    Tables from a pooled Database share its connection and see tables made elsewhere.
+    """
+    db_file = str(tmp_path / "pooled.db")
+    writer = database.Database(db_file)
+    writer.make_table("first", ["logic_time", "real_time", "a"], ["FLOAT", "INT", "INT"], ["Q", "T", "Q"])
+    writer.get_table("first").append(a=1)
+    with database.pooled(db_file) as the_db:
+        assert the_db.get_table_list() == ["first"]
+        the_tab = the_db.get_table("first")
+        assert the_tab.conn_ is the_db.conn
+        assert the_tab.to_pandas()["a"].tolist() == [1]
+
+    writer.make_table("second", ["logic_time", "real_time", "b"], ["FLOAT", "INT", "TEXT"], ["Q", "T", "N"])
+    with database.pooled(db_file) as the_db:
+        assert the_db.get_table_list() == ["first", "second"]
+        assert the_db.get_table_cols_and_vtypes("second") == (["logic_time", "real_time", "b"], ["Q", "T", "N"])
+    writer.remove_table("first")
+    with database.pooled(db_file) as the_db:
+        assert not the_db.check_if_table_exists("first")
+
+def test_recreated_file(tmp_path):
+    """
+    The cached tables of a file are not used for a file made again with the same name and schema version.
+    """
+    db_file = tmp_path / "recreated.db"
+    for table_name in ("alpha", "beta"):
+        for path in tmp_path.glob("recreated.db*"):
+            path.unlink()
+        the_db = database.Database(str(db_file))
+        the_db.make_table(table_name, ["logic_time", "real_time", "a"], ["FLOAT", "INT", "INT"], ["Q", "T", "Q"])
+        assert the_db.get_table_list() == [table_name]
+        the_db.get_table(table_name).append(a=1)
+        the_db.conn.close()
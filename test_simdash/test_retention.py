@@ -0,0 +1,84 @@
+"""
+Tests for retention policies and pruning.
+"""
+import time
+
+import numpy as np
+import pytest
+
+from simdash.database import retention
+from simdash.database.database import Database
+
+START = 1565085600
+
+def make_usage_table(db_file, num_rows, rollups=None):
+    """
+    Make a table with a row every 10 seconds from START.
+    """
+    the_db = Database(db_file)
+    the_db.make_table("usage", ["logic_time", "real_time", "cpu"], ["FLOAT", "INT", "FLOAT"], ["Q", "T", "Q"],
+                      rollups=rollups)
+    the_db.get_table("usage").extend({"real_time": START + 10 * np.arange(num_rows),
+                                      "cpu": np.arange(num_rows, dtype=float)})
+    return the_db
+
+def test_max_rows(tmp_path):
+    """
+    Only the newest max_rows rows are kept, and the freed pages are given back to the file system.
+    """
+    db_file = str(tmp_path / "retention.db")
+    the_db = make_usage_table(db_file, 5000)
+    assert retention.prune_database(the_db) == {}
+    the_db.set_retention("usage", max_rows=20)
+    assert Database(db_file).get_retention("usage") == {"max_rows": 20}
+
+    assert retention.prune_database(the_db, batch_size=700, pause=0) == {"usage": 4980}
+    assert the_db.get_table("usage").to_pandas()["logic_time"].tolist() == list(np.arange(4981.0, 5001.0))
+    assert the_db.conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2
+    assert the_db.conn.execute("PRAGMA freelist_count;").fetchone()[0] == 0
+    assert retention.prune_database(the_db) == {}
+
+    the_db.set_retention("usage")
+    assert the_db.get_retention("usage") == {}
+    with pytest.raises(ValueError):
+        the_db.set_retention("no_such_table", max_rows=1)
+    with pytest.raises(ValueError):
+        the_db.set_retention("usage", keep_rollups=True)
+
+@pytest.mark.parametrize("keep_rollups", [False, True])
+def test_max_age_and_rollups(tmp_path, keep_rollups):
+    """
+    Rows older than max_age are deleted, along with the rollup buckets before them unless rollups are kept.
+    """
+    the_db = make_usage_table(str(tmp_path / "retention.db"), 720, rollups={"1min": ["cpu"], "10min": ["cpu"]})
+    the_db.set_retention("usage", max_age="1h", keep_rollups=keep_rollups)
+    now = START + 7200
+    assert retention.prune_table(the_db, "usage", now=now, batch_size=100, pause=0) == 360
+    the_tab = the_db.get_table("usage")
+    assert the_tab.to_pandas()["real_time"].min() == START + 3600
+    minutes = the_tab.read_rollup(60)
+    tens = the_tab.read_rollup(600)
+    if keep_rollups:
+        assert len(minutes.index) == 120 and len(tens.index) == 12
+    else:
+        assert minutes["real_time"].min() == START + 3600 and len(minutes.index) == 60
+        assert tens["real_time"].min() == START + 3600
+
+def test_pruner(tmp_path):
+    """
+    The pruner deletes the rows in the background until it is stopped.
+    """
+    db_file = str(tmp_path / "retention.db")
+    the_db = make_usage_table(db_file, 100)
+    the_db.set_retention("usage", max_rows=10)
+    pruner = retention.Pruner(db_file, interval=0.05, pause=0).start()
+    try:
+        deadline = time.monotonic() + 10
+        while the_db.get_table("usage").len() > 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        the_db.get_table("usage").append(cpu=1.0)
+        while the_db.get_table("usage").len() > 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        pruner.stop()
+    assert the_db.get_table("usage").to_pandas()["logic_time"].tolist() == list(np.arange(92.0, 102.0))
@@ -0,0 +1,176 @@
+"""
+Tests for the chart pages and the /data/ endpoint.
+"""
+import concurrent.futures
+import gzip
+import json
+import os
+import re
+import time
+
+from simdash import serve
+from simdash.serve import app
+from simdash.database.database import Database
+
+def test_rows_since(served_db):
+    """
+    Only rows after the given rowid are returned.
+    """
+    client = app.test_client()
+    data = client.get("/data/rootpid1?rowid=3").get_json()
+    assert data["rowid"] == 5
+    assert data["r_column"] == "real_time"
+    assert [row["logic_time"] for row in data["rows"]] == [4.0, 5.0]
+
+    data = client.get("/data/rootpid1?rowid=5").get_json()
+    assert data["rowid"] == 5
+    assert data["rows"] == []
+
+    Database(served_db).get_table("rootpid1").append(cpu_percent=1, mem_percent=2)
+    data = client.get("/data/rootpid1?l_time=5").get_json()
+    assert data["rowid"] == 6
+    assert len(data["rows"]) == 1
+
+    assert client.get("/data/no_such_table").status_code == 404
+
+def test_chart_pages(served_db):
+    """
+    The chart pages render and start polling from the current last rowid.
+    """
+    client = app.test_client()
+    response = client.get("/displayconfig/")
+    assert response.status_code == 200
+    assert b'simdashLiveChart(\'#vis0\'' in response.data
+    assert b'"rootpid1",\n                   5, 5000' in response.data
+
+    response = client.get("/sys_usage")
+    assert response.status_code == 200
+    assert b'"sys_usage", 5, 5000' in response.data
+
+    response = client.post("/pid/", data={"UserValue": "root", "PIDValue": "1"})
+    assert response.status_code == 200
+    assert b'"rootpid1",\n                   5, 5000' in response.data
+    assert client.get("/pid/").status_code == 200
+
+def test_refetched_charts(served_db, monkeypatch):
+    """
+    New rows are added to charts in the browser up to max_points rows, charts the server changes in other ways
+    are fetched again from /chart/ as they are now.
+    """
+    client = app.test_client()
+    monkeypatch.setattr(serve, "MAX_POINTS", 10)
+    assert b'/chart/sys/0", 10);' in client.get("/sys_usage").data
+    monkeypatch.setattr(serve, "MAX_POINTS", None)
+    assert b'/chart/sys/0", null);' in client.get("/sys_usage").data
+    # Downsampled or read from rollups
+    monkeypatch.setattr(serve, "MAX_POINTS", 3)
+    page = client.get("/sys_usage").data.decode()
+    assert '/chart/sys/0", 0);' in page
+    spec = client.get("/chart/sys/0").get_json()
+    assert spec == json.loads(re.search(r"var yourVlSpec = (.*)", page).group(1))
+
+    with open(serve.CONFIG_PATH, "a") as config_file:
+        config_file.write('[[tab]]\ntable_name = "rootpid1"\nmark = "line"\nwindow = 2\n'
+                          '[tab.encode]\nx = "logic_time"\ny = "cpu_percent"\n')
+    monkeypatch.setattr(serve, "MAX_POINTS", None)
+    page = client.get("/displayconfig/").data
+    assert b'/chart/config/0",\n                   null);' in page
+    assert b'/chart/config/1",\n                   0);' in page
+    Database(served_db).get_table("rootpid1").append(cpu_percent=70, mem_percent=2)
+    rows = list(client.get("/chart/config/1").get_json()["usermeta"]["simdashDatasets"].values())
+    assert client.get(rows[0]).get_json()["columns"]["cpu_percent"] == [30.0, 40.0, 70.0]
+    assert client.get("/chart/config/2").status_code == 404
+    assert client.get("/chart/nope/0").status_code == 404
+
+def test_conditional_responses(served_db):
+    """
+    Unchanged pages and data are answered with 304 Not Modified.
+    """
+    client = app.test_client()
+    for url in ["/displayconfig/", "/pid/", "/sys_usage", "/data/rootpid1?rowid=5"]:
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert response.headers["Last-Modified"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+
+    etag = client.get("/displayconfig/").headers["ETag"]
+    Database(served_db).get_table("rootpid1").append(cpu_percent=1, mem_percent=2)
+    response = client.get("/displayconfig/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+def test_gzip_responses(served_db):
+    """
+    Large responses are gzipped for clients that accept it and still answer conditional requests.
+    """
+    client = app.test_client()
+    plain = client.get("/sys_usage")
+    assert "Content-Encoding" not in plain.headers
+    response = client.get("/sys_usage", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-gz"'
+    response = client.get("/sys_usage", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    small = client.get("/data/rootpid1?rowid=5", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+def test_datasets_by_url(served_db):
+    """
+    Pages hold chart specs without data, the datasets are loaded by URL as columns.
+    """
+    client = app.test_client()
+    page = client.get("/sys_usage").data.decode()
+    spec = json.loads(re.search(r"var yourVlSpec = (.*)", page).group(1))
+    assert all(rows == [] for rows in spec["datasets"].values())
+    assert spec["usermeta"]["simdashTemporal"] == ["real_time"]
+    url = list(spec["usermeta"]["simdashDatasets"].values())[0]
+
+    response = client.get(url)
+    data = response.get_json()
+    assert data["length"] == 5
+    assert data["columns"]["cpu_load"] == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert data["columns"]["real_time"][0].startswith("2019-08-06T10:00")
+    assert response.cache_control.immutable
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    # Another server process has to build the page's charts to find the dataset
+    serve.DATASET_CACHE.clear()
+    serve.CHART_CACHE.clear()
+    assert client.get(url).get_json() == data
+    assert client.get("/dataset/data-0123").status_code == 404
+
+def test_slow_and_failing_charts(served_db, monkeypatch):
+    """
+    Charts that are too slow or fail are shown as placeholders on a page that is not cached.
+    """
+    client = app.test_client()
+    serve.CHART_CACHE.clear()
+    monkeypatch.setattr(serve, "CHART_TIMEOUT", 0.1)
+    monkeypatch.setattr(serve.viz, "get_system_charts", lambda *args: time.sleep(1) or "{}")
+    response = client.get("/sys_usage")
+    assert response.status_code == 200
+    assert b"still being built" in response.data
+    assert "ETag" not in response.headers and response.cache_control.no_store
+
+    def fail(*args):
+        raise RuntimeError("no chart")
+    monkeypatch.setattr(serve.viz, "make_pid_chart", fail)
+    response = client.post("/pid/", data={"UserValue": "root", "PIDValue": "1"})
+    assert b"could not be built" in response.data
+
+def test_chart_timeout_starts_with_the_chart(served_db, monkeypatch):
+    """
+    The time a chart waits for a chart thread behind other work does not count against its timeout.
+    """
+    monkeypatch.setattr(serve, "CHART_TIMEOUT", 0.2)
+    monkeypatch.setattr(serve, "_CHART_EXECUTOR", concurrent.futures.ThreadPoolExecutor(1))
+    monkeypatch.setattr(serve, "_CHART_EXECUTOR_PID", os.getpid())
+    serve._CHART_EXECUTOR.submit(time.sleep, 0.4)
+    with app.test_request_context():
+        charts = serve.build_charts([(("queued",), time.time(), lambda: time.sleep(0.1) or "{}", "sys")])
+    assert json.loads(charts[0])["datasets"] == {}
+    serve._CHART_EXECUTOR.shutdown()
@@ -0,0 +1,130 @@
+"""
+Tests for buffered and bulk writes to a Table.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from simdash.database.database import Database
+from simdash.importer import import_file, read_chunks
+
+def make_test_table(tmp_path):
+    """
+    Create a database with a small table and return the table.
+    """
+    the_db = Database(str(tmp_path / "batch.db"))
+    the_db.make_table("batch_table", ["logic_time", "real_time", "a"], ["FLOAT", "INT", "INT"], ["Q", "T", "Q"])
+    return the_db.get_table("batch_table")
+
+def test_flush_on_row_count(tmp_path):
+    """
+    Rows are only written once max_rows are pending.
+    """
+    tab = make_test_table(tmp_path)
+    other = Database(str(tmp_path / "batch.db")).get_table("batch_table")
+    tab.buffered(max_rows=3, interval=None)
+    tab.append(a=1)
+    tab.append(a=2)
+    assert other.len() == 0
+    tab.append(a=3)
+    assert other.len() == 3
+    assert other.to_pandas()["logic_time"].tolist() == [1.0, 2.0, 3.0]
+
+def test_flush_on_interval(tmp_path):
+    """
+    Pending rows are written once the flush interval has passed.
+    """
+    tab = make_test_table(tmp_path)
+    other = Database(str(tmp_path / "batch.db")).get_table("batch_table")
+    tab.buffered(max_rows=1000, interval=0.05)
+    tab.append(a=1)
+    assert other.len() == 0
+    time.sleep(0.1)
+    tab.append(a=2)
+    assert other.len() == 2
+
+def test_flush_on_exit(tmp_path):
+    """
+    Leaving the context manager flushes and keeps logical time increasing.
+    """
+    tab = make_test_table(tmp_path)
+    with tab.buffered(max_rows=1000):
+        for i in range(10):
+            tab.append(a=i)
+        tab.append(a=10, l_time=100.0)
+        tab.append(a=11)
+    dframe = tab.to_pandas()
+    assert dframe["logic_time"].tolist() == [float(i) for i in range(1, 11)] + [100.0, 101.0]
+    assert tab.buffer_rows_ is None
+    tab.append(a=12)
+    assert tab.len() == 13
+
+def test_extend_from_arrays(tmp_path):
+    """
+    Extend fills in missing time columns and continues the logical time.
+    """
+    tab = make_test_table(tmp_path)
+    tab.append(a=0)
+    assert tab.extend({"a": np.arange(5)}, chunk_size=2) == 5
+    tab.append(a=5)
+    dframe = tab.to_pandas()
+    assert dframe["logic_time"].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+    assert dframe["a"].tolist() == [0, 0, 1, 2, 3, 4, 5]
+    with pytest.raises(ValueError):
+        tab.extend({"a": [1, 2], "not_a_column": [1, 2]})
+
+def test_extend_buffered(tmp_path):
+    """
+    Rows extended in buffered mode are written with the appended rows, in one transaction.
+    """
+    tab = make_test_table(tmp_path)
+    other = Database(str(tmp_path / "batch.db")).get_table("batch_table")
+    tab.buffered(max_rows=10, interval=None)
+    tab.append(a=0)
+    tab.extend({"a": np.arange(1, 5)}, chunk_size=2)
+    tab.append(a=5)
+    assert other.len() == 0
+    tab.flush()
+    assert other.to_pandas()["a"].tolist() == [0, 1, 2, 3, 4, 5]
+    tab.extend({"a": np.arange(6, 16)})
+    assert other.len() == 16
+
+def test_extend_from_dataframe(tmp_path):
+    """
+    Extend converts real time strings the same way append does.
+    """
+    tab = make_test_table(tmp_path)
+    dframe = pd.DataFrame({"logic_time": [10.0, 20.0], "real_time": ["08-06-2013", "08-07-2013"], "a": [1, 2]})
+    tab.extend(dframe)
+    tab.append(a=3, r_time="08-08-2013")
+    result = tab.to_pandas()
+    assert result["logic_time"].tolist() == [10.0, 20.0, 21.0]
+    assert result["real_time"].tolist() == [pd.Timestamp("08-06-2013").timestamp(),
+                                            pd.Timestamp("08-07-2013").timestamp(),
+                                            pd.Timestamp("08-08-2013").timestamp()]
+
+def test_import_csv(tmp_path):
+    """
+    Importing a CSV creates the table and appends its rows.
+    """
+    csv_file = tmp_path / "run.csv"
+    pd.DataFrame({"a": [1, 2, 3], "b": [0.5, 1.5, 2.5]}).to_csv(csv_file, index=False)
+    the_db = Database(str(tmp_path / "import.db"))
+    assert import_file(the_db, "run", str(csv_file), chunk_size=2) == 3
+    assert the_db.get_table_cols_and_vtypes("run") == (["logic_time", "real_time", "a", "b"], ["Q", "T", "Q", "Q"])
+    assert the_db.get_table("run").to_pandas()["b"].tolist() == [0.5, 1.5, 2.5]
+
+def test_import_parquet(tmp_path):
+    """
+    Parquet files are read a batch of chunk_size rows at a time.
+    """
+    pytest.importorskip("pyarrow")
+    parquet_file = tmp_path / "run.parquet"
+    pd.DataFrame({"a": [1, 2, 3, 4, 5], "c": list("vwxyz")}).to_parquet(parquet_file, row_group_size=5)
+    assert [len(chunk.index) for chunk in read_chunks(str(parquet_file), 2)] == [2, 2, 1]
+    the_db = Database(str(tmp_path / "import.db"))
+    assert import_file(the_db, "run", str(parquet_file), chunk_size=2) == 5
+    assert the_db.get_table_cols_and_vtypes("run")[1] == ["Q", "T", "Q", "N"]
+    assert the_db.get_table("run").to_pandas()["c"].tolist() == list("vwxyz")
@@ -0,0 +1,277 @@
+"""
+Tests for windowed reads from a Table.
+"""
+import json
+import os
+import sqlite3
+
+import altair as alt
+import numpy as np
+import pandas as pd
+import pytest
+
+from simdash.database.database import Database
+from simdash.viz import chart_toml
+from simdash.viz.chart_toml import create_toml_chart_without_encodings, create_toml_charts_without_encodings
+from simdash.viz.viz import convert_real_time
+
+def make_test_table(tmp_path, num_rows=10):
+    """
+    Create a table with one row per hour of real time.
+    """
+    the_db = Database(str(tmp_path / "query.db"))
+    the_db.make_table("query_table", ["logic_time", "real_time", "a", "b"],
+                      ["FLOAT", "INT", "INT", "TEXT"], ["Q", "T", "Q", "N"])
+    tab = the_db.get_table("query_table")
+    tab.extend({"a": list(range(num_rows)), "b": [str(i) for i in range(num_rows)],
+                "real_time": pd.date_range("2019-01-01", periods=num_rows, freq="h")})
+    return tab
+
+def index_names(db_file):
+    """
+    Get the names of all indexes in a database file.
+    """
+    conn = sqlite3.connect(db_file)
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index';")}
+
+def test_windowed_reads(tmp_path):
+    """
+    Time windows, column subsets and limits only return the rows asked for.
+    """
+    tab = make_test_table(tmp_path)
+    assert tab.to_pandas(start=3, end=5)["a"].tolist() == [2, 3, 4]
+    assert tab.to_pandas(start="2019-01-01 07:00", by="real")["a"].tolist() == [7, 8, 9]
+    assert tab.to_pandas(end=pd.Timestamp("2019-01-01 01:00"), by="real")["a"].tolist() == [0, 1]
+    assert tab.to_pandas(limit=3)["a"].tolist() == [7, 8, 9]
+    assert tab.to_pandas(start=2, limit=2, columns=["a"]).columns.tolist() == ["a"]
+    assert tab.time_range() == (1.0, 10.0)
+    with pytest.raises(ValueError):
+        tab.to_pandas(columns=["c"])
+    with pytest.raises(ValueError):
+        tab.to_pandas(start=1, by="wall")
+
+def test_iter_chunks(tmp_path):
+    """
+    Chunks cover the rows asked for once each, in order.
+    """
+    tab = make_test_table(tmp_path)
+    chunks = list(tab.iter_chunks(4))
+    assert [len(chunk.index) for chunk in chunks] == [4, 4, 2]
+    assert pd.concat(chunks, ignore_index=True).equals(tab.to_pandas())
+    chunks = list(tab.iter_chunks(2, start="2019-01-01 05:00", columns=["a"], by="real", numpy=True))
+    assert [chunk["a"].tolist() for chunk in chunks] == [[5, 6], [7, 8], [9]]
+    assert not list(tab.iter_chunks(5, start=11))
+
+def test_to_numpy(tmp_path):
+    """
+    Columns are read into typed arrays, with real time as local datetimes on request.
+    """
+    tab = make_test_table(tmp_path)
+    tab.append(b="no a")
+    data = tab.to_numpy(start=9, datetimes=True)
+    assert data["a"].dtype == np.float64 and np.isnan(data["a"][-1])
+    assert data["b"].tolist() == ["8", "9", "no a"]
+    assert data["real_time"][:2].tolist() == pd.to_datetime(["2019-01-01 08:00", "2019-01-01 09:00"]).tolist()
+    assert tab.to_numpy(end=3, columns=["a"])["a"].dtype == np.int64
+    with tab.conn_:
+        tab.conn_.execute("UPDATE query_table SET a = 'x' WHERE rowid = 1;")
+    assert tab.to_pandas()["a"].tolist()[:2] == ["x", 1]
+
+def test_arrow_export(tmp_path):
+    """
+    Tables are exported to Arrow tables and IPC streams.
+    """
+    pyarrow = pytest.importorskip("pyarrow")
+    tab = make_test_table(tmp_path)
+    assert tab.to_arrow(columns=["a", "real_time"]).column("a").to_pylist() == list(range(10))
+    path = str(tmp_path / "query.arrows")
+    assert tab.write_arrow(path, chunk_size=3) == 10
+    with pyarrow.ipc.open_stream(path) as reader:
+        table = reader.read_all()
+    assert table.num_rows == 10 and pyarrow.types.is_timestamp(table.schema.field("real_time").type)
+
+def test_time_indexes(tmp_path):
+    """
+    New tables get time indexes and old databases get them by migration.
+    """
+    make_test_table(tmp_path)
+    db_file = str(tmp_path / "query.db")
+    assert {"query_table__logic_time", "query_table__real_time"} <= index_names(db_file)
+
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute('DROP INDEX "query_table__logic_time";')
+        conn.execute('DROP INDEX "query_table__real_time";')
+        conn.execute("PRAGMA user_version = 0;")
+    assert not index_names(db_file)
+    Database(db_file)
+    assert {"query_table__logic_time", "query_table__real_time"} <= index_names(db_file)
+
+def test_toml_window(tmp_path):
+    """
+    The window key of a [[tab]] block only reads the rows in the rolling window.
+    """
+    db_file = str(tmp_path / "window.db")
+    the_db = Database(db_file)
+    the_db.make_table("window", ["logic_time", "real_time", "a"], ["FLOAT", "INT", "FLOAT"], ["Q", "T", "Q"])
+    the_db.get_table("window").extend({"a": np.arange(48.0),
+                                       "real_time": pd.date_range("2019-01-01", periods=48, freq="h")})
+    config_file = tmp_path / "window.toml"
+    config_file.write_text('[[tab]]\ntable_name = "window"\nmark = "line"\nwindow = "2 hours"\n'
+                           '[tab.encode]\nx = "logic_time"\ny = "a"\n'
+                           '[[tab]]\ntable_name = "window"\nmark = "line"\nwindow = 9\nlimit = 4\n'
+                           '[tab.encode]\nx = "logic_time"\ny = "a"\n')
+    specs = [json.loads(chart) for chart in create_toml_charts_without_encodings(db_file, str(config_file))]
+    assert [row["a"] for row in list(specs[0]["datasets"].values())[0]] == [45.0, 46.0, 47.0]
+    assert [row["a"] for row in list(specs[1]["datasets"].values())[0]] == [44.0, 45.0, 46.0, 47.0]
+
+def test_aggregate(tmp_path):
+    """
+    Tables are binned, grouped and aggregated in SQL.
+    """
+    tab = make_test_table(tmp_path)
+    dframe = tab.aggregate({"a": "mean"}, bin_column="logic_time", bin_step=4)
+    assert dframe.to_dict("list") == {"logic_time": [0.0, 4.0, 8.0], "a": [1.0, 4.5, 8.0]}
+    dframe = tab.aggregate({"a": "max", "logic_time": "count"}, group_by=["b"], limit=2)
+    assert dframe.to_dict("list") == {"b": ["8", "9"], "a": [8, 9], "logic_time": [1, 1]}
+    assert tab.aggregate({"a": "sum"}, start=9).to_dict("list") == {"a": [17]}
+    # Bins are floored, so values in (-4, 0) are not put in the bin of [0, 4)
+    tab.extend({"a": [-5, -4, -1, 0, 3], "b": ["x"] * 5})
+    dframe = tab.aggregate({"logic_time": "count"}, bin_column="a", bin_step=4, start=11)
+    assert dframe.to_dict("list") == {"a": [-8.0, -4.0, 0.0], "logic_time": [1, 2, 2]}
+    with pytest.raises(ValueError):
+        tab.aggregate({"a": "median"})
+    with pytest.raises(ValueError):
+        tab.aggregate({"a": "sum"}, group_by=["a"])
+
+def test_toml_projection_and_aggregate(tmp_path):
+    """
+    Charts only read their encoded columns and aggregate on the server when asked to.
+    """
+    db_file = str(tmp_path / "wide.db")
+    the_db = Database(db_file)
+    columns = ["logic_time", "real_time"] + [f"c{i}" for i in range(20)]
+    the_db.make_table("wide", columns, ["FLOAT", "INT"] + ["FLOAT"] * 20, ["Q", "T"] + ["Q"] * 20)
+    the_db.get_table("wide").extend({"c0": np.arange(100.0), "c1": np.arange(100.0) % 2,
+                                     "real_time": pd.date_range("2019-01-01", periods=100, freq="min")})
+    config_file = tmp_path / "wide.toml"
+    config_file.write_text('[[tab]]\ntable_name = "wide"\nmark = "line"\n'
+                           '[tab.encode]\nx = "logic_time"\ny = "c0"\n'
+                           '[[tab]]\ntable_name = "wide"\nmark = "line"\nbin = "30min"\naggregate = "max"\n'
+                           '[tab.encode]\nx = "real_time"\ny = "c0"\ncolor = "c1"\n')
+    specs = [json.loads(chart) for chart in create_toml_charts_without_encodings(db_file, str(config_file))]
+    rows = list(specs[0]["datasets"].values())[0]
+    assert len(rows) == 100 and set(rows[0]) == {"logic_time", "real_time", "c0"}
+    rows = list(specs[1]["datasets"].values())[0]
+    assert [(row["c1"], row["c0"]) for row in rows] == [(0.0, 28.0), (1.0, 29.0), (0.0, 58.0), (1.0, 59.0),
+                                                        (0.0, 88.0), (1.0, 89.0), (0.0, 98.0), (1.0, 99.0)]
+    assert rows[0]["real_time"].startswith("2019-01-01T00:00")
+
+def test_stats(tmp_path):
+    """
+    Statistics cover every row and are extended as rows are added or dropped.
+    """
+    tab = make_test_table(tmp_path)
+    stats = tab.stats()
+    assert tab.len() == stats["rows"] == 10
+    assert stats["l_time"] == (1.0, 10.0)
+    assert stats["columns"] == {"a": (0, 9)}
+    tab.append(a=-5, b="x")
+    tab.append(a=20, b="y")
+    stats = tab.stats()
+    assert stats["rows"] == 12
+    assert stats["l_time"] == (1.0, 12.0)
+    assert stats["columns"]["a"] == (-5, 20)
+
+    with tab.conn_:
+        tab.conn_.execute('DELETE FROM "query_table" WHERE rowid <= 11;')
+    fresh = Database(str(tmp_path / "query.db")).get_table("query_table")
+    assert fresh.stats() == {"rows": 1, "l_time": (12.0, 12.0), "r_time": fresh.time_range("real"),
+                             "columns": {"a": (20, 20)}}
+
+    # Rows deleted from the middle and the end are noticed by the count of rows
+    (tmp_path / "middle").mkdir()
+    tab = make_test_table(tmp_path / "middle")
+    assert tab.stats()["rows"] == 10
+    with tab.conn_:
+        tab.conn_.execute('DELETE FROM "query_table" WHERE rowid IN (5, 10);')
+    assert tab.len() == 8
+    assert tab.stats() == {"rows": 8, "l_time": (1.0, 9.0), "r_time": tab.time_range("real"),
+                           "columns": {"a": (0, 8)}}
+
+    # A file made again with the same name, schema version and number of rows is not taken for the old one
+    for path in (tmp_path / "middle").glob("query.db*"):
+        path.unlink()
+    tab = make_test_table(tmp_path / "middle", num_rows=8)
+    tab.conn_.execute('UPDATE "query_table" SET a = a + 100;')
+    tab.conn_.commit()
+    assert tab.stats()["columns"] == {"a": (100, 107)}
+
+def test_rollups(tmp_path):
+    """
+    Rollups hold the mean, min and max of every bucket as rows arrive, and charts of many rows read them.
+    """
+    the_db = Database(str(tmp_path / "rollup.db"))
+    the_db.make_table("usage", ["logic_time", "real_time", "cpu", "mem"], ["FLOAT", "INT", "FLOAT", "FLOAT"],
+                      ["Q", "T", "Q", "Q"], rollups={"1min": ["cpu", "mem"], "1h": ["cpu"]})
+    the_tab = the_db.get_table("usage")
+    real_time = 1565085600 + 10 * np.arange(1080)
+    cpu = np.arange(1080) % 7
+    the_tab.extend({"real_time": real_time[:1000], "cpu": cpu[:1000], "mem": np.ones(1000)})
+    with the_tab.buffered():
+        for i in range(1000, 1080):
+            the_tab.append(r_time=pd.Timestamp(int(real_time[i]), unit="s"), cpu=int(cpu[i]), mem=None)
+
+    expected = pd.DataFrame({"bucket": real_time // 60 * 60, "cpu": cpu}).groupby("bucket")["cpu"]
+    minutes = the_tab.read_rollup(60)
+    assert minutes["real_time"].tolist() == expected.mean().index.tolist()
+    assert np.allclose(minutes["cpu"], expected.mean())
+    assert minutes["mem"].iloc[-1] != minutes["mem"].iloc[-1] and minutes["mem"].iloc[0] == 1.0
+    assert the_tab.read_rollup(60, aggregate="max")["cpu"].tolist() == expected.max().tolist()
+    hours = the_tab.read_rollup(3600, start=real_time[500], by="real", aggregate="min")
+    assert hours["real_time"].tolist() == [1565085600 + 3600, 1565085600 + 7200]
+    assert hours["logic_time"].tolist() == [720.0, 1080.0]
+
+    assert the_tab.choose_rollup(5000) is None
+    assert the_tab.choose_rollup(200) == 60
+    assert the_tab.choose_rollup(100) == 60
+    assert the_tab.choose_rollup(100, columns=["real_time", "cpu"]) == 3600
+    assert the_tab.choose_rollup(100, start=1000) is None
+
+    # A rollup added to a table with rows starts out with them
+    the_db.add_rollup("usage", 600, ["cpu"])
+    tens = the_db.get_table("usage").read_rollup(600)
+    assert np.allclose(tens["cpu"], pd.Series(cpu).groupby(real_time // 600).mean())
+    with pytest.raises(ValueError):
+        the_db.add_rollup("usage", "10min", ["cpu"])
+
+    chart = json.loads(create_toml_chart_without_encodings(
+        the_db, {"table_name": "usage", "mark": "line", "max_points": 100,
+                 "encode": {"x": "real_time", "y": "cpu"}}))
+    assert len(next(iter(chart["datasets"].values()))) == 18
+
+    the_db.remove_table("usage")
+    conn = sqlite3.connect(str(tmp_path / "rollup.db"))
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'usage%';").fetchall()
+    assert tables == []
+
+def test_compiled_config(tmp_path):
+    """
+    Config files are parsed again only when they change, and charts are compiled once into templates
+    that render the same spec as Altair.
+    """
+    tab = make_test_table(tmp_path)
+    config_file = tmp_path / "compiled.toml"
+    config_file.write_text('[[tab]]\ntable_name = "query_table"\nmark = "line"\n'
+                           '[tab.encode]\nx = "real_time"\ny = "a"\ncolor = "b"\n')
+    config = chart_toml.load_config(str(config_file))
+    assert chart_toml.load_config(str(config_file)) is config
+    config_file.write_text(config_file.read_text().replace('"line"', '"point"'))
+    os.utime(config_file, ns=(0, os.stat(config_file).st_mtime_ns + 10 ** 9))
+    assert chart_toml.load_config(str(config_file))['tab'][0]['mark'] == "point"
+
+    misses = chart_toml.TEMPLATES.misses
+    first, second = [create_toml_charts_without_encodings(tab.filename_, str(config_file))[0] for _ in range(2)]
+    assert first == second and chart_toml.TEMPLATES.misses == misses + 1
+    dframe = convert_real_time(tab.to_pandas(), "real_time")
+    assert first == alt.Chart(dframe).mark_point().encode(x="real_time:T", y="a:Q", color="b").to_json()